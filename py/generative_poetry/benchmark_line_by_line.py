@@ -0,0 +1,60 @@
+"""
+Сравнение обычной генерации (generate_poems) и построчной генерации с откатом по кэшу
+(generate_poems_line_by_line) по числу декодированных токенов и времени на один принятый стих.
+
+    python -m generative_poetry.benchmark_line_by_line --topics "зима,любовь,осенний лес"
+"""
+
+import os
+import time
+import logging
+import argparse
+
+from generative_poetry.long_poem_generator2 import LongPoemGeneratorCore2
+
+
+def run_mode(name, generate_fn, topics, stats_fn):
+    nb_accepted = 0
+    tokens0 = stats_fn()
+    t0 = time.time()
+    for topic in topics:
+        poems = generate_fn(topic)
+        nb_accepted += len(poems)
+        logging.info('%s: topic="%s" accepted=%d', name, topic, len(poems))
+    elapsed = time.time() - t0
+    nb_tokens = stats_fn() - tokens0
+
+    if nb_accepted:
+        print('{:<14} accepted={:<4} tokens={:<8} tokens/poem={:<10.1f} sec/poem={:.2f}'.format(
+            name, nb_accepted, nb_tokens, nb_tokens / float(nb_accepted), elapsed / nb_accepted))
+    else:
+        print('{:<14} accepted=0    tokens={}'.format(name, nb_tokens))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokens per accepted poem: whole-sample vs line-by-line generation')
+    parser.add_argument('--tmp_dir', default='../../tmp', type=str)
+    parser.add_argument('--data_dir', default='../../data', type=str)
+    parser.add_argument('--models_dir', default='../../models', type=str)
+    parser.add_argument('--gpt_name', default='stressed_long_poetry_generator_medium', type=str)
+    parser.add_argument('--topics', default='зима,любовь,осенний лес,море,дорога домой', type=str)
+    parser.add_argument('--num_return_sequences', type=int, default=10)
+    parser.add_argument('--num_poems', type=int, default=5, help='Poems per topic in line-by-line mode')
+    parser.add_argument('--max_line_attempts', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    core = LongPoemGeneratorCore2(args.gpt_name)
+    core.load(os.path.expanduser(args.models_dir), os.path.expanduser(args.data_dir), os.path.expanduser(args.tmp_dir))
+    core.line_generator.max_line_attempts = args.max_line_attempts
+
+    topics = [topic.strip() for topic in args.topics.split(',') if topic.strip()]
+
+    run_mode('whole-sample',
+             lambda topic: core.generate_poems(topic, num_return_sequences=args.num_return_sequences),
+             topics, lambda: core.poem_generator.nb_decoded_tokens)
+    run_mode('line-by-line',
+             lambda topic: core.generate_poems_line_by_line(topic, num_poems=args.num_poems),
+             topics, lambda: core.line_generator.nb_decoded_tokens)
+    print(core.line_generator.get_stats_str())
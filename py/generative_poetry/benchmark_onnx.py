@@ -0,0 +1,64 @@
+"""
+Скорость генерации (токены в секунду) PyTorch- и ONNX Runtime-бэкендов RugptGenerator на одних и тех же затравках.
+
+    python -m generative_poetry.benchmark_onnx --topics "зима,любовь,осенний лес"
+"""
+
+import os
+import time
+import logging
+import argparse
+
+import torch
+
+from generative_poetry.long_poem_generator2 import LongPoemGeneratorCore2, RugptGenerator
+from generative_poetry.onnx_generator import OnnxRugptGenerator
+
+
+def run_backend(name, generator, seeds, num_return_sequences):
+    tokens0 = generator.nb_decoded_tokens
+    nb_texts = 0
+    t0 = time.time()
+    for seed in seeds:
+        nb_texts += len(generator.generate_output(seed, num_return_sequences=num_return_sequences, top_p=0.5, top_k=30))
+    elapsed = time.time() - t0
+    nb_tokens = generator.nb_decoded_tokens - tokens0
+    print('{:<6} tokens={:<8} elapsed={:<8.1f} tokens/s={:<8.1f} texts={}'.format(
+        name, nb_tokens, elapsed, nb_tokens / elapsed if elapsed > 0 else 0.0, nb_texts))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokens/sec of the PyTorch and ONNX Runtime GPT backends')
+    parser.add_argument('--tmp_dir', default='../../tmp', type=str)
+    parser.add_argument('--data_dir', default='../../data', type=str)
+    parser.add_argument('--models_dir', default='../../models', type=str)
+    parser.add_argument('--gpt_name', default='stressed_long_poetry_generator_medium', type=str)
+    parser.add_argument('--topics', default='зима,любовь,осенний лес,море,дорога домой', type=str)
+    parser.add_argument('--num_return_sequences', type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    models_dir = os.path.expanduser(args.models_dir)
+    tmp_dir = os.path.expanduser(args.tmp_dir)
+    model_dir = os.path.join(models_dir, args.gpt_name)
+
+    # Затравки строятся один раз, чтобы оба бэкенда получили одинаковые промпты.
+    core = LongPoemGeneratorCore2(args.gpt_name)
+    core.load(models_dir, os.path.expanduser(args.data_dir), tmp_dir)
+    seeds = [core.build_seed(topic.strip()) for topic in args.topics.split(',') if topic.strip()]
+
+    torch_generator = core.poem_generator
+    if torch_generator.device.type != 'cpu':
+        # сравниваем на CPU, как работает ONNX-бэкенд
+        torch_generator = RugptGenerator()
+        torch_generator.device = torch.device('cpu')
+        torch_generator.load(model_dir)
+
+    onnx_generator = OnnxRugptGenerator()
+    onnx_generator.load(model_dir, onnx_path=os.path.join(tmp_dir, args.gpt_name + '.onnx'))
+
+    torch.manual_seed(1)
+    run_backend('torch', torch_generator, seeds, args.num_return_sequences)
+    torch.manual_seed(1)
+    run_backend('onnx', onnx_generator, seeds, args.num_return_sequences)
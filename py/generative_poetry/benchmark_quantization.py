@@ -0,0 +1,73 @@
+"""
+Сравнение fp32 и int8 (динамическая квантизация) GPT-модели на CPU: скорость генерации в токенах
+в секунду и доля вариантов, принятых выравнивателем.
+
+    python -m generative_poetry.benchmark_quantization --topics "зима,любовь,осенний лес"
+"""
+
+import os
+import time
+import logging
+import argparse
+
+import torch
+
+from generative_poetry.long_poem_generator2 import LongPoemGeneratorCore2, RugptGenerator
+
+
+def run_mode(name, core, generator, topics, num_return_sequences, score_threshold):
+    core.poem_generator = generator
+    tokens0 = generator.nb_decoded_tokens
+    nb_samples = 0
+    nb_accepted = 0
+    gen_time = 0.0
+    for topic in topics:
+        seed = core.build_seed(topic)
+        t0 = time.time()
+        poems = generator.generate_output(seed, num_return_sequences=num_return_sequences, top_p=0.5, top_k=30)
+        gen_time += time.time() - t0
+
+        nb_samples += len(poems)
+        nb_accepted += len(core.rank_poems(poems, score_threshold))
+
+    nb_tokens = generator.nb_decoded_tokens - tokens0
+    print('{:<5} tokens/s={:<8.1f} samples={:<5} accepted={:<5} acceptance_rate={:.3f}'.format(
+        name, nb_tokens / gen_time if gen_time > 0 else 0.0, nb_samples, nb_accepted,
+        nb_accepted / float(nb_samples) if nb_samples else 0.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput and acceptance rate of fp32 vs int8 GPT model on CPU')
+    parser.add_argument('--tmp_dir', default='../../tmp', type=str)
+    parser.add_argument('--data_dir', default='../../data', type=str)
+    parser.add_argument('--models_dir', default='../../models', type=str)
+    parser.add_argument('--gpt_name', default='stressed_long_poetry_generator_medium', type=str)
+    parser.add_argument('--topics', default='зима,любовь,осенний лес,море,дорога домой', type=str)
+    parser.add_argument('--num_return_sequences', type=int, default=10)
+    parser.add_argument('--score_threshold', type=float, default=0.20)
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 - leave the default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    models_dir = os.path.expanduser(args.models_dir)
+    tmp_dir = os.path.expanduser(args.tmp_dir)
+
+    core = LongPoemGeneratorCore2(args.gpt_name)
+    core.load(models_dir, os.path.expanduser(args.data_dir), tmp_dir)
+    fp32_generator = core.poem_generator
+    if fp32_generator.device.type != 'cpu':
+        logging.warning('CUDA is available, int8 mode will fall back to fp32; run with CUDA_VISIBLE_DEVICES=""')
+
+    int8_generator = RugptGenerator()
+    int8_generator.load(os.path.join(models_dir, args.gpt_name), quantize=True,
+                        quantized_cache_path=os.path.join(tmp_dir, args.gpt_name + '.int8.pt'))
+
+    topics = [topic.strip() for topic in args.topics.split(',') if topic.strip()]
+    torch.manual_seed(1)
+    run_mode('fp32', core, fp32_generator, topics, args.num_return_sequences, args.score_threshold)
+    torch.manual_seed(1)
+    run_mode('int8', core, int8_generator, topics, args.num_return_sequences, args.score_threshold)
@@ -0,0 +1,78 @@
+"""
+Ускорение генерации за счет спекулятивного декодирования с маленькой черновой моделью.
+Спекулятивное сэмплирование сохраняет распределение основной модели, поэтому качество сравниваем
+по доле вариантов, принятых выравнивателем, а скорость - по времени генерации на один принятый стих.
+Ранжирование в замер времени не входит: второй режим получал бы уже прогретые кэши ударений и рифм.
+
+    python -m generative_poetry.benchmark_speculative --draft_gpt_name stressed_long_poetry_generator_small
+"""
+
+import os
+import time
+import logging
+import argparse
+
+import torch
+
+from generative_poetry.long_poem_generator2 import LongPoemGeneratorCore2
+
+
+def run_mode(name, core, draft_model, seeds, num_return_sequences, score_threshold):
+    generator = core.poem_generator
+    generator.draft_model = draft_model
+
+    # прогрев: первые вызовы generate в каждом режиме заметно медленнее остальных
+    generator.generate_output(seeds[0], num_return_sequences=1, top_p=0.5, top_k=30)
+
+    rows0 = generator.nb_generated_rows
+    assisted0 = generator.nb_assisted_rows
+    nb_samples = 0
+    nb_accepted = 0
+    gen_time = 0.0
+    for seed in seeds:
+        t0 = time.time()
+        poems = generator.generate_output(seed, num_return_sequences=num_return_sequences, top_p=0.5, top_k=30)
+        gen_time += time.time() - t0
+
+        nb_samples += len(poems)
+        nb_accepted += len(core.rank_poems(poems, score_threshold))
+
+    print('{:<12} generation={:<8.1f} samples={:<5} accepted={:<5} acceptance_rate={:.3f} sec/accepted={:.2f} '
+          'assisted_rows={}/{}'.format(name, gen_time, nb_samples, nb_accepted,
+                                       nb_accepted / float(nb_samples) if nb_samples else 0.0,
+                                       gen_time / nb_accepted if nb_accepted else float('inf'),
+                                       generator.nb_assisted_rows - assisted0, generator.nb_generated_rows - rows0))
+    return gen_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generation speedup of speculative decoding with a draft model')
+    parser.add_argument('--tmp_dir', default='../../tmp', type=str)
+    parser.add_argument('--data_dir', default='../../data', type=str)
+    parser.add_argument('--models_dir', default='../../models', type=str)
+    parser.add_argument('--gpt_name', default='stressed_long_poetry_generator_medium', type=str)
+    parser.add_argument('--draft_gpt_name', default='stressed_long_poetry_generator_small', type=str)
+    parser.add_argument('--num_assistant_tokens', type=int, default=5)
+    parser.add_argument('--topics', default='зима,любовь,осенний лес,море,дорога домой', type=str)
+    parser.add_argument('--num_return_sequences', type=int, default=10)
+    parser.add_argument('--score_threshold', type=float, default=0.20)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    models_dir = os.path.expanduser(args.models_dir)
+    core = LongPoemGeneratorCore2(args.gpt_name)
+    core.load(models_dir, os.path.expanduser(args.data_dir), os.path.expanduser(args.tmp_dir))
+    seeds = [core.build_seed(topic.strip()) for topic in args.topics.split(',') if topic.strip()]
+
+    core.poem_generator.load_draft_model(os.path.join(models_dir, args.draft_gpt_name), args.num_assistant_tokens)
+    draft_model = core.poem_generator.draft_model
+
+    torch.manual_seed(1)
+    baseline_time = run_mode('baseline', core, None, seeds, args.num_return_sequences, args.score_threshold)
+    torch.manual_seed(1)
+    speculative_time = run_mode('speculative', core, draft_model, seeds, args.num_return_sequences, args.score_threshold)
+
+    print(core.poem_generator.speculative_stats.get_stats_str())
+    print('generation speedup={:.2f}'.format(baseline_time / speculative_time if speculative_time > 0 else 0.0))
+    print('Note: temperature schedules, streaming and row callbacks always bypass the draft model')
@@ -0,0 +1,147 @@
+"""
+Динамическое объединение запросов к RugptGenerator в пакеты.
+
+Запросы от разных пользователей, пришедшие в течение короткого окна, собираются в один вызов
+model.generate: затравки выравниваются паддингом слева, а результаты раздаются обратно по
+запросам. В пакет попадают только запросы с одинаковыми параметрами генерации.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+
+class GenerationRequest(object):
+    def __init__(self, context, gen_params, row_callback=None, stop_event=None):
+        self.context = context
+        self.gen_params = gen_params
+        self.row_callback = row_callback
+        self.stop_event = stop_event
+        self.key = tuple(sorted(gen_params.items()))
+        self.enqueue_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchStopEvent(object):
+    """
+    Остановка пакета для FinishedRowsStreamer: пакет прерывается, только когда остановлены все его запросы,
+    а запросы без stop_event (обычные, не потоковые) дожидаются завершения генерации.
+    """
+    def __init__(self, requests):
+        self.requests = requests
+
+    def is_set(self):
+        return all(request.stop_event is not None and request.stop_event.is_set() for request in self.requests)
+
+
+class GenerationBatcher(object):
+    def __init__(self, generator, max_batch_size=8, max_wait=0.05):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        # запросы, не подошедшие по параметрам к предыдущему пакету
+        self.pending = []
+
+        self.nb_batches = 0
+        self.nb_requests = 0
+        self.total_queue_latency = 0.0
+        self.max_queue_latency = 0.0
+
+        self.thread = threading.Thread(target=self.run, name='GenerationBatcher', daemon=True)
+        self.thread.start()
+
+    def generate_output(self, context, row_callback=None, stop_event=None, **gen_params):
+        """
+        Аналог RugptGenerator.generate_output, блокирует вызывающий поток до готовности результата.
+        row_callback(text) получает каждый вариант этого запроса сразу после его завершения, stop_event
+        прекращает выдачу вариантов запросу (см. RugptGenerator.generate_output_batch).
+        """
+        request = GenerationRequest(context, gen_params, row_callback, stop_event)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def collect_batch(self):
+        if self.pending:
+            first = self.pending.pop(0)
+        else:
+            first = self.requests.get()
+
+        batch = [first]
+        rest = []
+        for request in self.pending:
+            if request.key == first.key and len(batch) < self.max_batch_size:
+                batch.append(request)
+            else:
+                rest.append(request)
+        self.pending = rest
+
+        deadline = first.enqueue_time + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if request.key == first.key:
+                batch.append(request)
+            else:
+                self.pending.append(request)
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+
+            t0 = time.time()
+            for request in batch:
+                latency = t0 - request.enqueue_time
+                self.total_queue_latency += latency
+                self.max_queue_latency = max(self.max_queue_latency, latency)
+
+            stream_params = dict()
+            if any(request.row_callback is not None for request in batch):
+                stream_params['row_callback'] = lambda icontext, text: self.dispatch_row(batch[icontext], text)
+                stream_params['stop_event'] = BatchStopEvent(batch)
+
+            try:
+                outputs = self.generator.generate_output_batch([request.context for request in batch],
+                                                               **batch[0].gen_params, **stream_params)
+                for request, output in zip(batch, outputs):
+                    request.result = output
+            except Exception as ex:
+                logging.error('Batched generation failed: %s', ex)
+                for request in batch:
+                    request.error = ex
+
+            self.nb_batches += 1
+            self.nb_requests += len(batch)
+            logging.debug('Generated batch of %d/%d requests in %.2f sec; %s', len(batch), self.max_batch_size,
+                          time.time() - t0, self.get_stats_str())
+
+            for request in batch:
+                request.done.set()
+
+    @staticmethod
+    def dispatch_row(request, text):
+        if request.row_callback is not None and (request.stop_event is None or not request.stop_event.is_set()):
+            request.row_callback(text)
+
+    def get_stats_str(self):
+        if self.nb_batches == 0:
+            return 'generation batcher: no batches yet'
+
+        return 'generation batcher: batches={} requests={} avg_batch_fill={:.2f} avg_queue_latency={:.3f}s ' \
+               'max_queue_latency={:.3f}s'.format(self.nb_batches, self.nb_requests,
+                                                  self.nb_requests / float(self.nb_batches * self.max_batch_size),
+                                                  self.total_queue_latency / self.nb_requests, self.max_queue_latency)
@@ -0,0 +1,287 @@
+"""
+Дополнительные обработчики логитов и счетчики для RugptGenerator.
+"""
+
+import torch
+import transformers
+
+
+class RowTemperatureLogitsWarper(transformers.LogitsProcessor):
+    """Температура задается отдельно для каждой строки пакета генерации"""
+    def __init__(self, temperatures):
+        # temperatures - тензор размера batch_size
+        self.temperatures = temperatures
+
+    def __call__(self, input_ids, scores):
+        return scores / self.temperatures.to(scores.dtype).unsqueeze(1)
+
+
+def build_sampling_warpers(temperatures, top_k, top_p, typical_p):
+    """
+    Цепочка температура + top_k + top_p + typical_p в том же порядке, в каком ее собирает generate
+    для скалярной температуры.
+    """
+    warpers = [RowTemperatureLogitsWarper(temperatures)]
+    if top_k is not None and top_k != 0:
+        warpers.append(transformers.TopKLogitsWarper(top_k=top_k, min_tokens_to_keep=1))
+    if top_p is not None and top_p < 1.0:
+        warpers.append(transformers.TopPLogitsWarper(top_p=top_p, min_tokens_to_keep=1))
+    if typical_p is not None and typical_p < 1.0:
+        warpers.append(transformers.TypicalLogitsWarper(mass=typical_p, min_tokens_to_keep=1))
+    return warpers
+
+
+def make_row_temperatures(temperatures, nb_contexts, num_return_sequences, device):
+    """
+    generate возвращает строки подряд для каждой затравки; внутри затравки первые num_return_sequences
+    строк получают первую температуру расписания, следующие - вторую и т.д.
+    """
+    row_temperatures = [t for _ in range(nb_contexts) for t in temperatures for _ in range(num_return_sequences)]
+    return torch.tensor(row_temperatures, dtype=torch.float32, device=device)
+
+
+# Размеры стоп, как в poetry_alignment.meters
+METER_SIGNATURES = [(1, 0), (0, 1), (1, 0, 0), (0, 1, 0), (0, 0, 1)]
+
+
+def get_line_stress_signature(line_tokens):
+    """
+    Схема ударности строки по разметке, которую выдает сама модель. Токены строки идут в порядке
+    генерации, то есть слоги и слова переставлены задом наперед. Для односложных слов без
+    отметки ударения в схеме стоит None - такой слог может быть и ударным, и безударным.
+    Вернет None, если строку оценить нельзя (есть посимвольные токены ##).
+    """
+    signature = []
+    words = []
+    word = []
+    for token in line_tokens[::-1]:
+        if token.startswith('##'):
+            return None
+        if token == '|':
+            words.append(word)
+            word = []
+        else:
+            word.append(token)
+    words.append(word)
+
+    for word in words:
+        word_signature = []
+        for syllable in word:
+            for i, c in enumerate(syllable):
+                if c.lower() in 'уеыаоэёяию':
+                    word_signature.append(1 if syllable[i + 1: i + 2] == '\u0301' else 0)
+
+        if len(word_signature) == 1 and word_signature[0] == 0:
+            word_signature = [None]
+        signature.extend(word_signature)
+
+    return signature
+
+
+def score_line_meters(signature):
+    """Для каждого метра вернет оценку строки в духе MetreMappingCursor: 0.1 за лишнее ударение, 0.95 за пропущенное"""
+    scores = []
+    for meter in METER_SIGNATURES:
+        best_score = 0.0
+        for prefix in (0, 1):
+            FP, FN = 0, 0
+            for pos, sign in enumerate(signature):
+                if prefix:
+                    metre_sign = 0 if pos == 0 else meter[(pos - prefix) % len(meter)]
+                else:
+                    metre_sign = meter[pos % len(meter)]
+
+                if sign is None:
+                    continue
+                elif metre_sign and not sign:
+                    FN += 1
+                elif not metre_sign and sign:
+                    FP += 1
+            best_score = max(best_score, pow(0.1, FP) * pow(0.95, FN))
+        scores.append(best_score)
+    return scores
+
+
+class MeterEarlyStoppingProcessor(transformers.LogitsProcessor):
+    """
+    Разбирает каждую завершенную строку прямо во время генерации и оценивает ее по размерам.
+    Если для лучшего размера накопленная оценка стиха упала ниже min_score или строк стало больше
+    запрошенного max_lines, строка пакета завершается принудительным </s>, а ее номер запоминается
+    в dropped_rows, чтобы не тратить на нее время при ранжировании. По умолчанию число строк
+    не ограничивается: выравниватель принимает и 8-строчные, и 4n+1-строчные стихи.
+    """
+    def __init__(self, tokenizer, prompt_len, min_score=0.001, max_lines=None, nl_token_id=5, eos_token_id=2):
+        self.id2str = tokenizer.id2str
+        self.prompt_len = prompt_len
+        self.min_score = min_score
+        self.max_lines = max_lines
+        self.nl_token_id = nl_token_id
+        self.eos_token_id = eos_token_id
+
+        self.line_starts = dict()
+        self.meter_scores = dict()
+        self.line_counts = dict()
+        self.dropped_rows = set()
+        self.finished_rows = set()
+
+    def __call__(self, input_ids, scores):
+        cur_len = input_ids.shape[1]
+        last_tokens = input_ids[:, -1].tolist()
+        for row, last_token in enumerate(last_tokens):
+            if row in self.finished_rows:
+                continue
+
+            if last_token == self.eos_token_id:
+                self.finished_rows.add(row)
+                continue
+
+            if last_token != self.nl_token_id or cur_len <= self.prompt_len:
+                continue
+
+            line_start = self.line_starts.get(row, self.prompt_len)
+            self.line_starts[row] = cur_len
+            line_tokens = [self.id2str[token_id] for token_id in input_ids[row, line_start: cur_len - 1].tolist()]
+            if not line_tokens:
+                continue
+
+            self.line_counts[row] = self.line_counts.get(row, 0) + 1
+            hopeless = self.max_lines is not None and self.line_counts[row] > self.max_lines
+
+            signature = get_line_stress_signature(line_tokens)
+            if signature is not None:
+                line_scores = score_line_meters(signature)
+                row_scores = [s1 * s2 for s1, s2 in zip(self.meter_scores.get(row, [1.0] * len(line_scores)),
+                                                        line_scores)]
+                self.meter_scores[row] = row_scores
+                hopeless = hopeless or max(row_scores) < self.min_score
+
+            if hopeless:
+                scores[row, :] = -float('inf')
+                scores[row, self.eos_token_id] = 0.0
+                self.dropped_rows.add(row)
+                self.finished_rows.add(row)
+
+        return scores
+
+
+class LineCountStoppingCriteria(transformers.StoppingCriteria):
+    """
+    Останавливает строку пакета, как только она сгенерировала n_lines разделителей <nl> или </s>:
+    продолжение все равно будет отброшено при декодировании и выравнивании.
+    prompt_len - общая длина затравки с паддингом слева для всех строк пакета.
+    """
+    def __init__(self, prompt_len, n_lines, nl_token_id=5, eos_token_id=2):
+        self.prompt_len = prompt_len
+        self.n_lines = n_lines
+        self.nl_token_id = nl_token_id
+        self.eos_token_id = eos_token_id
+        self.stopped_rows = set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # При спекулятивном декодировании за шаг добавляется несколько токенов, поэтому </s> ищем по всей строке.
+        generated = input_ids[:, self.prompt_len:]
+        is_done = (generated == self.eos_token_id).any(dim=1) | \
+                  ((generated == self.nl_token_id).sum(dim=1) >= self.n_lines)
+        self.stopped_rows.update(row for row, done in enumerate(is_done.tolist()) if done)
+        return is_done
+
+    def build_for_row(self, row_prompt_len):
+        """Критерий для одиночной последовательности со своей длиной затравки без паддинга"""
+        return LineCountStoppingCriteria(row_prompt_len, self.n_lines, self.nl_token_id, self.eos_token_id)
+
+    def trim(self, token_ids):
+        """
+        Обрезает одну последовательность после n_lines-го разделителя <nl> или первого </s>: если за шаг
+        принимается несколько токенов, строка может уйти дальше места, где ее остановил бы критерий.
+        """
+        nb_lines = 0
+        for pos, token_id in enumerate(token_ids[self.prompt_len:].tolist()):
+            if token_id == self.nl_token_id:
+                nb_lines += 1
+            if token_id == self.eos_token_id or nb_lines >= self.n_lines:
+                return token_ids[:self.prompt_len + pos + 1]
+        return token_ids
+
+
+class FinishedRowsStreamer(transformers.StoppingCriteria):
+    """
+    Отдает каждую строку пакета в callback сразу после того, как она сгенерировала </s> (или была
+    остановлена другим критерием, записавшим ее в stopped_rows), не дожидаясь окончания всего пакета.
+    Установка stop_event прерывает генерацию для всех строк.
+    """
+    def __init__(self, callback, dropped_rows=None, stop_event=None, eos_token_id=2, stopped_rows=None):
+        self.callback = callback
+        self.dropped_rows = dropped_rows if dropped_rows is not None else set()
+        self.stop_event = stop_event
+        self.eos_token_id = eos_token_id
+        self.stopped_rows = stopped_rows if stopped_rows is not None else set()
+        self.reported_rows = set()
+
+    def report(self, row, token_ids):
+        self.reported_rows.add(row)
+        if row not in self.dropped_rows:
+            self.callback(row, token_ids)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for row, last_token in enumerate(input_ids[:, -1].tolist()):
+            if (last_token == self.eos_token_id or row in self.stopped_rows) and row not in self.reported_rows:
+                self.report(row, input_ids[row])
+
+        stop = self.stop_event is not None and self.stop_event.is_set()
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+    def flush(self, output_sequences):
+        """Строки, упершиеся в max_length без </s>, отдаются после окончания генерации"""
+        for row in range(output_sequences.shape[0]):
+            if row not in self.reported_rows:
+                self.report(row, output_sequences[row])
+
+
+class SpeculativeDecodingStats(object):
+    """
+    Статистика спекулятивного декодирования по счетчикам прогонов основной и черновой моделей.
+    Каждый прогон черновой модели предлагает один токен, каждый прогон основной модели проверяет
+    предложенные токены и добавляет один свой, поэтому принятые черновые токены - это
+    сгенерированные токены минус прогоны основной модели.
+    """
+    def __init__(self, model, draft_model):
+        self.nb_target_forwards = 0
+        self.nb_draft_forwards = 0
+        model.register_forward_hook(self.on_target_forward)
+        draft_model.register_forward_hook(self.on_draft_forward)
+
+        self.nb_sequences = 0
+        self.nb_tokens = 0
+        self.nb_proposed = 0
+        self.nb_accepted = 0
+        self.nb_verifications = 0
+        self.target0 = 0
+        self.draft0 = 0
+
+    def on_target_forward(self, module, inputs, output):
+        self.nb_target_forwards += 1
+
+    def on_draft_forward(self, module, inputs, output):
+        self.nb_draft_forwards += 1
+
+    def begin(self):
+        self.target0 = self.nb_target_forwards
+        self.draft0 = self.nb_draft_forwards
+
+    def end(self, nb_new_tokens):
+        nb_verifications = self.nb_target_forwards - self.target0
+        self.nb_sequences += 1
+        self.nb_tokens += nb_new_tokens
+        self.nb_verifications += nb_verifications
+        self.nb_proposed += self.nb_draft_forwards - self.draft0
+        self.nb_accepted += max(0, nb_new_tokens - nb_verifications)
+
+    def get_acceptance_rate(self):
+        return self.nb_accepted / float(self.nb_proposed) if self.nb_proposed else 0.0
+
+    def get_stats_str(self):
+        return 'speculative decoding: sequences={} tokens={} proposed={} accepted={} acceptance_rate={:.3f} ' \
+               'tokens_per_verification={:.2f}'.format(self.nb_sequences, self.nb_tokens, self.nb_proposed,
+                                                       self.nb_accepted, self.get_acceptance_rate(),
+                                                       self.nb_tokens / float(self.nb_verifications)
+                                                       if self.nb_verifications else 0.0)
@@ -0,0 +1,86 @@
+"""
+Динамическая int8-квантизация GPT2 для генерации на CPU.
+
+В GPT2 проекции внимания и MLP сделаны на transformers.pytorch_utils.Conv1D, который
+torch.quantization.quantize_dynamic не трогает, поэтому сначала они заменяются эквивалентными
+nn.Linear (веса Conv1D хранятся транспонированными). Квантованная модель целиком сохраняется
+на диск (по умолчанию рядом с исходной), и следующий запуск загружает ее без from_pretrained и повторной конвертации.
+Кэш привязан к версии torch и размеру/времени изменения файлов весов.
+"""
+
+import os
+import time
+import logging
+
+import torch
+import torch.nn
+import transformers
+from transformers.pytorch_utils import Conv1D
+
+
+QUANTIZED_CACHE_NAME = 'gpt2_dynamic_int8.pt'
+
+
+def conv1d_to_linear(conv):
+    nx, nf = conv.weight.shape
+    linear = torch.nn.Linear(nx, nf)
+    linear.weight.data = conv.weight.data.t().contiguous()
+    linear.bias.data = conv.bias.data.clone()
+    return linear
+
+
+def replace_conv1d(module):
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            setattr(module, name, conv1d_to_linear(child))
+        else:
+            replace_conv1d(child)
+
+
+def quantize_gpt2(model):
+    replace_conv1d(model)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def get_source_signature(model_dir):
+    """Строка, по которой определяется, что кэш построен по текущим весам текущей версией torch"""
+    items = ['torch=' + torch.__version__]
+    for filename in sorted(os.listdir(model_dir)):
+        if filename.endswith(('.bin', '.safetensors', 'config.json')):
+            st = os.stat(os.path.join(model_dir, filename))
+            items.append('{}:{}:{}'.format(filename, st.st_size, int(st.st_mtime)))
+    return '|'.join(items)
+
+
+def load_quantized_gpt2(model_dir, cache_path=None):
+    """Вернет квантованную GPT2LMHeadModel, при возможности - из дискового кэша"""
+    if cache_path is None:
+        cache_path = os.path.join(model_dir, QUANTIZED_CACHE_NAME)
+    signature = get_source_signature(model_dir)
+
+    if os.path.exists(cache_path):
+        try:
+            t0 = time.time()
+            cached = torch.load(cache_path, map_location='cpu', weights_only=False)
+            if cached.get('signature') == signature:
+                logging.info('Quantized model loaded from "%s" in %.1f sec', cache_path, time.time() - t0)
+                return cached['model']
+            logging.info('Quantized model cache "%s" is stale, rebuilding', cache_path)
+        except Exception as ex:
+            logging.warning('Could not load quantized model cache "%s": %s', cache_path, ex)
+
+    t0 = time.time()
+    model = transformers.GPT2LMHeadModel.from_pretrained(model_dir)
+    model.eval()
+    model = quantize_gpt2(model)
+    logging.info('GPT2 quantized to int8 in %.1f sec', time.time() - t0)
+
+    try:
+        tmp_path = cache_path + '.tmp'
+        torch.save({'signature': signature, 'model': model}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logging.info('Quantized model stored in "%s"', cache_path)
+    except Exception as ex:
+        logging.warning('Could not store quantized model in "%s": %s', cache_path, ex)
+
+    return model
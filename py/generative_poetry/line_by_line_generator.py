@@ -0,0 +1,197 @@
+"""
+Построчная генерация четверостиший с откатом по кэшу трансформера.
+
+Обычно вариант из generate_poems отбраковывается из-за одной неудачной строки, например из-за
+сломанной рифмы в последней строке, и тогда весь вариант генерируется заново. Здесь стих
+декодируется по одной строке: на каждой границе <nl> запоминается длина DynamicCache и логиты
+следующего шага, готовая строка сразу проверяется выравнивателем на размер и на возможность
+рифмовки с предыдущими строками, а при неудаче обрезанный до границы кэш используется для
+повторной генерации только этой строки.
+"""
+
+import logging
+
+import torch
+import transformers
+
+from generative_poetry.poetry_alignment import PoetryLine, MetreMappingBatch, meters
+from generative_poetry.generation_hooks import build_sampling_warpers
+
+
+# Какие пары строк должны рифмоваться в каждой схеме, по номеру последней строки пары.
+RHYME_SCHEME_PAIRS = {'ABAB': {2: [(0, 2)], 3: [(1, 3)]},
+                      'AABB': {1: [(0, 1)], 3: [(2, 3)]},
+                      'ABBA': {2: [(1, 2)], 3: [(0, 3)]}}
+
+
+class GeneratedLine(object):
+    def __init__(self, text, meter_scores, rhyming_tails):
+        self.text = text
+        # оценки строки для каждого метра из poetry_alignment.meters
+        self.meter_scores = meter_scores
+        self.rhyming_tails = rhyming_tails
+
+
+class LineByLineGenerator(object):
+    def __init__(self, poem_generator, aligner, decode_line_fn, n_lines=4, max_line_attempts=5, max_line_tokens=48,
+                 min_meter_score=0.01):
+        self.poem_generator = poem_generator
+        self.aligner = aligner
+        # декодер арабизованной строки в обычный текст (long_poem_generator2.decode_line2)
+        self.decode_line_fn = decode_line_fn
+        self.n_lines = n_lines
+        self.max_line_attempts = max_line_attempts
+        self.max_line_tokens = max_line_tokens
+        self.min_meter_score = min_meter_score
+
+        self.nl_token_id = 5
+        self.eos_token_id = 2
+
+        # статистика для бенчмарка
+        self.nb_decoded_tokens = 0
+        self.nb_line_attempts = 0
+        self.nb_line_rejections = 0
+
+    def score_line(self, text):
+        """Разметка строки выравнивателем: лучшие оценки по каждому метру и возможные рифмующиеся окончания"""
+        pline = PoetryLine.build(text, self.aligner.udpipe, self.aligner.accentuator)
+        if sum((pword.n_vowels > 1) for pword in pline.pwords) >= 8:
+            return None
+
+        slines = pline.get_stress_variants(self.aligner)
+        meter_scores = []
+        rhyming_tails = []
+        tail_keys = set()
+        for sline in slines:
+            tail = sline.get_rhyming_tail()
+            if tail.is_ok() and tail.__repr__() not in tail_keys:
+                tail_keys.add(tail.__repr__())
+                rhyming_tails.append(tail)
+
+        mapping_batch = MetreMappingBatch(slines, [metre_signature for _, metre_signature in meters], self.aligner)
+        for prefix_scores in mapping_batch.scores:
+            meter_scores.append(max([0.0] + prefix_scores[0] + prefix_scores[1]))
+
+        return GeneratedLine(text, meter_scores, rhyming_tails)
+
+    def lines_rhyme(self, line1, line2):
+        return any(self.aligner.check_rhyming(tail1, tail2)
+                   for tail1 in line1.rhyming_tails for tail2 in line2.rhyming_tails)
+
+    def check_line(self, lines, new_line, meter_scores, schemes):
+        """
+        Проверка очередной строки. Вернет (накопленные оценки метров, оставшиеся схемы рифмовки)
+        или None, если строку надо перегенерировать.
+        """
+        new_meter_scores = [s1 * s2 for s1, s2 in zip(meter_scores, new_line.meter_scores)]
+        if max(new_meter_scores) < self.min_meter_score:
+            return None
+
+        iline = len(lines)
+        all_lines = lines + [new_line]
+        new_schemes = [scheme for scheme in schemes
+                       if all(self.lines_rhyme(all_lines[i1], all_lines[i2])
+                              for i1, i2 in RHYME_SCHEME_PAIRS[scheme].get(iline, []))]
+        if not new_schemes:
+            return None
+
+        return new_meter_scores, new_schemes
+
+    def forward(self, token_id, past):
+        input_ids = torch.tensor([[token_id]], dtype=torch.long, device=self.poem_generator.device)
+        # Блокируется только сам прогон модели: кэш past принадлежит этому стиху, а разбор и оценка
+        # строк не мешают другим потокам генерации.
+        with self.poem_generator.generate_lock:
+            output = self.poem_generator.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+        self.nb_decoded_tokens += 1
+        return output.logits[:, -1, :]
+
+    def sample_line(self, generated_ids, logits, past, warpers):
+        """
+        Сэмплирует токены до <nl> или </s>. Вернет токены строки без разделителя, признак </s>
+        и логиты для следующего шага. Если за max_line_tokens токенов строка не закончилась, вместо
+        токенов вернет None: кэш и логиты тогда стоят посреди строки, и такую строку надо отбросить.
+        """
+        line_ids = []
+        for _ in range(self.max_line_tokens):
+            scores = logits
+            input_ids = torch.tensor([generated_ids + line_ids], dtype=torch.long, device=self.poem_generator.device)
+            for warper in warpers:
+                scores = warper(input_ids, scores)
+            token_id = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).item()
+
+            if token_id == self.eos_token_id:
+                return line_ids, True, logits
+
+            logits = self.forward(token_id, past)
+            if token_id == self.nl_token_id:
+                return line_ids, False, logits
+            line_ids.append(token_id)
+
+        return None, False, logits
+
+    def decode_line(self, line_ids):
+        return self.decode_line_fn(self.poem_generator.tokenizer.decode(line_ids, clean_up_tokenization_spaces=True))
+
+    def generate_poem(self, seed, temperature=1.0, top_k=30, top_p=0.5, typical_p=1.0):
+        """
+        Генерация одного четверостишия. Вернет список строк или None, если какую-то строку
+        не удалось подобрать за max_line_attempts попыток.
+        """
+        tokenizer = self.poem_generator.tokenizer
+        device = self.poem_generator.device
+        prompt_ids = tokenizer.encode("<s> " + seed + ' $', add_special_tokens=False)
+        warpers = build_sampling_warpers(torch.tensor([temperature], dtype=torch.float32, device=device),
+                                         top_k, top_p, typical_p)
+
+        with torch.no_grad():
+            past = transformers.DynamicCache()
+            with self.poem_generator.generate_lock:
+                output = self.poem_generator.model(input_ids=torch.tensor([prompt_ids], dtype=torch.long,
+                                                                          device=device),
+                                                   past_key_values=past, use_cache=True)
+            logits = output.logits[:, -1, :]
+
+            generated_ids = list(prompt_ids)
+            lines = []
+            meter_scores = [1.0] * len(meters)
+            schemes = list(RHYME_SCHEME_PAIRS.keys())
+            while len(lines) < self.n_lines:
+                # Граница строки: сюда откатываемся при неудачной попытке.
+                cache_len = past.get_seq_length()
+                line_logits = logits
+
+                accepted = None
+                for _ in range(self.max_line_attempts):
+                    self.nb_line_attempts += 1
+                    line_ids, eos, logits = self.sample_line(generated_ids, line_logits, past, warpers)
+
+                    new_line = None
+                    # обрезанная по max_line_tokens строка (line_ids=None) отклоняется вместе с пустой
+                    text = self.decode_line(line_ids) if line_ids else ''
+                    if text and not (eos and len(lines) + 1 < self.n_lines):
+                        try:
+                            new_line = self.score_line(text)
+                        except Exception as ex:
+                            logging.debug('Line "%s" scoring failed: %s', text, ex)
+
+                    if new_line is not None:
+                        accepted = self.check_line(lines, new_line, meter_scores, schemes)
+                        if accepted is not None:
+                            break
+
+                    self.nb_line_rejections += 1
+                    past.crop(cache_len)
+
+                if accepted is None:
+                    return None
+
+                meter_scores, schemes = accepted
+                lines.append(new_line)
+                generated_ids.extend(line_ids + [self.nl_token_id])
+
+        return [line.text for line in lines]
+
+    def get_stats_str(self):
+        return 'line-by-line: decoded_tokens={} line_attempts={} line_rejections={}'.format(
+            self.nb_decoded_tokens, self.nb_line_attempts, self.nb_line_rejections)
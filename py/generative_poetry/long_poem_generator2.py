@@ -1,6 +1,10 @@
 import os
+import re
 import json
+import time
+import queue
 import logging
+import threading
 import torch
 import torch.nn
 import transformers
@@ -13,14 +17,18 @@ from generative_poetry.whitespace_normalization import normalize_whitespaces
 from poetry.phonetic import Accents
 from generative_poetry.udpipe_parser import UdpipeParser
 from generative_poetry.poetry_alignment import PoetryStressAligner
+from generative_poetry.generation_batcher import GenerationBatcher
+from generative_poetry.prompt_cache import PromptCache
+from generative_poetry.line_by_line_generator import LineByLineGenerator
+from generative_poetry.gpt_quantization import load_quantized_gpt2
+from generative_poetry.poem_length_stats import PoemLengthStats, is_supported_line_count
+from generative_poetry.generation_hooks import build_sampling_warpers, make_row_temperatures, MeterEarlyStoppingProcessor, \
+    FinishedRowsStreamer, SpeculativeDecodingStats, LineCountStoppingCriteria
 
 
 upper_cyr = 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ'
 
 
-logits_booster = None
-
-
 def decode_line2(line0, remove_stress_marks=True):
     out_words = []
 
@@ -44,8 +52,22 @@ class RugptGenerator:
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.tokenizer = None
         self.model = None
-
-    def load(self, model_dir):
+        self.prompt_cache = None
+        self.meter_min_score = None
+        self.meter_max_lines = None
+        # model.generate могут вызывать одновременно пакетировщик запросов и потоки потоковой генерации
+        self.generate_lock = threading.Lock()
+        # сколько позиций декодировано во всех вызовах generate, включая уже завершенные строки пакета
+        self.nb_decoded_tokens = 0
+        self.draft_model = None
+        self.speculative_stats = None
+        # сколько вариантов сгенерировано всего и сколько из них - с черновой моделью
+        self.nb_generated_rows = 0
+        self.nb_assisted_rows = 0
+        # длины строк принятых стихов, по ним выбирается бюджет токенов под запрошенное число строк
+        self.length_stats = PoemLengthStats()
+
+    def load_tokenizer(self, model_dir):
         with open(os.path.join(model_dir, 'tokenizer_config.json'), 'r') as f:
             config = json.load(f)
             tokenizer_class = config['tokenizer_class']
@@ -56,47 +78,262 @@ class RugptGenerator:
             else:
                 raise NotImplementedError()
 
-        self.model = transformers.GPT2LMHeadModel.from_pretrained(model_dir)
+    def load(self, model_dir, quantize=False, quantized_cache_path=None):
+        """
+        quantize=True включает динамическую int8-квантизацию линейных слоев (только для CPU),
+        квантованные веса кэшируются на диске, см. gpt_quantization.py
+        """
+        self.load_tokenizer(model_dir)
+
+        if quantize and self.device.type != 'cpu':
+            logging.warning('Int8 quantization is supported for CPU inference only, ignored')
+            quantize = False
+
+        if quantize:
+            self.model = load_quantized_gpt2(model_dir, quantized_cache_path)
+        else:
+            self.model = transformers.GPT2LMHeadModel.from_pretrained(model_dir)
 
         self.model.tokenizer = self.tokenizer  # он нам понадобится внутри нашей версии sample()
         self.model.to(self.device)
         self.model.eval()
 
+    def load_draft_model(self, draft_model_dir, num_assistant_tokens=5):
+        """
+        Маленькая модель с тем же словарем StressedGptTokenizer для спекулятивного декодирования:
+        черновая модель предлагает несколько слогов, основная проверяет их за один прогон.
+        """
+        draft_tokenizer = StressedGptTokenizer.from_pretrained(draft_model_dir)
+        if getattr(draft_tokenizer, 'id2str', None) != getattr(self.tokenizer, 'id2str', None):
+            raise RuntimeError('Draft model "{}" has a different vocabulary'.format(draft_model_dir))
+
+        self.draft_model = transformers.GPT2LMHeadModel.from_pretrained(draft_model_dir)
+        self.draft_model.to(self.device)
+        self.draft_model.eval()
+        self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        self.speculative_stats = SpeculativeDecodingStats(self.model, self.draft_model)
+        logging.info('Draft model loaded from "%s": num_assistant_tokens=%d', draft_model_dir, num_assistant_tokens)
+
+    def enable_meter_early_stopping(self, min_score, max_lines=None):
+        # Ранняя остановка вариантов, которые уже не укладываются в размер (см. MeterEarlyStoppingProcessor).
+        # Если в запросе задано число строк n_lines, то ограничением служит оно.
+        if not hasattr(self.tokenizer, 'id2str'):
+            logging.warning('Meter early stopping requires StressedGptTokenizer, ignored')
+            return
+        self.meter_min_score = min_score
+        self.meter_max_lines = max_lines
+        logging.info('Meter early stopping enabled: min_score=%g max_lines=%s', min_score, max_lines)
+
+    def enable_prompt_cache(self, max_size_mb):
+        self.prompt_cache = PromptCache(self.model, max_size_mb)
+        logging.info('Prompt cache enabled: max_size=%dMB', max_size_mb)
+
     def generate_output(self, context, num_return_sequences=10, temperature=1.0, top_k=30, top_p=0.40,
                         penalty_alpha=0.0, typical_p=1.0, repetition_penalty=1.0, no_repeat_ngram_size=0,
-                        positive_words=None, negative_words=None, max_len=256):
-        global logits_booster
-
-        prompt_text = "<s> " + context + ' $'
-        stop_token = "</s>"
-
-        encoded_prompt = self.tokenizer.encode(prompt_text, add_special_tokens=False, return_tensors="pt")
-        encoded_prompt = encoded_prompt.to(self.device)
+                        positive_words=None, negative_words=None, max_len=256, n_lines=None, row_callback=None,
+                        stop_event=None):
+        """row_callback(text) - потоковая выдача вариантов, см. generate_output_batch"""
+        batch_callback = None
+        if row_callback is not None:
+            batch_callback = lambda icontext, text: row_callback(text)
+
+        return self.generate_output_batch([context], num_return_sequences=num_return_sequences,
+                                          temperature=temperature, top_k=top_k, top_p=top_p,
+                                          penalty_alpha=penalty_alpha, typical_p=typical_p,
+                                          repetition_penalty=repetition_penalty,
+                                          no_repeat_ngram_size=no_repeat_ngram_size, max_len=max_len,
+                                          n_lines=n_lines, row_callback=batch_callback, stop_event=stop_event)[0]
+
+    def generate_output_batch(self, contexts, num_return_sequences=10, temperature=1.0, top_k=30, top_p=0.40,
+                              penalty_alpha=0.0, typical_p=1.0, repetition_penalty=1.0, no_repeat_ngram_size=0,
+                              positive_words=None, negative_words=None, max_len=256, row_callback=None, stop_event=None,
+                              n_lines=None):
+        """
+        Генерация для нескольких затравок одним вызовом generate. Затравки выравниваются паддингом слева,
+        вернет список результатов в порядке затравок.
+        Если temperature задана списком, то для каждой температуры из расписания генерируется
+        num_return_sequences вариантов, и все они сэмплируются за один проход.
+        Если задан row_callback(номер затравки, текст), то каждый вариант передается в него сразу после
+        завершения, а установка stop_event досрочно прекращает генерацию.
+        Если задано число строк n_lines, то max_len берется из статистики длин принятых стихов,
+        а каждая строка пакета останавливается после n_lines разделителей <nl> или </s>.
+        """
+        full_max_len = max_len
+        if n_lines is not None:
+            if not is_supported_line_count(n_lines):
+                raise ValueError('Unsupported number of lines n_lines={}, expected 1, 2, 4 or 4k+1'.format(n_lines))
+            max_len = min(max_len, self.length_stats.get_token_budget(n_lines))
+
+        encoded_prompts = [self.tokenizer.encode("<s> " + context + ' $', add_special_tokens=False)
+                           for context in contexts]
+        prompt_len = max(len(ids) for ids in encoded_prompts)
+        input_ids = torch.tensor([[0] * (prompt_len - len(ids)) + ids for ids in encoded_prompts],
+                                 dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor([[0] * (prompt_len - len(ids)) + [1] * len(ids) for ids in encoded_prompts],
+                                      dtype=torch.long, device=self.device)
+
+        # Спекулятивное декодирование в transformers идет по одной последовательности и проверяет
+        # сразу несколько токенов, поэтому несовместимо с построчными хуками, завязанными на номер строки
+        # пакета и на пошаговую генерацию (расписание температур, ранняя остановка, потоковая выдача).
+        use_draft = self.draft_model is not None and row_callback is None and not isinstance(temperature, (list, tuple))
+
+        logits_processor = transformers.LogitsProcessorList()
+        if isinstance(temperature, (list, tuple)):
+            # Температура для каждой строки своя, поэтому всю цепочку сэмплирования собираем сами,
+            # а встроенные варперы generate отключаем.
+            row_temperatures = make_row_temperatures(temperature, len(contexts), num_return_sequences, self.device)
+            logits_processor.extend(build_sampling_warpers(row_temperatures, top_k, top_p, typical_p))
+            num_return_sequences = num_return_sequences * len(temperature)
+            temperature, top_k, top_p, typical_p = 1.0, 0, 1.0, 1.0
+
+        meter_processor = None
+        if self.meter_min_score is not None and not use_draft:
+            max_lines = n_lines if n_lines is not None else self.meter_max_lines
+            meter_processor = MeterEarlyStoppingProcessor(self.tokenizer, prompt_len, min_score=self.meter_min_score,
+                                                          max_lines=max_lines)
+            logits_processor.append(meter_processor)
+
+        # Для одиночной затравки берем закэшированные состояния трансформера
+        past_key_values = None
+        if self.prompt_cache is not None and len(contexts) == 1 and not use_draft:
+            past_key_values = self.prompt_cache.get_past(input_ids, num_return_sequences)
+
+        stopping_criteria = transformers.StoppingCriteriaList()
+        line_count_criteria = None
+        if n_lines is not None:
+            line_count_criteria = LineCountStoppingCriteria(prompt_len, n_lines)
+            stopping_criteria.append(line_count_criteria)
+
+        streamer = None
+        if row_callback is not None:
+            nrs = num_return_sequences
+
+            def on_finished_row(row, token_ids):
+                for text in self.decode_generated([token_ids], prompt_len):
+                    row_callback(row // nrs, text)
+
+            streamer = FinishedRowsStreamer(on_finished_row,
+                                            dropped_rows=meter_processor.dropped_rows if meter_processor else None,
+                                            stop_event=stop_event,
+                                            stopped_rows=line_count_criteria.stopped_rows if line_count_criteria else None)
+            stopping_criteria.append(streamer)
 
         do_sample = True
 
-        output_sequences = self.model.generate(
-            input_ids=encoded_prompt,
-            max_length=max_len,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-            repetition_penalty=repetition_penalty,
-            typical_p=typical_p,
-            #penalty_alpha=penalty_alpha,
-            no_repeat_ngram_size=no_repeat_ngram_size,
-            num_return_sequences=num_return_sequences,
-            pad_token_id=0,
-        )
-
-        # Remove the batch dimension when returning multiple sequences
-        if len(output_sequences.shape) > 2:
-            output_sequences.squeeze_()
+        gen_kwargs = dict()
+        if use_draft:
+            gen_kwargs['assistant_model'] = self.draft_model
+
+        t0 = time.time()
+        with self.generate_lock:
+            output_sequences = self.generate_sequences(**gen_kwargs,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_length=max_len + prompt_len - min(len(ids) for ids in encoded_prompts),
+                do_sample=do_sample,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                typical_p=typical_p,
+                #penalty_alpha=penalty_alpha,
+                no_repeat_ngram_size=no_repeat_ngram_size,
+                num_return_sequences=num_return_sequences,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                pad_token_id=0,
+            )
+            self.nb_decoded_tokens += output_sequences.shape[0] * (output_sequences.shape[1] - prompt_len)
+            self.nb_generated_rows += output_sequences.shape[0]
+            if use_draft:
+                self.nb_assisted_rows += output_sequences.shape[0]
+        elapsed = time.time() - t0
+
+        nb_steps = output_sequences.shape[1] - prompt_len
+        if n_lines is not None and nb_steps > 0:
+            # Без бюджета и остановки по строкам generate прошел бы все full_max_len шагов.
+            logging.info('Generated %d steps for %d-line poems (budget=%d, default max_len=%d) in %.2f sec, '
+                         'saved ~%.2f sec', nb_steps, n_lines, max_len, full_max_len, elapsed,
+                         elapsed / nb_steps * max(0, full_max_len - nb_steps))
+
+        if streamer is not None:
+            streamer.flush(output_sequences)
+
+        dropped_rows = set()
+        if meter_processor is not None:
+            dropped_rows = meter_processor.dropped_rows
+            logging.debug('Meter early stopping dropped %d of %d sequences', len(dropped_rows),
+                          output_sequences.shape[0])
+
+        # generate возвращает num_return_sequences строк подряд для каждой затравки
+        outputs = []
+        for icontext in range(len(contexts)):
+            row_indices = range(icontext * num_return_sequences, (icontext + 1) * num_return_sequences)
+            rows = [output_sequences[irow] for irow in row_indices if irow not in dropped_rows]
+            outputs.append(self.decode_generated(rows, prompt_len))
+        return outputs
+
+    def generate_sequences(self, assistant_model=None, **gen_kwargs):
+        if assistant_model is None:
+            return self.model.generate(**gen_kwargs)
+
+        # Вспомогательное декодирование поддерживает только пакет из одной последовательности.
+        input_ids = gen_kwargs.pop('input_ids')
+        attention_mask = gen_kwargs.pop('attention_mask')
+        num_return_sequences = gen_kwargs.pop('num_return_sequences')
+        gen_kwargs.pop('past_key_values', None)
+
+        # Остановка по числу строк считает токены от конца затравки, а у каждой строки без паддинга
+        # своя длина затравки, поэтому критерий создается заново для каждой последовательности.
+        stopping_criteria = gen_kwargs.pop('stopping_criteria', None) or transformers.StoppingCriteriaList()
+        line_count_criteria = None
+        other_criteria = transformers.StoppingCriteriaList()
+        for criteria in stopping_criteria:
+            if isinstance(criteria, LineCountStoppingCriteria):
+                line_count_criteria = criteria
+            else:
+                other_criteria.append(criteria)
+
+        rows = []
+        for irow in range(input_ids.shape[0]):
+            # паддинг слева для одиночной затравки не нужен
+            row_mask = attention_mask[irow].bool()
+            row_ids = input_ids[irow][row_mask].unsqueeze(0)
+            nb_pad = input_ids.shape[1] - row_ids.shape[1]
+            for _ in range(num_return_sequences):
+                row_criteria = transformers.StoppingCriteriaList(other_criteria)
+                row_line_count = None
+                if line_count_criteria is not None:
+                    row_line_count = line_count_criteria.build_for_row(row_ids.shape[1])
+                    row_criteria.append(row_line_count)
+
+                self.speculative_stats.begin()
+                output = self.model.generate(input_ids=row_ids, attention_mask=torch.ones_like(row_ids),
+                                             assistant_model=assistant_model, num_return_sequences=1,
+                                             stopping_criteria=row_criteria,
+                                             **dict(gen_kwargs, max_length=gen_kwargs['max_length'] - nb_pad))
+                self.speculative_stats.end(output.shape[1] - row_ids.shape[1])
+
+                row = output[0]
+                if row_line_count is not None:
+                    # принятые за один шаг черновые токены могли уйти дальше n-го разделителя
+                    row = row_line_count.trim(row)
+                    if row_line_count.stopped_rows:
+                        line_count_criteria.stopped_rows.add(len(rows))
+                rows.append(torch.cat([input_ids[irow, :nb_pad], row]))
+
+        # дополняем справа до общей длины, как это делает generate для завершившихся строк
+        max_len = max(row.shape[0] for row in rows)
+        return torch.stack([torch.cat([row, row.new_full((max_len - row.shape[0],), gen_kwargs['pad_token_id'])])
+                            for row in rows])
+
+    def decode_generated(self, output_sequences, prompt_len):
+        stop_token = "</s>"
 
         generated_sequences = set()
         for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
-            generated_sequence = generated_sequence.tolist()[encoded_prompt.shape[1]:]
+            generated_sequence = generated_sequence.tolist()[prompt_len:]
 
             # Decode text
             text = self.tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
@@ -117,54 +354,122 @@ class LongPoemGeneratorCore2(object):
         self.parser = None
         self.accents = None
         self.aligner = None
-
-    def load(self, models_dir, data_dir, tmp_dir):
-        self.poem_generator = RugptGenerator()
-        self.poem_generator.load(os.path.join(models_dir, self.gpt_name))
+        self.batcher = None
+        self.line_generator = None
+        self.length_stats_path = None
+
+    def load(self, models_dir, data_dir, tmp_dir, stress_backend='auto', quantize=False, gpt_backend='torch',
+             draft_gpt_name=None):
+        """
+        gpt_backend='onnx' - генерация через ONNX Runtime на CPU, см. onnx_generator.py
+        draft_gpt_name - маленькая модель для спекулятивного декодирования, см. RugptGenerator.load_draft_model
+        """
+        if gpt_backend == 'onnx':
+            from generative_poetry.onnx_generator import OnnxRugptGenerator
+            self.poem_generator = OnnxRugptGenerator()
+            self.poem_generator.load(os.path.join(models_dir, self.gpt_name),
+                                     onnx_path=os.path.join(tmp_dir, self.gpt_name + '.onnx'))
+        else:
+            self.poem_generator = RugptGenerator()
+            self.poem_generator.load(os.path.join(models_dir, self.gpt_name), quantize=quantize,
+                                     quantized_cache_path=os.path.join(tmp_dir, self.gpt_name + '.int8.pt') if quantize else None)
+            if draft_gpt_name:
+                self.poem_generator.load_draft_model(os.path.join(models_dir, draft_gpt_name))
 
         self.parser = UdpipeParser()
         self.parser.load(models_dir)
 
         self.accents = Accents()
-        self.accents.load_pickle(os.path.join(tmp_dir, 'accents.pkl'))
-        self.accents.after_loading(stress_model_dir=os.path.join(tmp_dir, 'stress_model'))
+        # Компактный формат из accents_mmap.py загружается мгновенно и разделяется между процессами.
+        mmap_path = os.path.join(tmp_dir, 'accents.mmap')
+        if os.path.exists(mmap_path):
+            self.accents.load_mmap(mmap_path)
+        else:
+            self.accents.load_pickle(os.path.join(tmp_dir, 'accents.pkl'))
+        precomputed_path = os.path.join(tmp_dir, 'precomputed_accents.pkl')
+        if os.path.exists(precomputed_path):
+            self.accents.load_precomputed_accents(precomputed_path)
+        self.accents.after_loading(stress_model_dir=os.path.join(tmp_dir, 'stress_model'), stress_backend=stress_backend,
+                                   predicted_accents_db=os.path.join(tmp_dir, 'predicted_accents.sqlite'))
 
         self.aligner = PoetryStressAligner(self.parser, self.accents, os.path.join(data_dir, 'poetry', 'dict'))
-
-    def generate_poems(self, topic, genre=None, emotion_token=None, num_return_sequences=10, temperature=1.0, top_p=0.5, top_k=30,
-                       score_threshold=0.20, penalty_alpha=0.0, typical_p=1.0, repetition_penalty=1.0, no_repeat_ngram_size=0):
+        self.length_stats_path = os.path.join(tmp_dir, 'poem_length_stats.json')
         try:
-            if genre:
-                seed = arabize(break_to_syllables(self.parser, self.accents, genre + ' , ' + topic))
-            elif emotion_token is not None:
-                seed = arabize(break_to_syllables(self.parser, self.accents, topic))
-                if emotion_token:
-                    seed += ' ' + emotion_token
-            elif genre is None and topic is not None:
-                seed = arabize(break_to_syllables(self.parser, self.accents, topic))
-            else:
-                raise NotImplementedError()
-
-            poems = self.poem_generator.generate_output(seed,
-                                                        num_return_sequences=num_return_sequences,
-                                                        temperature=temperature,
-                                                        top_p=top_p,
-                                                        top_k=top_k,
-                                                        penalty_alpha=penalty_alpha,
-                                                        typical_p=typical_p,
-                                                        repetition_penalty=repetition_penalty,
-                                                        no_repeat_ngram_size=no_repeat_ngram_size,
-                                                        )
+            self.poem_generator.length_stats.load(self.length_stats_path)
         except Exception as ex:
-            logging.error(ex)
-            return []
+            logging.error('Could not load poem length stats: %s', ex)
+
+        if self.poem_generator.model is not None:
+            # построчная генерация работает с DynamicCache модели PyTorch
+            self.line_generator = LineByLineGenerator(self.poem_generator, self.aligner, decode_line2)
+
+    def enable_batching(self, max_batch_size, max_wait):
+        # Запросы из разных потоков будут объединяться в общие вызовы generate
+        self.batcher = GenerationBatcher(self.poem_generator, max_batch_size=max_batch_size, max_wait=max_wait)
+        logging.info('Generation batching enabled: max_batch_size=%d max_wait=%.3f', max_batch_size, max_wait)
+
+    def build_seed(self, topic, genre=None, emotion_token=None):
+        if genre:
+            seed = arabize(break_to_syllables(self.parser, self.accents, genre + ' , ' + topic))
+        elif emotion_token is not None:
+            seed = arabize(break_to_syllables(self.parser, self.accents, topic))
+            if emotion_token:
+                seed += ' ' + emotion_token
+        elif genre is None and topic is not None:
+            seed = arabize(break_to_syllables(self.parser, self.accents, topic))
+        else:
+            raise NotImplementedError()
+
+        return seed
 
+    def generate_texts(self, seed, **gen_params):
+        if self.batcher is not None:
+            return self.batcher.generate_output(seed, **gen_params)
+        else:
+            return self.poem_generator.generate_output(seed, **gen_params)
+
+    def rank_poems(self, poems, score_threshold, use_markup=False):
+        """
+        use_markup=True - строки декодируются вместе с отметками ударений, которые расставила модель,
+        и выравниватель размечает их по этим отметкам без синтаксического разбора.
+        """
+        raw_poems = [[line for line in poem.split('<nl>') if len(line) > 0] for poem in poems]
+        decoded_poems = [[decode_line2(line, remove_stress_marks=not use_markup) for line in lines] for lines in raw_poems]
+        accepted_indices = []
+        ranked_poems = self.rank_lines(decoded_poems, score_threshold, accepted_indices, use_markup=use_markup)
+
+        # Длины строк принятых стихов в токенах пополняют статистику для бюджета генерации.
+        tokenizer = self.poem_generator.tokenizer
+        for ipoem in accepted_indices:
+            self.poem_generator.length_stats.add_poem([len(tokenizer.tokenize(line.strip())) for line in raw_poems[ipoem]])
+        if self.length_stats_path and self.poem_generator.length_stats.nb_unsaved >= 100:
+            try:
+                self.poem_generator.length_stats.save(self.length_stats_path)
+            except Exception as ex:
+                logging.error(ex)
+
+        return ranked_poems
+
+    def rank_lines(self, decoded_poems, score_threshold, accepted_indices=None, use_markup=False):
+        """В accepted_indices, если задан, добавляются номера принятых стихов из decoded_poems"""
         threshold_score = 0.1
         ranked_poems = []
-        for ipoem, poem in enumerate(poems):
-            lines = [decode_line2(line) for line in poem.split('<nl>') if len(line) > 0]
+
+        # Ударения для всех несловарных слов во всех вариантах определяем одним вызовом нейросетевой модели,
+        # дальше при выравнивании они будут браться из кэша. При разметке по отметкам модели словарь
+        # нужен только для отдельных слов, их проще разметить по одному.
+        if not use_markup:
+            try:
+                self.accents.get_accents_batch([word for lines in decoded_poems for line in lines
+                                                for word in re.findall(r'[а-яё]+', line.lower())])
+            except Exception as ex:
+                logging.error(ex)
+
+        for ipoem, lines in enumerate(decoded_poems):
             try:
-                a = self.aligner.align(lines, check_rhymes=True)
+                a = self.aligner.align(lines, check_rhymes=True, use_markup=use_markup)
+                if use_markup:
+                    lines = [line.replace('\u0301', '') for line in lines]
                 if a is not None and a.score >= threshold_score:
                     score = a.score
 
@@ -183,9 +488,156 @@ class LongPoemGeneratorCore2(object):
 
                     if score > score_threshold:
                         ranked_poems.append((lines, score))
+                        if accepted_indices is not None:
+                            accepted_indices.append(ipoem)
             except Exception as ex:
                 logging.error(ex)
                 continue
 
+        logging.debug(self.accents.predicted_accents.get_stats_str())
+        logging.debug(self.accents.accent_memo.get_stats_str())
+        logging.debug(self.aligner.get_search_stats_str())
+        logging.debug(self.aligner.rhyme_cache.get_stats_str())
+        if use_markup:
+            logging.debug(self.aligner.get_markup_stats_str())
+        if self.poem_generator.prompt_cache is not None:
+            logging.debug(self.poem_generator.prompt_cache.get_stats_str())
+        if self.poem_generator.speculative_stats is not None:
+            logging.debug(self.poem_generator.speculative_stats.get_stats_str())
+            logging.debug('assisted rows: %d of %d', self.poem_generator.nb_assisted_rows,
+                          self.poem_generator.nb_generated_rows)
+
         ranked_poems = sorted(ranked_poems, key=lambda z: -z[1])
         return ranked_poems
+
+    def generate_poems(self, topic, genre=None, emotion_token=None, num_return_sequences=10, temperature=1.0, top_p=0.5, top_k=30,
+                       score_threshold=0.20, penalty_alpha=0.0, typical_p=1.0, repetition_penalty=1.0, no_repeat_ngram_size=0,
+                       n_lines=None, use_markup=False):
+        """
+        temperature может быть списком температур: тогда num_return_sequences вариантов генерируется
+        для каждой температуры за один проход, и ранжируется объединение всех вариантов.
+        n_lines - требуемое число строк (1, 2, 4 или 4k+1), задает бюджет и остановку генерации.
+        use_markup - выравнивание по отметкам ударений самой модели, см. rank_poems.
+        """
+        try:
+            seed = self.build_seed(topic, genre, emotion_token)
+            poems = self.generate_texts(seed,
+                                        num_return_sequences=num_return_sequences,
+                                        temperature=temperature,
+                                        top_p=top_p,
+                                        top_k=top_k,
+                                        penalty_alpha=penalty_alpha,
+                                        typical_p=typical_p,
+                                        repetition_penalty=repetition_penalty,
+                                        no_repeat_ngram_size=no_repeat_ngram_size,
+                                        n_lines=n_lines,
+                                        )
+        except Exception as ex:
+            logging.error(ex)
+            return []
+
+        return self.rank_poems(poems, score_threshold, use_markup=use_markup)
+
+    def generate_poems_line_by_line(self, topic, genre=None, emotion_token=None, num_poems=3, temperature=1.0,
+                                    top_p=0.5, top_k=30, score_threshold=0.20, typical_p=1.0):
+        """
+        Четверостишия генерируются построчно с проверкой каждой строки (см. LineByLineGenerator),
+        собранные стихи ранжируются так же, как в generate_poems.
+        """
+        if self.line_generator is None:
+            logging.error('Line-by-line generation is not available for this GPT backend')
+            return []
+
+        try:
+            seed = self.build_seed(topic, genre, emotion_token)
+        except Exception as ex:
+            logging.error(ex)
+            return []
+
+        poems = []
+        for _ in range(num_poems):
+            try:
+                lines = self.line_generator.generate_poem(seed, temperature=temperature, top_k=top_k, top_p=top_p,
+                                                          typical_p=typical_p)
+            except Exception as ex:
+                logging.error(ex)
+                continue
+
+            if lines is not None:
+                poems.append(lines)
+
+        logging.debug(self.line_generator.get_stats_str())
+        return self.rank_lines(poems, score_threshold)
+
+    def generate_poems_stream(self, topic, genre=None, emotion_token=None, max_poems=3, time_budget=60.0,
+                              batch_size=5, temperature=1.0, top_p=0.5, top_k=30, score_threshold=0.20,
+                              penalty_alpha=0.0, typical_p=1.0, repetition_penalty=1.0, no_repeat_ngram_size=0,
+                              n_lines=None, use_markup=False, stop_event=None):
+        """
+        Потоковый вариант generate_poems: генерация идет небольшими пакетами в фоновом потоке, каждый
+        завершившийся вариант сразу выравнивается, а принятые стихи выдаются итератором по мере появления.
+        Генерация прекращается, когда набрано max_poems стихов или истекло time_budget секунд.
+        Если temperature задана списком, то каждый пакет сэмплирует batch_size вариантов для каждой
+        температуры расписания за один проход. При включенном батчинге (enable_batching) пакеты
+        идут через общий GenerationBatcher вместе с запросами других пользователей.
+        Установка stop_event (threading.Event) из другого потока прекращает генерацию и выдачу.
+        """
+        try:
+            seed = self.build_seed(topic, genre, emotion_token)
+        except Exception as ex:
+            logging.error(ex)
+            return
+
+        t0 = time.time()
+        texts = queue.Queue()
+        if stop_event is None:
+            stop_event = threading.Event()
+
+        def produce():
+            try:
+                while not stop_event.is_set() and time.time() - t0 < time_budget:
+                    self.generate_texts(seed,
+                                        num_return_sequences=batch_size,
+                                        temperature=temperature,
+                                        top_p=top_p,
+                                        top_k=top_k,
+                                        penalty_alpha=penalty_alpha,
+                                        typical_p=typical_p,
+                                        repetition_penalty=repetition_penalty,
+                                        no_repeat_ngram_size=no_repeat_ngram_size,
+                                        n_lines=n_lines,
+                                        row_callback=texts.put,
+                                        stop_event=stop_event)
+            except Exception as ex:
+                logging.error(ex)
+            finally:
+                texts.put(None)
+
+        threading.Thread(target=produce, name='PoemStream', daemon=True).start()
+
+        nb_poems = 0
+        seen_texts = set()
+        try:
+            while nb_poems < max_poems and not stop_event.is_set():
+                timeout = time_budget - (time.time() - t0)
+                if timeout <= 0:
+                    break
+
+                try:
+                    text = texts.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if text is None:
+                    break
+
+                if text in seen_texts:
+                    continue
+                seen_texts.add(text)
+
+                for lines, score in self.rank_poems([text], score_threshold, use_markup=use_markup):
+                    nb_poems += 1
+                    logging.debug('Streaming: poem #%d accepted after %.1f sec', nb_poems, time.time() - t0)
+                    yield lines, score
+        finally:
+            stop_event.set()
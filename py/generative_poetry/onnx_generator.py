@@ -0,0 +1,180 @@
+"""
+Бэкенд ONNX Runtime для RugptGenerator.
+
+GPT2LMHeadModel с past_key_values один раз экспортируется в ONNX (файл кладется в tmp_dir и
+пересобирается при изменении весов), дальше генерация идет на CPU через onnxruntime. Цикл
+сэмплирования повторяет model.generate: те же логит-процессоры transformers в том же порядке,
+те же критерии остановки и паддинг завершенных строк, поэтому generate_output/generate_output_batch
+возвращают ровно то же, что и PyTorch-вариант, и конвейер выравнивания не меняется.
+"""
+
+import os
+import json
+import time
+import logging
+
+import numpy as np
+import torch
+import transformers
+import onnxruntime
+
+from generative_poetry.long_poem_generator2 import RugptGenerator
+from generative_poetry.gpt_quantization import get_source_signature
+
+
+class Gpt2WithPast(torch.nn.Module):
+    """Обертка для экспорта: past_key_values передаются и возвращаются плоским списком тензоров"""
+    def __init__(self, model):
+        super(Gpt2WithPast, self).__init__()
+        self.model = model
+        self.n_layer = model.config.n_layer
+
+    def forward(self, input_ids, attention_mask, position_ids, *past_flat):
+        past = transformers.DynamicCache.from_legacy_cache(
+            tuple((past_flat[2 * i], past_flat[2 * i + 1]) for i in range(self.n_layer)))
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                            past_key_values=past, use_cache=True, return_dict=True)
+        present = output.past_key_values.to_legacy_cache()
+        return (output.logits,) + tuple(t for layer in present for t in layer)
+
+
+def get_past_names(n_layer, prefix):
+    return [name for i in range(n_layer) for name in ('{}_key_{}'.format(prefix, i), '{}_value_{}'.format(prefix, i))]
+
+
+def export_gpt2_onnx(model_dir, onnx_path):
+    """Экспорт модели в onnx_path, если файла еще нет или он построен по другим весам"""
+    signature = get_source_signature(model_dir)
+    signature_path = onnx_path + '.signature'
+    if os.path.exists(onnx_path) and os.path.exists(signature_path):
+        with open(signature_path, 'r') as f:
+            if json.load(f).get('signature') == signature:
+                return
+
+    t0 = time.time()
+    model = transformers.GPT2LMHeadModel.from_pretrained(model_dir)
+    model.eval()
+    config = model.config
+    head_dim = config.n_embd // config.n_head
+
+    # Трассируем с непустым прошлым, длины по всем осям делаем динамическими.
+    batch_size, seq_len, past_len = 2, 3, 4
+    input_ids = torch.ones((batch_size, seq_len), dtype=torch.long)
+    attention_mask = torch.ones((batch_size, past_len + seq_len), dtype=torch.long)
+    position_ids = torch.arange(past_len, past_len + seq_len, dtype=torch.long).unsqueeze(0).repeat(batch_size, 1)
+    past_flat = [torch.zeros((batch_size, config.n_head, past_len, head_dim)) for _ in range(2 * config.n_layer)]
+
+    past_names = get_past_names(config.n_layer, 'past')
+    present_names = get_past_names(config.n_layer, 'present')
+    dynamic_axes = {'input_ids': {0: 'batch', 1: 'seq'},
+                    'attention_mask': {0: 'batch', 1: 'total_seq'},
+                    'position_ids': {0: 'batch', 1: 'seq'},
+                    'logits': {0: 'batch', 1: 'seq'}}
+    for name in past_names:
+        dynamic_axes[name] = {0: 'batch', 2: 'past_seq'}
+    for name in present_names:
+        dynamic_axes[name] = {0: 'batch', 2: 'total_seq'}
+
+    tmp_path = onnx_path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(Gpt2WithPast(model), (input_ids, attention_mask, position_ids) + tuple(past_flat), tmp_path,
+                          input_names=['input_ids', 'attention_mask', 'position_ids'] + past_names,
+                          output_names=['logits'] + present_names,
+                          dynamic_axes=dynamic_axes, opset_version=14, do_constant_folding=True)
+    os.replace(tmp_path, onnx_path)
+    with open(signature_path, 'w') as f:
+        json.dump({'signature': signature}, f)
+    logging.info('GPT model exported to "%s" in %.1f sec', onnx_path, time.time() - t0)
+
+
+class OnnxRugptGenerator(RugptGenerator):
+    def __init__(self):
+        super(OnnxRugptGenerator, self).__init__()
+        # ONNX Runtime здесь используется только на CPU
+        self.device = torch.device('cpu')
+        self.session = None
+        self.config = None
+
+    def load(self, model_dir, onnx_path=None, nb_threads=0):
+        self.load_tokenizer(model_dir)
+
+        if onnx_path is None:
+            onnx_path = os.path.join(model_dir, 'model_with_past.onnx')
+        export_gpt2_onnx(model_dir, onnx_path)
+
+        self.config = transformers.GPT2Config.from_pretrained(model_dir)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if nb_threads > 0:
+            options.intra_op_num_threads = nb_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        logging.info('ONNX Runtime session created for "%s"', onnx_path)
+
+    def enable_prompt_cache(self, max_size_mb):
+        # Кэш затравок хранит DynamicCache, ONNX-бэкенд держит прошлое в numpy-массивах.
+        logging.warning('Prompt cache is not supported by the ONNX backend, ignored')
+
+    def run_model(self, input_ids, attention_mask, position_ids, past):
+        feed = {'input_ids': input_ids, 'attention_mask': attention_mask, 'position_ids': position_ids}
+        feed.update(zip(get_past_names(self.config.n_layer, 'past'), past))
+        outputs = self.session.run(None, feed)
+        return outputs[0][:, -1, :], outputs[1:]
+
+    def generate_sequences(self, input_ids, attention_mask, max_length, do_sample, temperature, top_k, top_p,
+                           repetition_penalty, typical_p, no_repeat_ngram_size, num_return_sequences,
+                           logits_processor, stopping_criteria, pad_token_id, past_key_values=None):
+        """Сэмплирование в духе GenerationMixin._sample с теми же процессорами и критериями остановки"""
+        processors = transformers.LogitsProcessorList()
+        if repetition_penalty is not None and repetition_penalty != 1.0:
+            processors.append(transformers.RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if no_repeat_ngram_size is not None and no_repeat_ngram_size > 0:
+            processors.append(transformers.NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+        processors.extend(logits_processor)
+        if temperature is not None and temperature != 1.0:
+            processors.append(transformers.TemperatureLogitsWarper(temperature))
+        if top_k is not None and top_k != 0:
+            processors.append(transformers.TopKLogitsWarper(top_k=top_k, min_tokens_to_keep=1))
+        if top_p is not None and top_p < 1.0:
+            processors.append(transformers.TopPLogitsWarper(top_p=top_p, min_tokens_to_keep=1))
+        if typical_p is not None and typical_p < 1.0:
+            processors.append(transformers.TypicalLogitsWarper(mass=typical_p, min_tokens_to_keep=1))
+
+        eos_token_id = self.config.eos_token_id
+        input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0)
+        batch_size = input_ids.shape[0]
+
+        head_dim = self.config.n_embd // self.config.n_head
+        past = [np.zeros((batch_size, self.config.n_head, 0, head_dim), dtype=np.float32)
+                for _ in range(2 * self.config.n_layer)]
+
+        # Позиции для паддинга слева считаем так же, как prepare_inputs_for_generation.
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        step_ids = input_ids
+
+        unfinished = torch.ones(batch_size, dtype=torch.long)
+        while input_ids.shape[1] < max_length:
+            logits, past = self.run_model(step_ids.numpy(), attention_mask.numpy(), position_ids.numpy(), past)
+
+            scores = processors(input_ids, torch.from_numpy(logits))
+            if do_sample:
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(scores, dim=-1)
+            next_tokens = next_tokens * unfinished + pad_token_id * (1 - unfinished)
+
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            attention_mask = torch.cat([attention_mask, torch.ones((batch_size, 1), dtype=attention_mask.dtype)],
+                                       dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+            step_ids = next_tokens[:, None]
+
+            if eos_token_id is not None:
+                unfinished = unfinished * (next_tokens != eos_token_id).long()
+            if len(stopping_criteria):
+                unfinished = unfinished * (~stopping_criteria(input_ids, scores)).long()
+            if unfinished.max() == 0:
+                break
+
+        return input_ids
@@ -0,0 +1,66 @@
+"""
+Статистика длин строк (в токенах) принятых стихов для выбора бюджета генерации.
+
+Вместо фиксированного max_len=256 генератор берет бюджет под запрошенное число строк: высокий
+квантиль длины строки, умноженный на число строк, плюс разделители <nl> и </s>. Пока данных мало,
+используется консервативная длина строки по умолчанию. Статистика сохраняется в json, чтобы
+после перезапуска не начинать с нуля.
+"""
+
+import io
+import os
+import json
+import logging
+import threading
+
+
+def is_supported_line_count(n_lines):
+    """Стихи такой длины умеет выравнивать PoetryStressAligner.align: 1, 2, 4 или 4k+1 строк"""
+    return n_lines in (1, 2, 4) or (n_lines >= 5 and (n_lines - 1) % 4 == 0)
+
+
+class PoemLengthStats(object):
+    def __init__(self, default_line_tokens=40, quantile=0.98, min_samples=50, max_samples=10000, slack_tokens=4):
+        self.default_line_tokens = default_line_tokens
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.slack_tokens = slack_tokens
+        # длины строк в токенах, без разделителя <nl>; храним последние max_samples строк
+        self.line_lengths = []
+        self.nb_unsaved = 0
+        self.lock = threading.Lock()
+
+    def add_poem(self, line_lengths):
+        with self.lock:
+            self.line_lengths.extend(line_lengths)
+            if len(self.line_lengths) > self.max_samples:
+                self.line_lengths = self.line_lengths[-self.max_samples:]
+            self.nb_unsaved += len(line_lengths)
+
+    def get_line_budget(self):
+        with self.lock:
+            if len(self.line_lengths) < self.min_samples:
+                return self.default_line_tokens
+            lengths = sorted(self.line_lengths)
+        return lengths[min(len(lengths) - 1, int(self.quantile * len(lengths)))]
+
+    def get_token_budget(self, n_lines):
+        """Число токенов, которых хватит на стих из n_lines строк с разделителями и </s>"""
+        return n_lines * (self.get_line_budget() + 1) + 1 + self.slack_tokens
+
+    def load(self, path):
+        if os.path.exists(path):
+            with io.open(path, 'r', encoding='utf-8') as f:
+                self.line_lengths = json.load(f)['line_lengths'][-self.max_samples:]
+            logging.info('Poem length stats loaded from "%s": %d lines, line budget=%d', path,
+                         len(self.line_lengths), self.get_line_budget())
+
+    def save(self, path):
+        with self.lock:
+            data = {'line_lengths': list(self.line_lengths)}
+            self.nb_unsaved = 0
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
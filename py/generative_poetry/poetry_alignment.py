@@ -5,11 +5,14 @@ from functools import reduce
 import os
 import io
 import math
+import time
 import jellyfish
+import numpy as np
 import re
 from typing import List
 
 from poetry.phonetic import Accents, rhymed2, rhymed_fuzzy2
+from poetry.lru_cache import LruCache
 from generative_poetry.udpipe_parser import UdpipeParser
 from generative_poetry.metre_classifier import get_syllables
 from generative_poetry.whitespace_normalization import normalize_whitespaces
@@ -178,6 +181,94 @@ class MetreMappingCursor(object):
         result.add_word_mapping(best_mapping)
 
 
+class MetreMappingBatch(object):
+    """
+    MetreMappingCursor.map без сдвига ударений сразу для всех вариантов ударений строки, всех метров
+    и обоих префиксов. Сигнатуры ударений упаковываются в массивы, TP/FP/TN/FN по словам и оценки
+    получаются несколькими операциями numpy; MetreMappingResult строится только для выбранных сочетаний.
+    Оценки совпадают с MetreMappingCursor бит в бит: степени берутся из таблиц, посчитанных через pow,
+    а произведение по словам идет в том же порядке.
+    """
+    def __init__(self, line_stress_variants, metre_signatures, aligner):
+        self.variants = line_stress_variants
+        self.metre_signatures = metre_signatures
+
+        n_vars = len(line_stress_variants)
+        n_words = max(len(v.stressed_words) for v in line_stress_variants)
+        n_syllables = max(1, max(len(v.stress_signature) for v in line_stress_variants))
+
+        # ударность слогов и принадлежность слога слову; у коротких вариантов хвост остается нулевым
+        word_signs = np.zeros((n_vars, n_syllables), dtype=np.int32)
+        syllable2word = np.zeros((n_vars, n_syllables, n_words), dtype=np.int32)
+        shiftable = np.zeros((n_vars, n_words), dtype=bool)
+        for ivar, sline in enumerate(line_stress_variants):
+            pos = 0
+            for iword, word in enumerate(sline.stressed_words):
+                for word_sign in word.stress_signature:
+                    word_signs[ivar, pos] = word_sign
+                    syllable2word[ivar, pos, iword] = 1
+                    pos += 1
+                shiftable[ivar, iword] = self.is_shiftable(word, aligner)
+
+        # ожидаемая ударность слогов в каждом метре для prefix=0 и prefix=1, как в MetreMappingCursor.get_stress
+        metre_signs = np.zeros((len(metre_signatures), 2, n_syllables), dtype=np.int32)
+        for imetre, metre_signature in enumerate(metre_signatures):
+            for cursor in range(n_syllables):
+                metre_signs[imetre, 0, cursor] = metre_signature[cursor % len(metre_signature)]
+                if cursor > 0:
+                    metre_signs[imetre, 1, cursor] = metre_signature[(cursor - 1) % len(metre_signature)]
+
+        m = metre_signs[:, :, None, :]
+        w = word_signs[None, None, :, :]
+        # счетчики по словам, оси: метр, префикс, вариант, слово
+        self.TP = np.einsum('mpvs,vsw->mpvw', m * w, syllable2word)
+        self.FP = np.einsum('mpvs,vsw->mpvw', (1 - m) * w, syllable2word)
+        self.TN = np.einsum('mpvs,vsw->mpvw', (1 - m) * (1 - w), syllable2word)
+        self.FN = np.einsum('mpvs,vsw->mpvw', m * (1 - w), syllable2word)
+
+        max_count = n_syllables + 1
+        pow_fp = np.array([pow(0.1, k) for k in range(max_count)])
+        pow_fn = np.array([pow(0.95, k) for k in range(max_count)])
+        word_scores = pow_fp[self.FP] * pow_fn[self.FN]
+        scores = np.ones(word_scores.shape[:3])
+        for iword in range(n_words):
+            scores = scores * word_scores[:, :, :, iword]
+        scores = scores * np.array([v.get_score() for v in line_stress_variants])
+
+        # Сочетания, где MetreMappingCursor с allow_stress_shift=True может попробовать другое ударение слова;
+        # их приходится отображать прежним путем.
+        shift_candidates = ((self.FN > 0) & (self.FP > 0) & (self.TP == 0) & shiftable[None, None, :, :]).any(axis=-1)
+
+        # вложенные списки [метр][префикс][вариант] - индексировать их из питона быстрее, чем массивы
+        self.scores = scores.tolist()
+        self.shift_candidates = shift_candidates.tolist()
+
+    @staticmethod
+    def is_shiftable(stressed_word, aligner):
+        uform = stressed_word.poetry_word.form.lower()
+        return count_vowels(uform) > 1 and uform in aligner.accentuator.ambiguous_accents and \
+            uform not in aligner.accentuator.ambiguous_accents2
+
+    def build_result(self, imetre, prefix, ivar):
+        """MetreMappingResult без сдвига ударений для выбранного сочетания"""
+        sline = self.variants[ivar]
+        result = MetreMappingResult(sline)
+        for iword, word in enumerate(sline.stressed_words):
+            result.add_word_mapping(WordMappingResult(word,
+                                                      int(self.TP[imetre, prefix, ivar, iword]),
+                                                      int(self.FP[imetre, prefix, ivar, iword]),
+                                                      int(self.TN[imetre, prefix, ivar, iword]),
+                                                      int(self.FN[imetre, prefix, ivar, iword]),
+                                                      False))
+        return result
+
+    def map(self, imetre, prefix, ivar, allow_stress_shift, aligner):
+        if allow_stress_shift and self.shift_candidates[imetre][prefix][ivar]:
+            cursor = MetreMappingCursor(self.metre_signatures[imetre], prefix=prefix, allow_stress_shift=True)
+            return cursor.map(self.variants[ivar], aligner)
+        return self.build_result(imetre, prefix, ivar)
+
+
 class WordStressVariant(object):
     def __init__(self, poetry_word, new_stress_pos, score):
         self.poetry_word = poetry_word
@@ -636,6 +727,25 @@ def locate_Astress_pos(s):
     return stress_pos
 
 
+# Частеречные теги служебных слов для быстрой разметки строк без UDPipe (см. PoetryLine.build_from_markup_fast).
+# Остальные слова получают тег X, для которого в PoetryWord.get_stress_variants оставляется ударный вариант.
+FUNCTION_WORDS_UPOS = {word: upos for upos, words in [
+                    ('ADP', 'в во к ко с со о об обо у из от ото под подо за при до про для на по над надо перед пред '
+                            'без безо через сквозь меж между среди вокруг около возле после ради вдоль'),
+                    ('CCONJ', 'а и или иль но да либо то ни зато однако'),
+                    ('SCONJ', 'что чтоб чтобы если когда хотя будто словно пока раз едва коль ибо нежели чем как'),
+                    ('PART', 'не бы б ли ль же ж ни ка вот вон лишь уж даже разве неужели ведь пусть пускай только '
+                             'нибудь'),
+                    ('INTJ', 'ах ох эх ой увы ура эй'),
+                    ('PRON', 'я ты он она оно мы вы они меня тебя его ее её нас вас их мне тебе ему ей нам вам им '
+                             'мной тобой ним ней нею нем нём ними себя себе собой кто что ничто никто'),
+                    ('DET', 'мой моя моё мое мои твой твоя твоё твое твои свой своя своё свое свои наш ваш весь вся '
+                            'всё все этот эта это эти тот та те мою твою свою моих твоих моим твоим моей твоей своим'),
+                    ('ADV', 'где там тут здесь так уже еще ещё вновь опять всегда никогда тогда сейчас теперь вдруг '
+                            'снова очень нет')]
+                       for word in words.split(' ')}
+
+
 class PoetryLine(object):
     def __init__(self):
         self.text = None
@@ -697,9 +807,11 @@ class PoetryLine(object):
                                        alt_stress_pos)
                     pline.pwords.append(pword)
             else:
-                for ud_token in parsing:
+                # Слова, отсутствующие в словаре, отдаем модели ударений одним пакетом.
+                stress_positions = accentuator.get_accents_batch([t.form.lower() for t in parsing],
+                                                                 [t.tags + [t.upos] for t in parsing])
+                for ud_token, stress_pos in zip(parsing, stress_positions):
                     word = ud_token.form.lower()
-                    stress_pos = accentuator.get_accent(word, ud_tags=ud_token.tags + [ud_token.upos])
                     alt_stress_pos = []
                     if count_vowels(word) > 0 and stress_pos == -1:
                         if word in accentuator.ambiguous_accents2:
@@ -780,6 +892,83 @@ class PoetryLine(object):
         pline.locate_rhyming_word()
         return pline
 
+    @staticmethod
+    def build_from_markup_fast(markup_line, accentuator, stats=None):
+        """
+        Разметка строки по ударениям, которые расставила сама генеративная модель, без синтаксического
+        разбора. Слово, в котором отметки нет или она не согласуется со словарем, размечается через
+        accentuator.get_accent. Вернет None, если строку надо разбирать полным PoetryLine.build, в том числе
+        когда рифмуемое слово кончается на -ого и для его транскрипции нужна часть речи.
+        В stats (Counter), если задан, накапливается число слов, размеченных по отметкам и через словарь.
+        """
+        pline = PoetryLine()
+        pline.text = markup_line.replace('\u0301', '')
+        pline.pwords = []
+
+        for token in re.findall(r'[а-яёa-z\u0301]+(?:-[а-яёa-z\u0301]+)*|[^\s\w\u0301]', markup_line, flags=re.I):
+            form = token.replace('\u0301', '')
+            if not form[0].isalpha():
+                pline.pwords.append(PoetryWord(form, form, 'PUNCT', [], -1))
+                continue
+
+            word = form.lower()
+            upos = FUNCTION_WORDS_UPOS.get(word, 'X')
+
+            # позиции гласных, после которых стоит отметка ударения
+            marks = []
+            n_vowels = 0
+            for i, c in enumerate(token):
+                if c.lower() in 'уеыаоэёяию':
+                    n_vowels += 1
+                    if token[i + 1: i + 2] == '\u0301':
+                        marks.append(n_vowels)
+
+            stress_pos = None
+            if n_vowels == 0:
+                stress_pos = -1
+            elif len(marks) == 1:
+                stress_pos = marks[0]
+                if word not in accentuator.ambiguous_accents and word not in accentuator.ambiguous_accents2:
+                    dict_stress = accentuator.word_accents_dict.get(word)
+                    if dict_stress is not None and dict_stress != stress_pos:
+                        # отметка модели расходится со словарем
+                        stress_pos = None
+            elif n_vowels == 1 and not marks:
+                # односложные слова модель часто оставляет без отметки
+                stress_pos = 1
+
+            alt_stress_pos = []
+            if stress_pos is None:
+                if stats is not None:
+                    stats['dictionary_words'] += 1
+                stress_pos = accentuator.get_accent(word)
+                if stress_pos == -1 and word in accentuator.ambiguous_accents:
+                    alt_stress_pos = [locate_Astress_pos(stressed_form) for stressed_form in accentuator.ambiguous_accents[word]]
+                    stress_pos = alt_stress_pos[0]
+                if stress_pos == -1:
+                    return None
+            elif stats is not None:
+                stats['markup_words'] += 1
+
+            pline.pwords.append(PoetryWord(word, form, upos, [], stress_pos, alt_stress_pos))
+
+        if not any(pword.upos != 'PUNCT' for pword in pline.pwords):
+            return None
+
+        # Клаузула на -ого транскрибируется по-разному для ADJ/DET (родного -> родново) и прочих слов,
+        # а без разбора часть речи неизвестна. Правее рифмуемого слова могут стоять только односложные,
+        # поэтому смотрим на последнее многосложное слово строки.
+        for pword in pline.pwords[::-1]:
+            if pword.n_vowels > 1:
+                if pword.upos == 'X' and pword.form.lower().endswith('ого'):
+                    if stats is not None:
+                        stats['ogo_clausula_lines'] += 1
+                    return None
+                break
+
+        pline.locate_rhyming_word()
+        return pline
+
     def locate_rhyming_word(self):
         # Отмечаем последнее слово в строке,так как оно часто ударное
         located = False
@@ -982,10 +1171,182 @@ class CollocationStress(object):
         raise ValueError('Inconsistent call of CollocationStress::produce_stressed_line')
 
 
+def get_rhyme_scheme4(r01, r02, r03, r12, r13, r23):
+    """Схема рифмовки четверостишия и ее оценка по результатам попарной проверки рифм"""
+    rhyme_score = 1.0
+    if r01 and r12 and r23:
+        rhyme_scheme = 'AAAA'
+    elif r02 and r13:
+        rhyme_scheme = 'ABAB'
+    elif r03 and r12:
+        rhyme_scheme = 'ABBA'
+    elif r01 and r23:
+        rhyme_scheme = 'AABB'
+    #рифмовка "рубаи" AABA
+    elif r01 and r03 and not r02:
+        rhyme_scheme = 'AABA'
+    #неполные рифмовки
+    elif r02 and not r13:
+        rhyme_scheme = 'A-A-'
+        rhyme_score = 0.75
+    elif not r02 and r13:
+        rhyme_scheme = '-A-A'
+        rhyme_score = 0.75
+    else:
+        rhyme_scheme = '----'
+        rhyme_score = 0.50
+    return rhyme_scheme, rhyme_score
+
+
+# Схема рифмовки для каждой из 64 комбинаций попарных проверок; бит k соответствует паре
+# RHYME_PAIRS4[k], см. RhymeMatrix.get_mask4
+RHYME_PAIRS4 = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+RHYME_SCHEME4_TABLE = [get_rhyme_scheme4(*[bool(mask & (1 << k)) for k in range(6)]) for mask in range(64)]
+
+
+class RhymeMatrix(object):
+    """
+    Результаты check_rhyming для одного выравнивания. Рифмующиеся окончания вариантов разметки
+    сводятся к уникальным по ударной форме и грамматическим тегам слова, а проверка рифмы для пары
+    уникальных окончаний выполняется один раз, сколько бы раз эта пара ни встретилась в разных
+    сочетаниях вариантов и метрах.
+    Все окончания без ударного слова (not is_ok()) получают общий id BAD_TAIL_ID и ни с чем не рифмуются.
+    """
+    BAD_TAIL_ID = 0
+
+    def __init__(self, check_rhyming):
+        self.check_rhyming = check_rhyming
+        self.tail_ids = dict()
+        self.tails = [None]
+        self.verdicts = dict()
+        self.nb_checks = 0
+        self.nb_lookups = 0
+
+    @staticmethod
+    def get_tail_key(tail):
+        pword = tail.stressed_word.poetry_word
+        return tail.__repr__(), pword.upos, tuple(pword.tags)
+
+    def get_tail_id(self, tail):
+        if not tail.is_ok():
+            return self.BAD_TAIL_ID
+
+        key = self.get_tail_key(tail)
+        tail_id = self.tail_ids.get(key)
+        if tail_id is None:
+            tail_id = len(self.tails)
+            self.tail_ids[key] = tail_id
+            self.tails.append(tail)
+        return tail_id
+
+    def rhymes(self, tail_id1, tail_id2):
+        self.nb_lookups += 1
+        if tail_id1 == self.BAD_TAIL_ID or tail_id2 == self.BAD_TAIL_ID:
+            return False
+
+        key = (tail_id1, tail_id2)
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            self.nb_checks += 1
+            verdict = self.check_rhyming(self.tails[tail_id1], self.tails[tail_id2])
+            self.verdicts[key] = verdict
+        return verdict
+
+    def get_mask4(self, tail_ids):
+        mask = 0
+        for k, (i1, i2) in enumerate(RHYME_PAIRS4):
+            if self.rhymes(tail_ids[i1], tail_ids[i2]):
+                mask |= 1 << k
+        return mask
+
+
+def search_best_quatrain(stressed_lines2, rhyme_matrix, best_score, best_key, key_prefix, exhaustive=False,
+                         stats=None):
+    """
+    Поиск лучшего сочетания вариантов разметки 4 строк методом ветвей и границ вместо полного перебора
+    itertools.product. Для каждой строки в stressed_lines2 задан список пар (metre_mapping, LineStressVariant).
+
+    Оценка сочетания - это оценка схемы рифмовки (не больше 1), умноженная на произведение оценок строк.
+    Поэтому произведение оценок уже выбранных строк на максимумы оставшихся ограничивает сверху все
+    сочетания поддерева, и поддеревья, которые не могут побить best_score, отбрасываются. Варианты строк
+    перебираются по убыванию оценки. Из сочетаний с равной оценкой выигрывает то, что раньше встретилось бы
+    при полном переборе; для этого ключ сочетания - key_prefix плюс номера вариантов в исходных списках.
+
+    Вернет (best_score, best_key, rhyme_scheme, сочетание) или None, если лучше best_score ничего нет.
+    """
+    nlines = len(stressed_lines2)
+    if any(len(items) == 0 for items in stressed_lines2):
+        return None
+
+    scores = [[item[0].get_score() for item in items] for items in stressed_lines2]
+    tail_ids = [[rhyme_matrix.get_tail_id(item[1].get_rhyming_tail()) for item in items] for items in stressed_lines2]
+    maxima = [max(line_scores) for line_scores in scores]
+    if exhaustive:
+        orders = [list(range(len(line_scores))) for line_scores in scores]
+    else:
+        orders = [sorted(range(len(line_scores)), key=lambda i: -line_scores[i]) for line_scores in scores]
+
+    if stats is not None:
+        stats['combinations'] += mul([len(items) for items in stressed_lines2])
+
+    best = [best_score, best_key, None]
+
+    def can_improve(bound):
+        if exhaustive or bound > best[0]:
+            return True
+        # равная оценка выигрывает только у сочетания этого же метра, встречающегося в переборе позже
+        return bound == best[0] and best[1] is not None and best[1][:len(key_prefix)] == key_prefix
+
+    def evaluate(idx):
+        if stats is not None:
+            stats['evaluated'] += 1
+
+        mask = rhyme_matrix.get_mask4([tail_ids[iline][i] for iline, i in enumerate(idx)])
+        rhyme_scheme, rhyme_score = RHYME_SCHEME4_TABLE[mask]
+
+        total_score = rhyme_score * mul([scores[iline][i] for iline, i in enumerate(idx)])
+        key = key_prefix + tuple(idx)
+        if total_score > best[0] or (total_score == best[0] and best[1] is not None and key < best[1]):
+            best[0] = total_score
+            best[1] = key
+            best[2] = (rhyme_scheme, tuple(stressed_lines2[iline][i] for iline, i in enumerate(idx)))
+
+    def visit(depth, idx, partial):
+        if depth == nlines:
+            evaluate(idx)
+            return
+
+        for i in orders[depth]:
+            # произведение считаем в том же порядке, что и mul, чтобы граница не разошлась с точной оценкой
+            p = scores[depth][i] if depth == 0 else partial * scores[depth][i]
+            bound = p
+            for j in range(depth + 1, nlines):
+                bound = bound * maxima[j]
+
+            if not can_improve(bound):
+                # дальше по списку варианты строки с оценкой не выше
+                break
+
+            visit(depth + 1, idx + [i], p)
+
+    visit(0, [], 1.0)
+
+    if best[2] is None:
+        return None
+    return best[0], best[1], best[2][0], best[2][1]
+
+
 class PoetryStressAligner(object):
     def __init__(self, udpipe, accentuator, data_dir):
         self.udpipe = udpipe
         self.accentuator = accentuator
+        # exhaustive_search=True - полный перебор сочетаний в align4, для сверки с поиском с отсечениями
+        self.exhaustive_search = False
+        # vectorized_meter_mapping=False - отображение на метры по одному сочетанию через MetreMappingCursor
+        self.vectorized_meter_mapping = True
+        self.search_stats = collections.Counter()
+        # статистика быстрой разметки по ударениям генеративной модели, см. build_line
+        self.markup_stats = collections.Counter()
 
         self.collocations = []
         self.collocation2_first = set()
@@ -1029,6 +1390,9 @@ class PoetryStressAligner(object):
 
         self.allow_fuzzy_rhyming = True
 
+        # Вердикты check_rhyming для пар окончаний, общие для всех запросов процесса.
+        self.rhyme_cache = LruCache(max_size=200000, name='rhyme_cache')
+
     def map_meter(self, signature, lines):
         scores = [line.map_meter(signature) for line in lines]
         return reduce(lambda x, y: x * y, scores)
@@ -1059,8 +1423,38 @@ class PoetryStressAligner(object):
         score = math.exp(-d * 1.0)
         return score
 
-    def align(self, lines0, check_rhymes=True):
-        lines = [line.replace('\u0301', '') for line in lines0]
+    def build_line(self, line):
+        """
+        Строки с отметками ударений от генеративной модели размечаются по этим отметкам,
+        остальные - полным разбором через UDPipe и словарь ударений.
+        """
+        if '\u0301' in line:
+            pline = PoetryLine.build_from_markup_fast(line, self.accentuator, self.markup_stats)
+            if pline is not None:
+                self.markup_stats['markup_lines'] += 1
+                return pline
+            line = line.replace('\u0301', '')
+
+        self.markup_stats['parsed_lines'] += 1
+        return PoetryLine.build(line, self.udpipe, self.accentuator)
+
+    def get_search_stats_str(self):
+        return 'align4 search: combinations={} evaluated={} rhyme_lookups={} rhyme_checks={}'.format(
+            self.search_stats['combinations'], self.search_stats['evaluated'], self.search_stats['rhyme_lookups'],
+            self.search_stats['rhyme_checks'])
+
+    def get_markup_stats_str(self):
+        return 'markup alignment: ' + ' '.join('{}={}'.format(k, v) for k, v in sorted(self.markup_stats.items()))
+
+    def align(self, lines0, check_rhymes=True, use_markup=False):
+        """
+        use_markup=True - строки несут отметки ударений от генеративной модели, и разметка строится
+        по ним (build_line) без синтаксического разбора.
+        """
+        if use_markup:
+            lines = list(lines0)
+        else:
+            lines = [line.replace('\u0301', '') for line in lines0]
         nlines = len(lines)
         if nlines == 2:
             return self.align2(lines, check_rhymes)
@@ -1107,10 +1501,33 @@ class PoetryStressAligner(object):
 
         return PoetryAlignment.build_n4(block_alignments, total_score)
 
+    @staticmethod
+    def get_rhyme_cache_key(rhyming_tail):
+        """Все, от чего зависит проверка рифмы: форма, ударение, безударные префикс и хвост, признак ADJ/DET"""
+        poetry_word = rhyming_tail.stressed_word.poetry_word
+        is_adj = poetry_word.upos in ('ADJ', 'DET') or 'ADJ' in poetry_word.tags or 'DET' in poetry_word.tags
+        return (poetry_word.form, rhyming_tail.stressed_word.new_stress_pos, rhyming_tail.prefix,
+                rhyming_tail.unstressed_tail, rhyming_tail.is_simple(), is_adj)
+
     def check_rhyming(self, rhyming_tail1, rhyming_tail2):
         if not rhyming_tail1.is_ok() or not rhyming_tail2.is_ok():
             return False
 
+        # Ключ не зависит от порядка окончаний: пару упорядочиваем и проверяем всегда в этом порядке.
+        key1 = self.get_rhyme_cache_key(rhyming_tail1)
+        key2 = self.get_rhyme_cache_key(rhyming_tail2)
+        if key2 < key1:
+            key1, key2 = key2, key1
+            rhyming_tail1, rhyming_tail2 = rhyming_tail2, rhyming_tail1
+
+        key = (key1, key2, self.allow_fuzzy_rhyming, self.accentuator.allow_rifmovnik)
+        verdict = self.rhyme_cache.get(key)
+        if verdict is None:
+            verdict = self.check_rhyming0(rhyming_tail1, rhyming_tail2)
+            self.rhyme_cache[key] = verdict
+        return verdict
+
+    def check_rhyming0(self, rhyming_tail1, rhyming_tail2):
         poetry_word1 = rhyming_tail1.stressed_word
         poetry_word2 = rhyming_tail2.stressed_word
 
@@ -1166,34 +1583,96 @@ class PoetryStressAligner(object):
         if res.rhyme_scheme == 'AABA':
             return res
         else:
-            plines = [PoetryLine.build(line, self.udpipe, self.accentuator) for line in lines]
+            plines = [self.build_line(line) for line in lines]
             return PoetryAlignment.build_no_rhyming_result([pline.get_stress_variants(self)[0] for pline in plines])
 
+    def build_mapping_batches(self, stressed_lines):
+        if self.vectorized_meter_mapping:
+            metre_signatures = [metre_signature for _, metre_signature in meters]
+            return [MetreMappingBatch(slines, metre_signatures, self) for slines in stressed_lines]
+        else:
+            return [None] * len(stressed_lines)
+
+    def map_stress_variants(self, pline, slines, mapping_batch, imetre, allow_stress_shift):
+        """
+        Для каждого рифмующегося окончания оставляем лучший в метре вариант разметки строки.
+        Вернет список пар (MetreMappingResult, LineStressVariant) в порядке появления окончаний.
+        """
+        metre_signature = meters[imetre][1]
+        best_scores = dict()
+        for ivar, sline in enumerate(slines):
+            for prefix in [0, 1]:
+                metre_mapping = None
+                if mapping_batch is None:
+                    cursor = MetreMappingCursor(metre_signature, prefix=prefix, allow_stress_shift=allow_stress_shift)
+                    metre_mapping = cursor.map(sline, self)
+                elif allow_stress_shift and mapping_batch.shift_candidates[imetre][prefix][ivar]:
+                    metre_mapping = mapping_batch.map(imetre, prefix, ivar, allow_stress_shift, self)
+
+                if metre_mapping is not None and metre_mapping.stress_shift_count > 0:
+                    stressed_words = [m.word for m in metre_mapping.word_mappings]
+                    new_stress_line = LineStressVariant(pline, stressed_words, self)
+                else:
+                    new_stress_line = sline
+
+                if new_stress_line.get_rhyming_tail().is_ok():
+                    tail_str = new_stress_line.get_rhyming_tail().__repr__()
+                    if metre_mapping is not None:
+                        score = metre_mapping.get_score()
+                    else:
+                        score = mapping_batch.scores[imetre][prefix][ivar]
+                    if tail_str not in best_scores:
+                        prev_score = -1e3
+                    else:
+                        prev_score = best_scores[tail_str][0]
+                    if score > prev_score:
+                        best_scores[tail_str] = (score, metre_mapping, prefix, ivar, new_stress_line)
+
+        # объекты с результатами отображения строим только для оставшихся вариантов
+        items = []
+        for score, metre_mapping, prefix, ivar, new_stress_line in best_scores.values():
+            if metre_mapping is None:
+                metre_mapping = mapping_batch.build_result(imetre, prefix, ivar)
+            items.append((metre_mapping, new_stress_line))
+        return items
+
     def align1(self, lines):
-        pline1 = PoetryLine.build(lines[0], self.udpipe, self.accentuator)
+        pline1 = self.build_line(lines[0])
         if sum((pword.n_vowels > 1) for pword in pline1.pwords) >= 8:
             raise ValueError('Line is too long: "{}"'.format(pline1))
 
         sline1x = pline1.get_stress_variants(self)
+        mapping_batch = self.build_mapping_batches([sline1x])[0]
 
         best_score = 0.0
         best_metre_name = None
         best_mapping = None
         best_variant = None
+        best_combination = None
         for allow_stress_shift in [False, True]:
-            for metre_name, metre_signature in meters:
+            for imetre, (metre_name, metre_signature) in enumerate(meters):
                 for ivar, sline1 in enumerate(sline1x):
-                    cursor = MetreMappingCursor(metre_signature, prefix=0, allow_stress_shift=allow_stress_shift)
-                    metre_mapping = cursor.map(sline1, self)
-                    if metre_mapping.get_score() > best_score:
-                        best_score = metre_mapping.get_score()
+                    if mapping_batch is None or (allow_stress_shift and mapping_batch.shift_candidates[imetre][0][ivar]):
+                        cursor = MetreMappingCursor(metre_signature, prefix=0, allow_stress_shift=allow_stress_shift)
+                        metre_mapping = cursor.map(sline1, self)
+                        score = metre_mapping.get_score()
+                    else:
+                        metre_mapping = None
+                        score = mapping_batch.scores[imetre][0][ivar]
+
+                    if score > best_score:
+                        best_score = score
                         best_metre_name = metre_name
                         best_mapping = metre_mapping
                         best_variant = [sline1]
+                        best_combination = (imetre, ivar)
 
             if best_score > 0.1:
                 break
 
+        if best_mapping is None and best_combination is not None:
+            best_mapping = mapping_batch.build_result(best_combination[0], 0, best_combination[1])
+
         if best_mapping.stress_shift_count > 0:
             stressed_words = [m.word for m in best_mapping.word_mappings]
             new_stress_line = LineStressVariant(pline1, stressed_words, self)
@@ -1202,12 +1681,14 @@ class PoetryStressAligner(object):
         return PoetryAlignment(best_variant, best_score, best_metre_name, rhyme_scheme='')
 
     def align2(self, lines, check_rhymes):
-        plines = [PoetryLine.build(line, self.udpipe, self.accentuator) for line in lines]
+        plines = [self.build_line(line) for line in lines]
         for pline in plines:
             if sum((pword.n_vowels > 1) for pword in pline.pwords) >= 8:
                 raise ValueError('Line is too long: "{}"'.format(pline))
 
         stressed_lines = [pline.get_stress_variants(self) for pline in plines]
+        mapping_batches = self.build_mapping_batches(stressed_lines)
+        rhyme_matrix = RhymeMatrix(self.check_rhyming)
 
         best_score = 0.0
         best_metre = None
@@ -1216,39 +1697,13 @@ class PoetryStressAligner(object):
 
         for allow_stress_shift in [False, True]:
             # Для каждой строки перебираем варианты разметки и оставляем по 2 варианта в каждом метре.
-            for metre_name, metre_signature in meters:
-                best_scores = dict()
+            for imetre, (metre_name, metre_signature) in enumerate(meters):
                 # В каждой строке перебираем варианты расстановки ударений.
-                for ipline, (pline, slines) in enumerate(zip(plines, stressed_lines)):
-                    best_scores[ipline] = dict()
-
-                    for ivar, sline in enumerate(slines):
-                        for prefix in [0, 1]:
-                            cursor = MetreMappingCursor(metre_signature, prefix=prefix,
-                                                        allow_stress_shift=allow_stress_shift)
-                            metre_mapping = cursor.map(sline, self)
-
-                            if metre_mapping.stress_shift_count > 0:
-                                stressed_words = [m.word for m in metre_mapping.word_mappings]
-                                new_stress_line = LineStressVariant(pline, stressed_words, self)
-                            else:
-                                new_stress_line = sline
-
-                            if new_stress_line.get_rhyming_tail().is_ok():
-                                tail_str = new_stress_line.get_rhyming_tail().__repr__()
-                                score = metre_mapping.get_score()
-                                if tail_str not in best_scores[ipline]:
-                                    prev_score = -1e3
-                                else:
-                                    prev_score = best_scores[ipline][tail_str][0].get_score()
-                                if score > prev_score:
-                                    best_scores[ipline][tail_str] = (metre_mapping, new_stress_line)
+                stressed_lines2 = [self.map_stress_variants(pline, slines, mapping_batch, imetre, allow_stress_shift)
+                                   for pline, slines, mapping_batch in zip(plines, stressed_lines, mapping_batches)]
 
                 # Теперь для каждой исходной строки имеем несколько вариантов расстановки ударений.
                 # Перебираем сочетания этих вариантов, проверяем рифмовку и оставляем лучший вариант для данной метра.
-                stressed_lines2 = [list() for _ in range(2)]
-                for iline, items2 in best_scores.items():
-                    stressed_lines2[iline].extend(items2.values())
 
                 vvx = list(itertools.product(*stressed_lines2))
                 for ivar, plinev in enumerate(vvx):
@@ -1256,8 +1711,8 @@ class PoetryStressAligner(object):
                     rhyme_scheme = None
                     rhyme_score = 1.0
 
-                    last_pwords = [pline[1].get_rhyming_tail() for pline in plinev]
-                    if self.check_rhyming(last_pwords[0], last_pwords[1]):
+                    tail_ids = [rhyme_matrix.get_tail_id(pline[1].get_rhyming_tail()) for pline in plinev]
+                    if rhyme_matrix.rhymes(tail_ids[0], tail_ids[1]):
                         rhyme_scheme = 'AA'
                     else:
                         rhyme_scheme = '--'
@@ -1273,6 +1728,9 @@ class PoetryStressAligner(object):
             if best_score > 0.1:
                 break
 
+        self.search_stats['rhyme_lookups'] += rhyme_matrix.nb_lookups
+        self.search_stats['rhyme_checks'] += rhyme_matrix.nb_checks
+
         if best_variant is None:
             return PoetryAlignment.build_no_rhyming_result([pline.get_stress_variants(self)[0] for pline in plines])
         else:
@@ -1280,103 +1738,47 @@ class PoetryStressAligner(object):
             return PoetryAlignment(best_lines, best_score, best_metre, rhyme_scheme=best_rhyme_scheme)
 
     def align4(self, lines, check_rhymes):
-        plines = [PoetryLine.build(line, self.udpipe, self.accentuator) for line in lines]
+        plines = [self.build_line(line) for line in lines]
         for pline in plines:
             if sum((pword.n_vowels > 1) for pword in pline.pwords) >= 8:
                 raise ValueError('Line is too long: "{}"'.format(pline))
 
         stressed_lines = [pline.get_stress_variants(self) for pline in plines]
+        # отображение на метры без сдвига ударений считается один раз для всех метров и обоих проходов
+        mapping_batches = self.build_mapping_batches(stressed_lines)
+
+        # рифмовка не зависит от метра, поэтому проверки рифм общие для всех метров
+        rhyme_matrix = RhymeMatrix(self.check_rhyming)
 
         best_score = 0.0
+        best_key = None
         best_metre = None
         best_rhyme_scheme = None
         best_variant = None
 
         for allow_stress_shift in [False, True]:
             # Для каждой строки перебираем варианты разметки и оставляем по ~2 варианта в каждом метре.
-            for metre_name, metre_signature in meters:
-                best_scores = dict()
-
+            for imetre, (metre_name, metre_signature) in enumerate(meters):
                 # В каждой строке перебираем варианты расстановки ударений.
-                for ipline, (pline, slines) in enumerate(zip(plines, stressed_lines)):
-                    best_scores[ipline] = dict()
-
-                    for ivar, sline in enumerate(slines):
-                        for prefix in [0, 1]:
-                            cursor = MetreMappingCursor(metre_signature, prefix=prefix,
-                                                        allow_stress_shift=allow_stress_shift)
-                            metre_mapping = cursor.map(sline, self)
-
-                            if metre_mapping.stress_shift_count > 0:
-                                stressed_words = [m.word for m in metre_mapping.word_mappings]
-                                new_stress_line = LineStressVariant(pline, stressed_words, self)
-                            else:
-                                new_stress_line = sline
-
-                            if new_stress_line.get_rhyming_tail().is_ok():
-                                tail_str = new_stress_line.get_rhyming_tail().__repr__()
-                                score = metre_mapping.get_score()
-                                if tail_str not in best_scores[ipline]:
-                                    prev_score = -1e3
-                                else:
-                                    prev_score = best_scores[ipline][tail_str][0].get_score()
-                                if score > prev_score:
-                                    best_scores[ipline][tail_str] = (metre_mapping, new_stress_line)
+                stressed_lines2 = [self.map_stress_variants(pline, slines, mapping_batch, imetre, allow_stress_shift)
+                                   for pline, slines, mapping_batch in zip(plines, stressed_lines, mapping_batches)]
 
                 # Теперь для каждой исходной строки имеем несколько вариантов расстановки ударений.
                 # Перебираем сочетания этих вариантов, проверяем рифмовку и оставляем лучший вариант для данной метра.
-                stressed_lines2 = [list() for _ in range(4)]
-                for iline, items2 in best_scores.items():
-                    stressed_lines2[iline].extend(items2.values())
-
-                vvx = list(itertools.product(*stressed_lines2))
-                for ivar, plinev in enumerate(vvx):
-                    # Определяем рифму
-                    rhyme_scheme = None
-                    rhyme_score = 1.0
-
-                    last_pwords = [pline[1].get_rhyming_tail() for pline in plinev]
-
-                    r01 = self.check_rhyming(last_pwords[0], last_pwords[1])
-                    r02 = self.check_rhyming(last_pwords[0], last_pwords[2])
-                    r03 = self.check_rhyming(last_pwords[0], last_pwords[3])
-                    r12 = self.check_rhyming(last_pwords[1], last_pwords[2])
-                    r13 = self.check_rhyming(last_pwords[1], last_pwords[3])
-                    r23 = self.check_rhyming(last_pwords[2], last_pwords[3])
-
-                    rhyme_score = 1.0
-                    if r01 and r12 and r23:
-                        rhyme_scheme = 'AAAA'
-                    elif r02 and r13:
-                        rhyme_scheme = 'ABAB'
-                    elif r03 and r12:
-                        rhyme_scheme = 'ABBA'
-                    elif r01 and r23:
-                        rhyme_scheme = 'AABB'
-                    #рифмовка "рубаи" AABA
-                    elif r01 and r03 and not r02:
-                        rhyme_scheme = 'AABA'
-                    #неполные рифмовки
-                    elif r02 and not r13:
-                        rhyme_scheme = 'A-A-'
-                        rhyme_score = 0.75
-                    elif not r02 and r13:
-                        rhyme_scheme = '-A-A'
-                        rhyme_score = 0.75
-                    else:
-                        rhyme_scheme = '----'
-                        rhyme_score = 0.50
 
-                    total_score = rhyme_score * mul([pline[0].get_score() for pline in plinev])
-                    if total_score > best_score:
-                        best_score = total_score
-                        best_metre = metre_name
-                        best_rhyme_scheme = rhyme_scheme
-                        best_variant = plinev
+                found = search_best_quatrain(stressed_lines2, rhyme_matrix, best_score, best_key,
+                                             (int(allow_stress_shift), imetre), exhaustive=self.exhaustive_search,
+                                             stats=self.search_stats)
+                if found is not None:
+                    best_score, best_key, best_rhyme_scheme, best_variant = found
+                    best_metre = metre_name
 
             if best_score > 0.1:
                 break
 
+        self.search_stats['rhyme_lookups'] += rhyme_matrix.nb_lookups
+        self.search_stats['rhyme_checks'] += rhyme_matrix.nb_checks
+
         if best_variant is None:
             return PoetryAlignment.build_no_rhyming_result([pline.get_stress_variants(self)[0] for pline in plines])
         else:
@@ -2803,3 +3205,34 @@ if __name__ == '__main__':
             exit(0)
 
     print('{} tests passed OK.'.format(len(true_markups)))
+
+    # В режиме разметки по ударениям модели строка с клаузулой на -ого разбирается полностью, чтобы
+    # прилагательные получили тег ADJ и транскрипцию "родново", как без use_markup.
+    assert PoetryLine.build_from_markup_fast('у до́ма родно́го', accents) is None
+    assert PoetryLine.build_from_markup_fast('у до́ма родно́го ты', accents) is None
+    assert PoetryLine.build_from_markup_fast('у до́ма родно́й', accents) is not None
+
+    # Окончание без ударного слова (строка из пунктуации или безударных односложных слов) не должно
+    # ронять выравнивание, а просто ни с чем не рифмуется.
+    rhyme_matrix = RhymeMatrix(aligner.check_rhyming)
+    bad_tail_id = rhyme_matrix.get_tail_id(RhymingTail(None, None, []))
+    good_tail_id = rhyme_matrix.get_tail_id(aligner.align1(['ночи']).poetry_lines[0].get_rhyming_tail())
+    assert bad_tail_id == RhymeMatrix.BAD_TAIL_ID
+    assert not rhyme_matrix.rhymes(bad_tail_id, good_tail_id) and not rhyme_matrix.rhymes(bad_tail_id, bad_tail_id)
+
+    # Бенчмарк векторизованного отображения на метры: те же стихи с MetreMappingCursor и с MetreMappingBatch,
+    # результаты выравнивания должны совпадать полностью, включая оценку.
+    poems = [[z.strip() for z in true_markup.split('\n') if z.strip()] for true_markup, _ in true_markups]
+    outputs = dict()
+    for vectorized in [False, True]:
+        aligner.vectorized_meter_mapping = vectorized
+        outputs[vectorized] = []
+        t0 = time.time()
+        for _ in range(3):
+            for poem in poems:
+                alignment = aligner.align(poem, check_rhymes=True)
+                outputs[vectorized].append((alignment.get_stressed_lines(), alignment.rhyme_scheme, alignment.score))
+        print('vectorized_meter_mapping={} elapsed={:.2f} sec'.format(vectorized, time.time() - t0))
+
+    nb_mismatches = sum((r1 != r2) for r1, r2 in zip(outputs[False], outputs[True]))
+    print('{} mismatches in {} alignments'.format(nb_mismatches, len(outputs[True])))
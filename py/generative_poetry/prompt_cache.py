@@ -0,0 +1,80 @@
+"""
+Кэш состояний трансформера (past_key_values) для повторяющихся затравок.
+
+Затравки из SeedGenerator и популярные темы повторяются, а цикл повышения температуры в боте
+генерирует по одной и той же затравке несколько раз. Для затравки, уже встречавшейся раньше,
+генерация начинается с сохраненного состояния и пропускает прогон затравки через модель.
+Размер кэша ограничен в мегабайтах, вытесняются давно не использованные затравки.
+"""
+
+import copy
+import threading
+import collections
+
+import torch
+import transformers
+
+
+class PromptCache(object):
+    def __init__(self, model, max_size_mb=256):
+        self.model = model
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.items = collections.OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_cache_nbytes(past):
+        nbytes = 0
+        for layer_tensors in past.to_legacy_cache():
+            for t in layer_tensors:
+                nbytes += t.numel() * t.element_size()
+        return nbytes
+
+    def compute_past(self, prompt_ids):
+        # Последний токен затравки оставляем для generate, чтобы он вычислил по нему логиты первого шага.
+        with torch.no_grad():
+            output = self.model(input_ids=prompt_ids[:, :-1], past_key_values=transformers.DynamicCache(),
+                                use_cache=True)
+        return output.past_key_values
+
+    def get_past(self, prompt_ids, num_return_sequences):
+        """
+        Вернет копию закэшированного состояния для затравки prompt_ids (тензор 1 x N),
+        размноженную под num_return_sequences вариантов генерации.
+        """
+        if prompt_ids.shape[1] < 2:
+            return None
+
+        key = tuple(prompt_ids[0].tolist())
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                past = item[0]
+            else:
+                self.misses += 1
+                past = self.compute_past(prompt_ids)
+                nbytes = self.get_cache_nbytes(past)
+                if nbytes <= self.max_size_bytes:
+                    self.items[key] = (past, nbytes)
+                    self.size_bytes += nbytes
+                    while self.size_bytes > self.max_size_bytes:
+                        _, (_, evicted_nbytes) = self.items.popitem(last=False)
+                        self.size_bytes -= evicted_nbytes
+
+            # generate дописывает в кэш новые токены, поэтому отдаем копию.
+            past = copy.deepcopy(past)
+
+        if num_return_sequences > 1:
+            past.batch_repeat_interleave(num_return_sequences)
+        return past
+
+    def get_stats_str(self):
+        total = self.hits + self.misses
+        return 'prompt cache: prompts={} size={:.1f}MB hits={} misses={} hit_rate={:.3f}'.format(
+            len(self.items), self.size_bytes / (1024.0 * 1024.0), self.hits, self.misses,
+            self.hits / total if total else 0.0)
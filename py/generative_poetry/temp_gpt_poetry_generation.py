@@ -4,6 +4,7 @@ import logging
 import argparse
 import traceback
 import getpass
+import threading
 import sqlite3
 from datetime import datetime
 
@@ -11,12 +12,12 @@ import telegram
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
 from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, Update
 
-import tensorflow as tf
-
 from generative_poetry.init_logging import init_logging
 from generative_poetry.poetry_seeds import SeedGenerator
 
 from generative_poetry.long_poem_generator2 import LongPoemGeneratorCore2
+from generative_poetry.poem_length_stats import is_supported_line_count
+from transcriptor_models.stress_model import resolve_stress_backend
 
 
 # Инициализация базы данных
@@ -86,6 +87,19 @@ top_p = 1.00
 top_k = 0
 typical_p = 0.6
 
+# Температуры 1.0, 1.1, 1.21... до 1.6, раньше перебиравшиеся повторными генерациями
+temperature_schedule = [1.0, 1.1, 1.21, 1.331, 1.4641]
+
+# Потоковая генерация: сколько стихов набирать на одну тему и сколько секунд на это тратить
+stream_max_poems = 5
+stream_time_budget = 60.0
+
+# Выравнивание по отметкам ударений, которые расставляет сама модель (без разбора UDPipe)
+markup_alignment = False
+
+# Требуемое число строк в стихе (1, 2, 4 или 4k+1), None - длину выбирает модель
+poem_n_lines = None
+
 LIKE = 'Нравится!'
 DISLIKE = 'Плохо :('
 NEW = 'Новая тема'
@@ -94,6 +108,8 @@ HISTORY = 'История'
 
 last_user_poems = dict()
 last_user_poem = dict()
+# Флаги остановки фоновой дочитки потока стихов для каждого пользователя
+user_stream_stops = dict()
 user_format = dict()
 
 
@@ -202,6 +218,28 @@ def show_history(update, context):
     context.bot.send_message(chat_id=update.message.chat_id, text="Выберите тему:", reply_markup=reply_markup)
 
 
+def stop_user_stream(user_id):
+    stop_event = user_stream_stops.pop(user_id, None)
+    if stop_event is not None:
+        stop_event.set()
+
+
+def read_poem_stream(poem_stream, user_id, user_poems):
+    """
+    Дочитывает варианты после первого отправленного стиха. Кнопка "Еще" берет варианты с конца
+    списка, поэтому новые добавляем в начало. Если пользователь сменил тему, поток закрывается.
+    """
+    try:
+        for lines, score in poem_stream:
+            if last_user_poems.get(user_id) is not user_poems:
+                break
+            user_poems.insert(0, '\n'.join(lines))
+    except Exception as ex:
+        logging.error('Error while reading poem stream for user id=%s: %s', user_id, ex)
+    finally:
+        poem_stream.close()
+
+
 def echo(update, context):
     try:
         user_id = get_user_id(update)
@@ -218,6 +256,7 @@ def echo(update, context):
             message_text = update.message.text
 
         if message_text == NEW:
+            stop_user_stream(user_id)
             last_user_poem[user_id] = None
             last_user_poems[user_id] = []
 
@@ -274,14 +313,25 @@ def echo(update, context):
         if message_text == MORE:
             # Вывод следующего
 
-            if user_id not in last_user_poem or len(last_user_poems[user_id]) < 1:
+            if user_id not in last_user_poem:
                 echo_on_error(context, update, user_id)
                 return
 
-            poem = last_user_poems[user_id][-1]
+            if len(last_user_poems[user_id]) < 1:
+                # Варианты могут еще генерироваться в фоне
+                keyboard = [[MORE, NEW], seed_generator.generate_seeds(user_id, domain=format)]
+                reply_markup = ReplyKeyboardMarkup(keyboard,
+                                                   one_time_keyboard=True,
+                                                   resize_keyboard=True,
+                                                   per_user=True)
+                context.bot.send_message(chat_id=chat_id,
+                                         text='Других вариантов пока нет. Попробуйте чуть позже или выберите новую тему.',
+                                         reply_markup=reply_markup)
+                return
 
+            # Список меняем на месте: в него же дописывает варианты фоновый поток.
+            poem = last_user_poems[user_id].pop()
             last_user_poem[user_id] = poem
-            last_user_poems[user_id] = last_user_poems[user_id][:-1]
 
             if len(last_user_poems[user_id]):
                 keyboard = [[LIKE, DISLIKE, MORE, NEW]]
@@ -308,55 +358,31 @@ def echo(update, context):
                      update.callback_query.from_user.name if update.callback_query else update.message.from_user.name,
                      user_id, str(chat_id))
 
-        temperature = 1.0
-        max_temperature = 1.6
-        while temperature <= max_temperature:
-            ranked_poems = long_poetry_generator.generate_poems(topic=seed,
-                                                                temperature=temperature, top_p=top_p, top_k=top_k,
-                                                                typical_p=typical_p,
-                                                                num_return_sequences=5)
-            poems2 = [('\n'.join(lines), score) for lines, score in ranked_poems]
-
-            if len(poems2) > 0:
-                break
-
-            temperature *= 1.1
-            logging.info('Rising temperature to %f and trying again with seed="%s" for user="%s" id=%s in chat=%s',
-                         temperature, seed, update.callback_query.from_user.name if update.callback_query else update.message.from_user.name,
-                         user_id, str(chat_id))
+        # Стихи выдаются по мере готовности: первый принятый вариант отправляем сразу,
+        # остальные складываем в очередь для кнопки "Еще". Генерация по предыдущей теме больше не нужна.
+        stop_user_stream(user_id)
+        stop_event = threading.Event()
+        user_stream_stops[user_id] = stop_event
+        poem_stream = long_poetry_generator.generate_poems_stream(topic=seed,
+                                                                  temperature=temperature_schedule,
+                                                                  top_p=top_p, top_k=top_k, typical_p=typical_p,
+                                                                  batch_size=5,
+                                                                  n_lines=poem_n_lines,
+                                                                  use_markup=markup_alignment,
+                                                                  max_poems=stream_max_poems,
+                                                                  time_budget=stream_time_budget,
+                                                                  stop_event=stop_event)
+
+        user_poems = []
+        last_user_poems[user_id] = user_poems
+        last_user_poem[user_id] = None
 
-        if len(poems2) == 0:
+        first_poem = next(poem_stream, None)
+        if first_poem is None:
             logging.info('Could not generate a poem for seed="%s" for user="%s" id=%s in chat=%s', seed,
                          update.callback_query.from_user.name if update.callback_query else update.message.from_user.name,
                          user_id, str(chat_id))
 
-        last_user_poems[user_id] = []
-        last_user_poem[user_id] = None
-
-        for ipoem, (poem, score) in enumerate(poems2, start=1):
-            if ipoem == 1:
-                last_user_poem[user_id] = poem
-            else:
-                last_user_poems[user_id].append(poem)
-
-        if last_user_poem[user_id]:
-            if len(last_user_poems[user_id]):
-                keyboard = [[LIKE, DISLIKE, MORE, NEW, HISTORY]]
-            else:
-                keyboard = [[LIKE, DISLIKE, HISTORY], seed_generator.generate_seeds(user_id, domain=format)]
-
-            reply_markup = ReplyKeyboardMarkup(keyboard,
-                                               one_time_keyboard=True,
-                                               resize_keyboard=True,
-                                               per_user=True)
-
-            context.bot.send_message(chat_id=chat_id,
-                                     text=render_poem_html(last_user_poem[user_id]),
-                                     reply_markup=reply_markup, parse_mode='HTML')
-
-            # Добавляем стих в историю
-            add_to_history_db(user_id, seed, last_user_poem[user_id])
-        else:
             keyboard = [seed_generator.generate_seeds(user_id, domain=format)]
             reply_markup = ReplyKeyboardMarkup(keyboard,
                                                one_time_keyboard=True,
@@ -366,6 +392,27 @@ def echo(update, context):
             context.bot.send_message(chat_id=chat_id,
                                      text='Что-то не получается сочинить 😞\nЗадайте другую тему, пожалуйста',
                                      reply_markup=reply_markup)
+            poem_stream.close()
+            return
+
+        last_user_poem[user_id] = '\n'.join(first_poem[0])
+
+        keyboard = [[LIKE, DISLIKE, MORE, NEW, HISTORY]]
+        reply_markup = ReplyKeyboardMarkup(keyboard,
+                                           one_time_keyboard=True,
+                                           resize_keyboard=True,
+                                           per_user=True)
+
+        context.bot.send_message(chat_id=chat_id,
+                                 text=render_poem_html(last_user_poem[user_id]),
+                                 reply_markup=reply_markup, parse_mode='HTML')
+
+        # Добавляем стих в историю
+        add_to_history_db(user_id, seed, last_user_poem[user_id])
+
+        # Остальные варианты дочитываем в отдельном потоке, чтобы не занимать обработчик диспетчера.
+        threading.Thread(target=read_poem_stream, args=(poem_stream, user_id, user_poems),
+                         name='PoemStreamReader', daemon=True).start()
 
     except Exception as ex:
         logging.error('Error in "echo"')
@@ -383,6 +430,26 @@ if __name__ == '__main__':
     parser.add_argument('--data_dir', default='../../data', type=str)
     parser.add_argument('--models_dir', default='../../models', type=str)
     parser.add_argument('--log', type=str, default='../../tmp/stressed_gpt_poetry_generation.{HOSTNAME}.{DATETIME}.log')
+    parser.add_argument('--stress_backend', type=str, default='auto', choices='auto keras numpy'.split(),
+                        help='Stress model backend, numpy does not require tensorflow')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='Max number of concurrent requests merged into one generate call, 1 disables batching')
+    parser.add_argument('--max_batch_wait', type=float, default=0.05,
+                        help='How long (in seconds) to wait for more requests before running a batch')
+    parser.add_argument('--prompt_cache_mb', type=int, default=256,
+                        help='Size of the prompt KV cache in megabytes, 0 disables the cache')
+    parser.add_argument('--stream_max_poems', type=int, default=5, help='Poems collected per topic in streaming mode')
+    parser.add_argument('--stream_time_budget', type=float, default=60.0,
+                        help='Time budget in seconds for streaming generation of one topic')
+    parser.add_argument('--gpt_backend', type=str, default='torch', choices='torch onnx'.split(),
+                        help='Inference engine for the GPT model: PyTorch or ONNX Runtime on CPU')
+    parser.add_argument('--markup_alignment', action='store_true',
+                        help='Align poems by the stress marks emitted by the GPT model instead of full parsing')
+    parser.add_argument('--quantize', action='store_true', help='Dynamic int8 quantization of the GPT model for CPU inference')
+    parser.add_argument('--meter_early_stopping', type=float, default=0.001,
+                        help='Stop sampling candidates whose meter score falls below this value, 0 disables')
+    parser.add_argument('--n_lines', type=int, default=0,
+                        help='Number of lines in generated poems: 1, 2, 4 or 4k+1; 0 lets the model decide')
 
     args = parser.parse_args()
     mode = args.mode
@@ -392,18 +459,37 @@ if __name__ == '__main__':
 
     init_logging(args.log, True)
 
+    stream_max_poems = args.stream_max_poems
+    stream_time_budget = args.stream_time_budget
+    markup_alignment = args.markup_alignment
+    if args.n_lines:
+        if not is_supported_line_count(args.n_lines):
+            parser.error('--n_lines must be 1, 2, 4 or 4k+1')
+        poem_n_lines = args.n_lines
+
     # Инициализация базы данных
     init_db()
 
-    for gpu in tf.config.experimental.list_physical_devices('GPU'):
-        tf.config.experimental.set_memory_growth(gpu, True)
+    stress_backend = resolve_stress_backend(os.path.join(tmp_dir, 'stress_model'), args.stress_backend)
+    if stress_backend == 'keras':
+        import tensorflow as tf
+        for gpu in tf.config.experimental.list_physical_devices('GPU'):
+            tf.config.experimental.set_memory_growth(gpu, True)
+
     # Генератор подсказок
     seed_generator = SeedGenerator(models_dir)
 
     # Генератор рифмованных стихов
     logging.info('Loading the long poetry generation models from "%s"...', models_dir)
     long_poetry_generator = LongPoemGeneratorCore2('stressed_long_poetry_generator_medium')
-    long_poetry_generator.load(models_dir, data_dir, tmp_dir)
+    long_poetry_generator.load(models_dir, data_dir, tmp_dir, stress_backend=stress_backend, quantize=args.quantize,
+                               gpt_backend=args.gpt_backend)
+    if args.meter_early_stopping > 0:
+        long_poetry_generator.poem_generator.enable_meter_early_stopping(args.meter_early_stopping)
+    if args.prompt_cache_mb > 0:
+        long_poetry_generator.poem_generator.enable_prompt_cache(args.prompt_cache_mb)
+    if args.mode == 'telegram' and args.max_batch_size > 1:
+        long_poetry_generator.enable_batching(args.max_batch_size, args.max_batch_wait)
 
     if args.mode == 'telegram':
         telegram_token = args.token
@@ -415,16 +501,17 @@ if __name__ == '__main__':
         bot_id = tg_bot.name
         logging.info('Telegram bot "%s" id=%s', tg_bot.name, tg_bot.id)
 
-        updater = Updater(token=telegram_token)
+        # обработчики сообщений выполняются параллельно, чтобы одновременные запросы попадали в один пакет
+        updater = Updater(token=telegram_token, workers=max(4, args.max_batch_size))
         dispatcher = updater.dispatcher
 
         start_handler = CommandHandler('start', start)
         dispatcher.add_handler(start_handler)
 
-        echo_handler = MessageHandler(Filters.text & ~Filters.command, echo)
+        echo_handler = MessageHandler(Filters.text & ~Filters.command, echo, run_async=True)
         dispatcher.add_handler(echo_handler)
 
-        callback_handler = CallbackQueryHandler(handle_callback)
+        callback_handler = CallbackQueryHandler(handle_callback, run_async=True)
         dispatcher.add_handler(callback_handler)
 
         logging.getLogger('telegram.bot').setLevel(logging.INFO)
@@ -441,6 +528,8 @@ if __name__ == '__main__':
             ranked_poems = long_poetry_generator.generate_poems(topic=topic,
                                                                 temperature=1.0, top_p=top_p, top_k=top_k,
                                                                 typical_p=typical_p,
+                                                                n_lines=poem_n_lines,
+                                                                use_markup=markup_alignment,
                                                                 num_return_sequences=5)
             if not ranked_poems:
                 print("Не удалось сгенерировать стихи для данной темы. Попробуйте другую тему.")
@@ -0,0 +1,346 @@
+"""
+Сборка словарей ударений из исходных файлов в data_dir.
+
+Каждый источник разбирается отдельной функцией, источники обрабатываются параллельно в
+рабочих процессах, а затем сливаются в главном процессе с прежними правилами старшинства:
+single_accent.dat задает начальные ударения, accents.txt, ruwiktionary-accents.txt и
+words_accent.json только добавляют отсутствующие слова, true_accents.txt переопределяет
+ударение и убирает слово из омографов.
+
+Результат разбора каждого источника кэшируется вместе с хэшем содержимого файла, поэтому
+при повторной сборке заново разбираются только изменившиеся источники.
+
+Пример:
+    python accents_builder.py --data_dir ../../data/poetry/dict --tmp_dir ../../tmp --workers 4
+"""
+
+import os
+import io
+import re
+import json
+import time
+import yaml
+import pickle
+import hashlib
+import logging
+import argparse
+import concurrent.futures
+
+from poetry.oov_corrections import count_vowels
+
+
+# Менять при изменении логики разбора, чтобы сбросить кэш.
+BUILDER_VERSION = 1
+
+
+def parse_rifmovnik(path, all_words):
+    # Рифмовник для нечеткой рифмы
+    with io.open(path, 'r', encoding='utf-8') as f:
+        rhyming_data = json.load(f)
+    return dict((key, values) for key, values in rhyming_data['dictionary'].items() if len(values) > 0)
+
+
+def parse_rhymed_words(path, all_words):
+    # пары слов, который будем считать рифмующимися
+    rhymed_words = set()
+    with io.open(path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            s = line.strip()
+            if s and not s.startswith('#'):
+                i = s.index(' ')
+                word1 = s[:i].strip()
+                word2 = s[i + 1:].strip()
+                rhymed_words.add((word1, word2))
+    return rhymed_words
+
+
+def parse_yo_words(path, all_words):
+    # однозначаная ёфикация
+    yo_words = dict()
+    with io.open(path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            word = line.strip().lower()
+            key = word.replace('ё', 'е')
+            yo_words[key] = word
+    return yo_words
+
+
+def parse_ambiguous_accents(path, all_words):
+    d = yaml.safe_load(io.open(path, 'r', encoding='utf-8').read())
+
+    d2 = dict()
+    for entry_name, entry_data in d.items():
+        entry_data2 = dict()
+        for form, tagsets in entry_data.items():
+            tagsets2 = []
+            for tagset in tagsets:
+                if 'Case=Every' in tagset:
+                    for case in ['Nom', 'Gen', 'Ins', 'Acc', 'Dat', 'Loc']:
+                        tagset2 = tagset.replace('Case=Every', 'Case={}'.format(case))
+                        tagsets2.append(tagset2)
+                else:
+                    tagsets2.append(tagset)
+
+            entry_data2[form] = tagsets2
+
+        d2[entry_name] = entry_data2
+
+    for word, wdata in d2.items():
+        for stressed_form, tagsets in wdata.items():
+            if not any((c in 'АЕЁИОУЫЭЮЯ') for c in stressed_form):
+                raise RuntimeError('Missing stressed vowel in "ambiguous_accents.yaml" for word={}'.format(word))
+
+    return d2
+
+
+def parse_ambiguous_accents2(path, all_words):
+    return yaml.safe_load(io.open(path, 'r', encoding='utf-8').read())
+
+
+def parse_single_accent(path, all_words):
+    accents = dict()
+    with io.open(path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            tx = line.split('\t')
+            if len(tx) == 2:
+                word, accent = tx[0], tx[1]
+                n_vowels = 0
+                for c in accent:
+                    if c.lower() in 'уеыаоэёяию':
+                        n_vowels += 1
+                        if c.isupper():
+                            accents[word.lower()] = n_vowels
+                            break
+    return accents
+
+
+def parse_accents_txt(path, all_words):
+    # при повторе слова в источнике остается первое ударение
+    accents = dict()
+    with io.open(path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            tx = line.strip().split('#')
+            if len(tx) == 2:
+                forms = tx[1].split(',')
+                for form in forms:
+                    word = form.replace('\'', '').replace('`', '').lower()
+                    if all_words is None or word in all_words:
+                        if '\'' in form:
+                            accent_pos = form.index('\'')
+                            nb_vowels_before = count_vowels(form[:accent_pos])
+                            if word not in accents:
+                                accents[word] = nb_vowels_before
+                        elif 'ё' in form:
+                            accent_pos = form.index('ё')
+                            nb_vowels_before = count_vowels(form[:accent_pos]) + 1
+                            if word not in accents:
+                                accents[word] = nb_vowels_before
+    return accents
+
+
+def parse_ruwiktionary(path, all_words):
+    stress_char = '́'
+    stress2_char = '̀'
+    accents = dict()
+    with io.open(path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            word = line.strip()
+            if '-' not in word:
+                nword = word.replace(stress_char, '').replace('\'', '').replace('ѝ', 'и').replace('ѐ', 'е')\
+                    .replace(stress2_char, '').lower()
+                if len(nword) > 2 and nword not in accents:
+                    if stress_char in word:
+                        accents[nword] = count_vowels(word[:word.index(stress_char)])
+                    elif '\'' in word:
+                        accents[nword] = count_vowels(word[:word.index('\'')])
+                    elif 'ё' in word:
+                        accents[nword] = count_vowels(word[:word.index('ё')]) + 1
+    return accents
+
+
+def parse_words_accent(path, all_words):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        d = json.load(f)
+
+    accents = dict()
+    for word, a in d.items():
+        if '-' not in word:
+            nword = word.lower()
+            if nword not in accents:
+                accents[nword] = a
+    return accents
+
+
+def parse_true_accents(path, all_words):
+    # возвращает слова в порядке файла, ударения из этого источника переопределяют все остальные
+    true_accent_entries = dict()
+    accents = dict()
+    with io.open(path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            word = line.strip()
+            if word:
+                nword = word.lower()
+                m = re.search('([АЕЁИОУЭЮЯЫ])', word)
+                if m is None:
+                    raise RuntimeError('Invalid item "{}" in "true_accents.txt"'.format(word))
+
+                accent_char = m.groups(0)[0]
+                accent_pos = word.index(accent_char)
+                nb_vowels_before = count_vowels(word[:accent_pos]) + 1
+                if nword in true_accent_entries and true_accent_entries[nword] != word:
+                    raise RuntimeError('Controversial redefenition of stress position for word "{}" in "true_accents.txt": '
+                                       '{} and {}'.format(nword, true_accent_entries[nword], word))
+
+                accents[nword] = nb_vowels_before
+                true_accent_entries[nword] = word
+    return accents
+
+
+# Источники в порядке слияния: имя, файл в data_dir, функция разбора
+SOURCES = [('rifmovnik', 'rifmovnik.small.upgraded.json', parse_rifmovnik),
+           ('rhymed_words', 'rhymed_words.txt', parse_rhymed_words),
+           ('yo_words', 'solarix_yo.txt', parse_yo_words),
+           ('ambiguous_accents', 'ambiguous_accents.yaml', parse_ambiguous_accents),
+           ('ambiguous_accents2', 'ambiguous_accents_2.yaml', parse_ambiguous_accents2),
+           ('single_accent', 'single_accent.dat', parse_single_accent),
+           ('accents_txt', 'accents.txt', parse_accents_txt),
+           ('ruwiktionary', 'ruwiktionary-accents.txt', parse_ruwiktionary),
+           ('words_accent', 'words_accent.json', parse_words_accent),
+           ('true_accents', 'true_accents.txt', parse_true_accents),
+           ]
+
+
+def get_source_hash(path, all_words):
+    h = hashlib.sha1()
+    h.update(str(BUILDER_VERSION).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    if all_words is not None:
+        # фильтр по списку слов тоже влияет на результат разбора
+        h.update('\n'.join(sorted(all_words)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def run_parser(parse_fn, path, all_words):
+    t0 = time.time()
+    result = parse_fn(path, all_words)
+    return result, time.time() - t0
+
+
+def load_cached_source(cache_dir, name, source_hash):
+    if cache_dir is None:
+        return None
+
+    cache_path = os.path.join(cache_dir, name + '.pkl')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['hash'] == source_hash:
+            return cached['result']
+    return None
+
+
+def store_cached_source(cache_dir, name, source_hash, result):
+    if cache_dir is not None:
+        with open(os.path.join(cache_dir, name + '.pkl'), 'wb') as f:
+            pickle.dump({'hash': source_hash, 'result': result}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def parse_sources(data_dir, all_words, nb_workers=1, cache_dir=None):
+    """Вернет словарь источник => результат разбора"""
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    results = dict()
+    stale_sources = []
+    for name, filename, parse_fn in SOURCES:
+        path = os.path.join(data_dir, filename)
+        source_hash = get_source_hash(path, all_words if parse_fn is parse_accents_txt else None)
+        result = load_cached_source(cache_dir, name, source_hash)
+        if result is not None:
+            logging.info('Source "%s": content unchanged, %d entries taken from cache', filename, len(result))
+            results[name] = result
+        else:
+            stale_sources.append((name, filename, parse_fn, path, source_hash))
+
+    def on_parsed(name, filename, source_hash, result, elapsed):
+        logging.info('Source "%s": %d entries parsed in %.2f sec', filename, len(result), elapsed)
+        store_cached_source(cache_dir, name, source_hash, result)
+        results[name] = result
+
+    if nb_workers <= 1 or len(stale_sources) <= 1:
+        for name, filename, parse_fn, path, source_hash in stale_sources:
+            logging.info('Parsing "%s"', path)
+            result, elapsed = run_parser(parse_fn, path, all_words)
+            on_parsed(name, filename, source_hash, result, elapsed)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nb_workers) as executor:
+            futures = dict()
+            for name, filename, parse_fn, path, source_hash in stale_sources:
+                source_words = all_words if parse_fn is parse_accents_txt else None
+                futures[executor.submit(run_parser, parse_fn, path, source_words)] = (name, filename, source_hash)
+
+            for future in concurrent.futures.as_completed(futures):
+                name, filename, source_hash = futures[future]
+                result, elapsed = future.result()
+                on_parsed(name, filename, source_hash, result, elapsed)
+
+    return results
+
+
+def build_accents(accents, data_dir, all_words, nb_workers=1, cache_dir=None):
+    """Заполняет словари объекта Accents из исходных файлов"""
+    t0 = time.time()
+    results = parse_sources(data_dir, all_words, nb_workers, cache_dir)
+
+    accents.rhyming_dict = results['rifmovnik']
+    accents.rhymed_words = set(results['rhymed_words'])
+    accents.yo_words = results['yo_words']
+    accents.ambiguous_accents = dict(results['ambiguous_accents'])
+    logging.info('%d items in ambiguous_accents', len(accents.ambiguous_accents))
+    accents.ambiguous_accents2 = results['ambiguous_accents2']
+    accents.ambiguous_index = None
+
+    word_accents_dict = dict(results['single_accent'])
+    logging.info('Source "single_accent": %d entries contributed', len(word_accents_dict))
+
+    for name in ['accents_txt', 'ruwiktionary', 'words_accent']:
+        nb_added = 0
+        for word, accent in results[name].items():
+            if word not in word_accents_dict:
+                word_accents_dict[word] = accent
+                nb_added += 1
+        logging.info('Source "%s": %d entries contributed', name, nb_added)
+
+    for nword, accent in results['true_accents'].items():
+        if nword in accents.ambiguous_accents:
+            del accents.ambiguous_accents[nword]
+        word_accents_dict[nword] = accent
+    logging.info('Source "true_accents": %d entries contributed', len(results['true_accents']))
+
+    accents.word_accents_dict = word_accents_dict
+    logging.info('%d items in word_accents_dict, build took %.1f sec', len(word_accents_dict), time.time() - t0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build accents.pkl from the source dictionaries')
+    parser.add_argument('--data_dir', type=str, default='../../data/poetry/dict')
+    parser.add_argument('--tmp_dir', type=str, default='../../tmp')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache_dir', type=str, default=None, help='By default tmp_dir/accents_build_cache')
+    parser.add_argument('--mmap', action='store_true', help='Also write accents.mmap')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    from poetry.phonetic import Accents
+    from poetry.accents_mmap import save_accents_mmap
+
+    tmp_dir = os.path.expanduser(args.tmp_dir)
+    accents = Accents()
+    build_accents(accents, os.path.expanduser(args.data_dir), None, nb_workers=args.workers,
+                  cache_dir=args.cache_dir or os.path.join(tmp_dir, 'accents_build_cache'))
+    accents.save_pickle(os.path.join(tmp_dir, 'accents.pkl'))
+    if args.mmap:
+        save_accents_mmap(accents, os.path.join(tmp_dir, 'accents.mmap'))
@@ -0,0 +1,137 @@
+"""
+Версионированный контейнер для accents.pkl с ленивой загрузкой секций.
+
+Каждый словарь Accents пиклится отдельно, в заголовке файла хранится таблица секций со смещениями.
+Секция десериализуется при первом обращении к соответствующему атрибуту, поэтому процесс, который
+не пользуется рифмовником, не тратит время и память на rhyming_dict.
+
+Accents.load_pickle сам определяет формат файла, старые accents.pkl читаются как раньше.
+
+Конвертация старого файла:
+    python accents_container.py --input ../../tmp/accents.pkl
+"""
+
+import os
+import time
+import pickle
+import struct
+import logging
+import argparse
+import threading
+
+
+MAGIC = b'ACCPKL\0\0'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+SECTION_ENTRY = struct.Struct('<32sQQ')
+
+SECTIONS = ['ambiguous_accents', 'ambiguous_accents2', 'word_accents_dict', 'yo_words', 'rhymed_words', 'rhyming_dict',
+            'ambiguous_index']
+
+
+class LazySection(object):
+    """
+    Дескриптор атрибута Accents: если для объекта зарегистрирован загрузчик секции, то
+    значение будет прочитано из контейнера при первом обращении.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        d = instance.__dict__
+        if self.name not in d:
+            with self.lock:
+                if self.name not in d:
+                    loader = d.get('_lazy_sections', dict()).pop(self.name, None)
+                    d[self.name] = loader() if loader is not None else None
+        return d[self.name]
+
+    def __set__(self, instance, value):
+        instance.__dict__.get('_lazy_sections', dict()).pop(self.name, None)
+        instance.__dict__[self.name] = value
+
+
+def is_container(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_container(accents, path):
+    blobs = [(name, pickle.dumps(getattr(accents, name), protocol=pickle.HIGHEST_PROTOCOL)) for name in SECTIONS]
+
+    offset = HEADER.size + SECTION_ENTRY.size * len(blobs)
+    entries = []
+    for name, blob in blobs:
+        entries.append(SECTION_ENTRY.pack(name.encode('utf-8'), offset, len(blob)))
+        offset += len(blob)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(blobs)))
+        f.write(b''.join(entries))
+        for _, blob in blobs:
+            f.write(blob)
+
+
+def read_directory(path):
+    """Вернет словарь секция => (смещение, длина)"""
+    with open(path, 'rb') as f:
+        magic, version, nb_sections = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise RuntimeError('File "{}" is not an accents container'.format(path))
+        if version > VERSION:
+            raise RuntimeError('Unsupported accents container version {} in "{}"'.format(version, path))
+
+        directory = dict()
+        for _ in range(nb_sections):
+            name, offset, length = SECTION_ENTRY.unpack(f.read(SECTION_ENTRY.size))
+            directory[name.rstrip(b'\0').decode('utf-8')] = (offset, length)
+    return directory
+
+
+def make_section_loader(path, name, offset, length):
+    def load_section():
+        t0 = time.time()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            value = pickle.loads(f.read(length))
+        logging.debug('Section "%s" loaded from "%s" in %.3f sec', name, path, time.time() - t0)
+        return value
+    return load_section
+
+
+def load_container_lazy(accents, path):
+    """Регистрирует загрузчики секций; сами данные читаются при первом обращении к атрибутам"""
+    lazy_sections = dict()
+    for name in SECTIONS:
+        accents.__dict__.pop(name, None)
+    for name, (offset, length) in read_directory(path).items():
+        if name in SECTIONS:
+            lazy_sections[name] = make_section_loader(path, name, offset, length)
+    accents.__dict__['_lazy_sections'] = lazy_sections
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert accents.pkl to the lazy section container')
+    parser.add_argument('--input', type=str, default='../../tmp/accents.pkl')
+    parser.add_argument('--output', type=str, default=None, help='By default the input file is converted in place')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    from poetry.phonetic import Accents
+
+    accents = Accents()
+    accents.load_pickle(args.input)
+    for name in SECTIONS:
+        getattr(accents, name)
+    accents.get_ambiguous_index()
+
+    output_path = args.output or args.input
+    tmp_path = output_path + '.tmp'
+    save_container(accents, tmp_path)
+    os.replace(tmp_path, output_path)
+    logging.info('Accents container with %d sections stored in "%s"', len(SECTIONS), output_path)
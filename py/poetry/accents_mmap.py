@@ -0,0 +1,271 @@
+"""
+Компактный формат словарей ударений, читаемый через mmap.
+
+Каждый словарь из accents.pkl сохраняется как отсортированная таблица строк с индексом смещений,
+поиск выполняется бинарным поиском прямо по отображенному в память файлу. Несколько рабочих
+процессов разделяют одну копию файла в page cache, а загрузка сводится к открытию файла.
+
+Конвертация:
+    python accents_mmap.py --input ../../tmp/accents.pkl --output ../../tmp/accents.mmap
+"""
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import logging
+import argparse
+import collections.abc
+
+
+MAGIC = b'ACCMMAP1'
+HEADER = struct.Struct('<8sI')
+SECTION_ENTRY = struct.Struct('<24sQQ')
+SECTION_HEADER = struct.Struct('<4sI')
+
+KIND_INT8 = b'int8'
+KIND_STR = b'str '
+KIND_JSON = b'json'
+KIND_NONE = b'none'
+
+
+def encode_offsets(offsets):
+    a = array.array('I', offsets)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+def pad8(n):
+    return (8 - n % 8) % 8
+
+
+def build_section(items, kind):
+    """items - список пар (ключ, значение); вернет байтовое представление секции"""
+    items = sorted(((key.encode('utf-8'), value) for key, value in items), key=lambda z: z[0])
+
+    key_offsets = [0]
+    for key, _ in items:
+        key_offsets.append(key_offsets[-1] + len(key))
+
+    chunks = [SECTION_HEADER.pack(kind, len(items)), encode_offsets(key_offsets)]
+
+    if kind == KIND_INT8:
+        chunks.append(array.array('b', [value for _, value in items]).tobytes())
+    elif kind in (KIND_STR, KIND_JSON):
+        values = [value.encode('utf-8') if kind == KIND_STR else json.dumps(value, ensure_ascii=False).encode('utf-8')
+                  for _, value in items]
+        value_offsets = [0]
+        for value in values:
+            value_offsets.append(value_offsets[-1] + len(value))
+        chunks.append(encode_offsets(value_offsets))
+        chunks.append(b''.join(key for key, _ in items))
+        chunks.append(b''.join(values))
+        return b''.join(chunks)
+
+    chunks.append(b''.join(key for key, _ in items))
+    return b''.join(chunks)
+
+
+class MmapStringTable(collections.abc.Mapping):
+    """Словарь строка => значение поверх секции mmap-файла"""
+    def __init__(self, mm, offset):
+        self.mm = mm
+        self.kind, self.n = SECTION_HEADER.unpack_from(mm, offset)
+        pos = offset + SECTION_HEADER.size
+
+        self.key_offsets = self.read_offsets(pos)
+        pos += 4 * (self.n + 1)
+
+        self.values_start = None
+        self.value_offsets = None
+        if self.kind == KIND_INT8:
+            self.values_start = pos
+            pos += self.n
+        elif self.kind in (KIND_STR, KIND_JSON):
+            self.value_offsets = self.read_offsets(pos)
+            pos += 4 * (self.n + 1)
+
+        self.keys_start = pos
+        if self.kind in (KIND_STR, KIND_JSON):
+            self.values_start = self.keys_start + self.key_offsets[self.n]
+
+    def read_offsets(self, pos):
+        view = memoryview(self.mm)[pos: pos + 4 * (self.n + 1)]
+        if sys.byteorder == 'little':
+            return view.cast('I')
+        a = array.array('I', view.tobytes())
+        a.byteswap()
+        return a
+
+    def get_key_bytes(self, i):
+        return self.mm[self.keys_start + self.key_offsets[i]: self.keys_start + self.key_offsets[i + 1]]
+
+    def find(self, key):
+        needle = key.encode('utf-8')
+        lo = 0
+        hi = self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_key_bytes(mid) < needle:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self.n and self.get_key_bytes(lo) == needle:
+            return lo
+        return -1
+
+    def get_value(self, i):
+        if self.kind == KIND_INT8:
+            v = self.mm[self.values_start + i]
+            return v - 256 if v > 127 else v
+        elif self.kind == KIND_NONE:
+            return None
+
+        data = self.mm[self.values_start + self.value_offsets[i]: self.values_start + self.value_offsets[i + 1]]
+        if self.kind == KIND_STR:
+            return data.decode('utf-8')
+        return json.loads(data.decode('utf-8'))
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self.find(key) != -1
+
+    def __getitem__(self, key):
+        i = self.find(key) if isinstance(key, str) else -1
+        if i == -1:
+            raise KeyError(key)
+        return self.get_value(i)
+
+    def get(self, key, default=None):
+        i = self.find(key) if isinstance(key, str) else -1
+        return default if i == -1 else self.get_value(i)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.get_key_bytes(i).decode('utf-8')
+
+    def __len__(self):
+        return self.n
+
+
+class MmapPairSet(collections.abc.Set):
+    """Множество пар слов (rhymed_words), пара хранится как ключ 'слово1\\tслово2'"""
+    def __init__(self, table):
+        self.table = table
+
+    def __contains__(self, pair):
+        return self.table.find(pair[0] + '\t' + pair[1]) != -1
+
+    def __iter__(self):
+        for key in self.table:
+            yield tuple(key.split('\t', 1))
+
+    def __len__(self):
+        return len(self.table)
+
+
+# Секции файла и вид хранимых значений.
+SECTIONS = [('ambiguous_accents', KIND_JSON),
+            ('ambiguous_accents2', KIND_JSON),
+            ('word_accents_dict', KIND_INT8),
+            ('yo_words', KIND_STR),
+            ('rhymed_words', KIND_NONE),
+            ('rhyming_dict', KIND_JSON)]
+
+# Разобранная таблица омографов (см. ambiguous_index.py)
+INDEX_SECTIONS = [('ambiguous_tags', KIND_JSON),
+                  ('ambiguous_index', KIND_JSON)]
+
+
+def save_accents_mmap(accents, path):
+    sections = []
+    for name, kind in SECTIONS:
+        data = getattr(accents, name)
+        if name == 'rhymed_words':
+            items = [(w1 + '\t' + w2, None) for w1, w2 in data]
+        else:
+            items = list(data.items())
+            if kind == KIND_INT8 and not all(-128 <= v <= 127 for _, v in items):
+                kind = KIND_JSON
+        sections.append((name, build_section(items, kind)))
+
+    ambiguous_index = accents.get_ambiguous_index()
+    if ambiguous_index is not None:
+        sections.append(('ambiguous_tags', build_section(ambiguous_index.tag2bit.items(), KIND_JSON)))
+        sections.append(('ambiguous_index', build_section(ambiguous_index.entries.items(), KIND_JSON)))
+
+    offset = HEADER.size + SECTION_ENTRY.size * len(sections)
+    offset += pad8(offset)
+    entries = []
+    for name, data in sections:
+        entries.append(SECTION_ENTRY.pack(name.encode('utf-8'), offset, len(data)))
+        offset += len(data) + pad8(len(data))
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(sections)))
+        f.write(b''.join(entries))
+        f.write(b'\0' * pad8(f.tell()))
+        for name, data in sections:
+            f.write(data)
+            f.write(b'\0' * pad8(len(data)))
+
+    logging.info('Accents dictionaries saved to "%s" (%d bytes)', path, os.path.getsize(path))
+
+
+def open_accents_mmap(path):
+    """Вернет объект mmap и словарь секция => MmapStringTable"""
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, nb_sections = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise RuntimeError('File "{}" is not an accents mmap dictionary'.format(path))
+
+    tables = dict()
+    for isection in range(nb_sections):
+        name, offset, _ = SECTION_ENTRY.unpack_from(mm, HEADER.size + isection * SECTION_ENTRY.size)
+        tables[name.rstrip(b'\0').decode('utf-8')] = MmapStringTable(mm, offset)
+
+    return mm, tables
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert accents.pkl to the mmap dictionary format')
+    parser.add_argument('--input', type=str, default='../../tmp/accents.pkl')
+    parser.add_argument('--output', type=str, default='../../tmp/accents.mmap')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    from poetry.phonetic import Accents
+
+    accents = Accents()
+    accents.load_pickle(args.input)
+    save_accents_mmap(accents, args.output)
+
+    # Сверяем содержимое
+    accents2 = Accents()
+    accents2.load_mmap(args.output)
+    for name, _ in SECTIONS:
+        d1 = getattr(accents, name)
+        d2 = getattr(accents2, name)
+        if len(d1) != len(d2):
+            print('Size mismatch in section "{}": {} != {}'.format(name, len(d1), len(d2)))
+            exit(1)
+        if name == 'rhymed_words':
+            if not all((pair in d2) for pair in d1):
+                print('Content mismatch in section "{}"'.format(name))
+                exit(1)
+        elif not all((d2.get(key) == value) for key, value in d1.items()):
+            print('Content mismatch in section "{}"'.format(name))
+            exit(1)
+    index1 = accents.get_ambiguous_index()
+    index2 = accents2.get_ambiguous_index()
+    if dict(index1.tag2bit) != dict(index2.tag2bit) or \
+            any([list(e) for e in index1.entries[word]] != index2.entries[word] for word in index1.entries):
+        print('Content mismatch in ambiguous accents index')
+        exit(1)
+    print('Conversion verified OK')
@@ -0,0 +1,103 @@
+"""
+Предразобранная таблица омографов для Accents.predict_ambiguous_accent.
+
+Наборы UD-тегов из ambiguous_accents переводятся в битовые маски над словарем тегов, а позиция
+ударения для каждого варианта вычисляется заранее. Выбор варианта сводится к нескольким
+целочисленным операциям.
+"""
+
+
+def get_stress_pos(accented):
+    """Номер ударной гласной, отмеченной заглавной буквой, или None"""
+    n_vowels = 0
+    for c in accented:
+        if c.lower() in 'уеыаоэёяию':
+            n_vowels += 1
+            if c.isupper():
+                return n_vowels
+    return None
+
+
+def popcount(x):
+    return bin(x).count('1')
+
+
+class AmbiguousAccentsIndex(object):
+    def __init__(self, tag2bit, entries):
+        # tag2bit - номер бита для каждого тега
+        # entries - для каждого слова список пар (маска тегов, номер ударной гласной) в исходном порядке
+        self.tag2bit = tag2bit
+        self.entries = entries
+        # Таблица entries может лежать в mmap-файле в виде json (см. accents_mmap.py), поэтому
+        # разобранные варианты и объединенную маску тегов слова запоминаем при первом обращении.
+        self.word_entries = dict()
+        self.word_masks = dict()
+
+    @staticmethod
+    def build(ambiguous_accents):
+        tag2bit = dict()
+        entries = dict()
+        for word, accented2tagsets in ambiguous_accents.items():
+            word_entries = []
+            for accented, tagsets in accented2tagsets.items():
+                stress_pos = get_stress_pos(accented)
+                for tagset in tagsets:
+                    mask = 0
+                    for tag in set(tagset.split('|')):
+                        if tag not in tag2bit:
+                            tag2bit[tag] = len(tag2bit)
+                        mask |= 1 << tag2bit[tag]
+                    word_entries.append((mask, stress_pos))
+            entries[word] = word_entries
+
+        return AmbiguousAccentsIndex(tag2bit, entries)
+
+    def get_tags_mask(self, ud_tags):
+        mask = 0
+        for tag in ud_tags:
+            bit = self.tag2bit.get(tag)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def get_word_entries(self, word):
+        word_entries = self.word_entries.get(word)
+        if word_entries is None:
+            word_entries = [tuple(entry) for entry in self.entries[word]]
+            self.word_entries[word] = word_entries
+        return word_entries
+
+    def get_word_mask(self, word):
+        word_mask = self.word_masks.get(word)
+        if word_mask is None:
+            word_mask = 0
+            for mask, _ in self.get_word_entries(word):
+                word_mask |= mask
+            self.word_masks[word] = word_mask
+        return word_mask
+
+    def get_relevant_mask(self, word, ud_tags):
+        """Теги из ud_tags, которые могут повлиять на выбор ударения для слова, в виде маски"""
+        return self.get_tags_mask(ud_tags) & self.get_word_mask(word)
+
+    def predict(self, word, ud_tags):
+        ud_mask = self.get_tags_mask(ud_tags)
+
+        # как и прежде, при равном числе совпавших тегов побеждает первый по порядку вариант
+        best_entry = None
+        best_matching = 0
+        for entry in self.get_word_entries(word):
+            nb_matched = popcount(entry[0] & ud_mask)
+            if nb_matched > best_matching:
+                best_matching = nb_matched
+                best_entry = entry
+
+        if best_entry is None:
+            return -1
+
+        if best_entry[1] is None:
+            msg = 'Could not predict stress position in word="{}" tags="{}"'.format(word,
+                                                                                    ' '.join(ud_tags) if ud_tags else '[]')
+            raise ValueError(msg)
+
+        return best_entry[1]
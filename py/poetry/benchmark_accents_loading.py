@@ -0,0 +1,84 @@
+"""
+Сравнение времени старта и пиковой памяти для разных форматов словарей ударений.
+
+Каждый вариант запускается в отдельном процессе: загрузка словарей плюс несколько типичных
+обращений к ним (get_accent без обращения к нейросетевой модели). Варианты:
+  legacy - старый accents.pkl с шестью пиклами подряд
+  lazy   - контейнер accents_container.py с ленивой загрузкой секций
+  mmap   - файл accents_mmap.py
+
+Пример:
+    python benchmark_accents_loading.py --legacy ../../tmp/accents.legacy.pkl --lazy ../../tmp/accents.pkl --mmap ../../tmp/accents.mmap
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+CHILD_CODE = r'''
+import sys, time, json, resource
+t0 = time.time()
+from poetry.phonetic import Accents
+t_import = time.time() - t0
+
+mode, path = sys.argv[1], sys.argv[2]
+rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+t0 = time.time()
+accents = Accents()
+if mode == 'mmap':
+    accents.load_mmap(path)
+else:
+    accents.load_pickle(path)
+t_load = time.time() - t0
+
+t0 = time.time()
+for word in 'кошка мама замок ель шёл полынь белый стихотворение'.split():
+    word = accents.yoficate(word)
+    accents.is_oov(word)
+    accents.lookup_accent(word, ['Case=Nom', 'NOUN'])
+t_lookup = time.time() - t0
+
+print(json.dumps({'import': t_import, 'load': t_load, 'lookup': t_lookup,
+                  'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                  'rss_delta_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0) / 1024.0}))
+'''
+
+
+def run_variant(mode, path, repeats):
+    py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = py_dir + os.pathsep + env.get('PYTHONPATH', '')
+
+    results = []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', CHILD_CODE, mode, path], env=env)
+        results.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+
+    # берем лучший прогон, чтобы меньше зависеть от состояния page cache
+    return min(results, key=lambda r: r['load'] + r['lookup'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time and RSS comparison for accents dictionary formats')
+    parser.add_argument('--legacy', type=str, default=None, help='accents.pkl in the old sequential format')
+    parser.add_argument('--lazy', type=str, default=None, help='accents.pkl in the lazy section container format')
+    parser.add_argument('--mmap', type=str, default=None, help='accents.mmap')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    variants = [(mode, path) for mode, path in [('legacy', args.legacy), ('lazy', args.lazy), ('mmap', args.mmap)]
+                if path and os.path.exists(path)]
+    if not variants:
+        print('No dictionary files given')
+        exit(1)
+
+    print('{:<8} {:>10} {:>10} {:>10} {:>12} {:>14}'.format('format', 'import,s', 'load,s', 'lookup,s',
+                                                              'maxrss,MB', 'rss_delta,MB'))
+    for mode, path in variants:
+        r = run_variant(mode, path, args.repeats)
+        print('{:<8} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f} {:>14.1f}'.format(mode, r['import'], r['load'], r['lookup'],
+                                                                             r['maxrss_mb'], r['rss_delta_mb']))
@@ -0,0 +1,118 @@
+import json
+import time
+import atexit
+import logging
+import sqlite3
+import threading
+import collections
+
+
+class LruCache(object):
+    """Ограниченный по размеру кэш с вытеснением давно не использованных элементов и счетчиками попаданий"""
+    def __init__(self, max_size=100000, name='cache'):
+        self.max_size = max_size
+        self.name = name
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats_str(self):
+        return '{}: size={} hits={} misses={} hit_rate={:.3f}'.format(self.name, len(self.items), self.hits,
+                                                                        self.misses, self.get_hit_rate())
+
+
+class PersistentLruCache(LruCache):
+    """
+    LRU-кэш, содержимое которого сохраняется в sqlite-файле: при старте последние max_size записей
+    загружаются из базы, новые записи сбрасываются на диск каждые flush_every вставок
+    или flush_interval секунд, а также при завершении процесса.
+    """
+    def __init__(self, db_path, max_size=100000, flush_every=200, flush_interval=60.0, name='cache'):
+        super().__init__(max_size, name)
+        self.db_path = db_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.dirty = dict()
+        self.last_flush = time.time()
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache_items (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.commit()
+
+        rows = self.conn.execute('SELECT key, value FROM cache_items ORDER BY rowid DESC LIMIT ?',
+                                 (max_size,)).fetchall()
+        for key, value in rows[::-1]:
+            self.items[key] = json.loads(value)
+        logging.info('%d items loaded into %s from "%s"', len(self.items), self.name, db_path)
+
+        atexit.register(self.close)
+
+    def put(self, key, value):
+        with self.lock:
+            super().put(key, value)
+            self.dirty[key] = value
+            if len(self.dirty) >= self.flush_every or time.time() - self.last_flush > self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty and self.conn is not None:
+                # REPLACE перемещает запись в конец таблицы, поэтому порядок rowid соответствует свежести.
+                self.conn.executemany('INSERT OR REPLACE INTO cache_items (key, value) VALUES (?, ?)',
+                                      [(key, json.dumps(value)) for key, value in self.dirty.items()])
+                self.conn.commit()
+                self.dirty.clear()
+            self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.flush()
+                # на диске храним не больше записей, чем помещается в кэш
+                self.conn.execute('DELETE FROM cache_items WHERE rowid NOT IN '
+                                  '(SELECT rowid FROM cache_items ORDER BY rowid DESC LIMIT ?)', (self.max_size,))
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,234 @@
+"""
+Скомпилированные правила нормализации несловарных слов для Accents.lookup_accent.
+
+Инфиксные замены ищутся автоматом Ахо-Корасик, окончания - по таблице суффиксов, продуктивные
+приставки - по префиксному дереву. Кандидаты выдаются в том же порядке, в котором их перебирала
+прежняя реализация, поэтому результат lookup_accent не меняется, а стоимость поиска для
+несловарного слова зависит от длины слова и числа сработавших правил, а не от общего числа правил.
+
+Сверка с прежней реализацией на списке слов:
+    python oov_corrections.py --words words.txt
+"""
+
+import io
+import re
+import argparse
+import collections
+
+
+INFIX_CORRECTIONS = [('тьса', 'тся'),
+                     ('тьса', 'ться'),
+                     ('ться', 'тся'),
+                     ('юцца', 'ются'),
+                     ('цца', 'ться'),
+                     ('юца', 'ются'),
+                     ('шы', 'ши'), ('жы', 'жи'), ('цы', 'ци'), ('щю', 'щу'), ('чю', 'чу'),
+                     ('ща', 'сча'),
+                     ('щя', 'ща'),  # щями
+                     ("чя", "ча"),  # чящя
+                     ("жэ", "же"),  # художэственный
+                     ('цэ', 'це'), ('жо', 'жё'), ('шо', 'шё'), ('чо', 'чё'), ('́чьк', 'чк'),
+                     ('що', 'щё'),  # вощоный
+                     ('щьк', 'щк'),
+                     ('цк', 'тск'),
+                     ('цца', 'тся'),
+                     ('ъе', 'ьё'),  # бъется
+                     ('ье', 'ъе'),  # сьЕли
+                     ('сн', 'стн'),  # грусный
+                     ('цц', 'тц'),  # браццы
+                     ('цц', 'дц'),  # триццать
+                     ('чт', 'чьт'),  # прячте
+                     ('тьн', 'тн'),  # плОтьник
+                     ('зд', 'сд'),  # здачу
+                     ('тса', 'тся'),  # гнУтса
+                     ]
+
+SUFFIX_CORRECTIONS = [('иш', 'ишь'),  # стоиш
+                      ('еш', 'ешь'),  # сможеш
+                      ('еч', 'ечь'),  # сбереч
+                      ('мса', 'мся'),  # встретимса
+                      ]
+
+PRODUCTIVE_PREFIXES = 'спец сверх недо анти полу электро магнито не прото микро макро нано квази само слабо одно двух трех четырех пяти шести семи восьми девяти десяти одиннадцати двенадцати тринадцати четырнадцати пятнадцати шестнадцати семнадцати восемнадцати девятнадцати двадцати тридцами сорока пятидесяти шестидесяти семидесяти восьмидесяти девяносто сто тысяче супер лже мета'.split()
+
+
+def count_vowels(s):
+    return sum((c in 'уеыаоэёяиюaeoy') for c in s.lower())
+
+
+class AhoCorasick(object):
+    """Автомат для поиска всех вхождений набора подстрок за один проход по слову"""
+    def __init__(self, patterns):
+        self.transitions = [dict()]
+        self.outputs = [set()]
+        self.fail = [0]
+
+        for ipattern, pattern in enumerate(patterns):
+            state = 0
+            for c in pattern:
+                next_state = self.transitions[state].get(c)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions.append(dict())
+                    self.outputs.append(set())
+                    self.fail.append(0)
+                    self.transitions[state][c] = next_state
+                state = next_state
+            self.outputs[state].add(ipattern)
+
+        # ссылки неудач строим обходом в ширину
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                f = self.fail[state]
+                while f and c not in self.transitions[f]:
+                    f = self.fail[f]
+                self.fail[next_state] = self.transitions[f].get(c, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+
+    def find_all(self, s):
+        """Вернет множество индексов шаблонов, которые входят в строку s"""
+        found = set()
+        state = 0
+        for c in s:
+            while state and c not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(c, 0)
+            if self.outputs[state]:
+                found |= self.outputs[state]
+        return found
+
+
+class OovCorrector(object):
+    """Правила нормализации несловарных слов, скомпилированные один раз при загрузке"""
+    def __init__(self, vowel_count_fn=count_vowels):
+        self.vowel_count_fn = vowel_count_fn
+        self.infix_automaton = AhoCorasick([pattern for pattern, _ in INFIX_CORRECTIONS])
+
+        self.suffix_rules = collections.defaultdict(list)
+        for irule, (ending, replacement) in enumerate(SUFFIX_CORRECTIONS):
+            self.suffix_rules[ending].append((irule, replacement))
+        self.suffix_lengths = sorted(set(len(ending) for ending in self.suffix_rules))
+
+        # префиксное дерево: узел - словарь переходов, ключ None хранит номера приставок в исходном списке
+        self.prefix_trie = dict()
+        for iprefix, prefix in enumerate(PRODUCTIVE_PREFIXES):
+            node = self.prefix_trie
+            for c in prefix:
+                node = node.setdefault(c, dict())
+            node.setdefault(None, []).append(iprefix)
+        self.prefix_vowels = [vowel_count_fn(prefix) for prefix in PRODUCTIVE_PREFIXES]
+
+    def match_prefixes(self, word):
+        matched = []
+        node = self.prefix_trie
+        for c in word:
+            node = node.get(c)
+            if node is None:
+                break
+            matched.extend(node.get(None, ()))
+        return sorted(matched)
+
+    def candidates(self, word):
+        """
+        Перебирает варианты нормализации слова в порядке приоритета правил.
+        Выдает пары (нормализованное слово, сдвиг), ударение берется как сдвиг плюс словарное
+        ударение нормализованного слова. Пара (None, позиция) означает правило с фиксированным
+        ударением, которое применяется без проверки по словарю.
+        """
+        for irule in sorted(self.infix_automaton.find_all(word)):
+            pattern, replacement = INFIX_CORRECTIONS[irule]
+            yield word.replace(pattern, replacement), 0
+
+        suffix_matches = []
+        for length in self.suffix_lengths:
+            if length > len(word):
+                break
+            for irule, replacement in self.suffix_rules.get(word[-length:], ()):
+                suffix_matches.append((irule, length, replacement))
+        for _, length, replacement in sorted(suffix_matches):
+            yield word[:-length] + replacement, 0
+
+        # убираем финальный "ь" после шипящих
+        if len(word) > 1 and word[-1] == 'ь' and word[-2] in 'чшщ':
+            yield word[:-1], 0
+
+        # повтор согласных сокращаем до одной согласной
+        if len(word) > 1:
+            cn = re.search(r'(.)\1', word, flags=re.I)
+            if cn:
+                c1 = cn.group(1)[0]
+                yield re.sub(c1 + '{2,}', c1, word, flags=re.I), 0
+
+        # Некоторые грамматические формы в русском языке имеют фиксированное ударение.
+        pos1 = word.find('ейш')
+        if pos1 != -1:
+            yield None, self.vowel_count_fn(word[:pos1]) + 1
+            return
+
+        # Есть продуктивные приставки типа АНТИ или НЕ
+        for iprefix in self.match_prefixes(word):
+            word1 = word[len(PRODUCTIVE_PREFIXES[iprefix]):]
+            if len(word1) > 2:
+                yield word1, self.prefix_vowels[iprefix]
+
+
+def legacy_candidates(word, vowel_count_fn=count_vowels):
+    """Прежний линейный перебор правил, оставлен как эталон для сверки"""
+    for m2 in INFIX_CORRECTIONS:
+        if m2[0] in word:
+            yield word.replace(m2[0], m2[1]), 0
+
+    for e1, e2 in SUFFIX_CORRECTIONS:
+        if word.endswith(e1):
+            yield word[:-len(e1)] + e2, 0
+
+    if re.search(r'[чшщ]ь$', word):
+        yield word[:-1], 0
+
+    if len(word) > 1:
+        cn = re.search(r'(.)\1', word, flags=re.I)
+        if cn:
+            c1 = cn.group(1)[0]
+            yield re.sub(c1 + '{2,}', c1, word, flags=re.I), 0
+
+    pos1 = word.find('ейш')
+    if pos1 != -1:
+        yield None, vowel_count_fn(word[:pos1]) + 1
+        return
+
+    for prefix in ' '.join(PRODUCTIVE_PREFIXES).split():
+        if word.startswith(prefix):
+            word1 = word[len(prefix):]
+            if len(word1) > 2:
+                yield word1, vowel_count_fn(prefix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regression check of compiled OOV corrections against the legacy rules')
+    parser.add_argument('--words', type=str, default=None, help='Word list, one word per line')
+    args = parser.parse_args()
+
+    if args.words:
+        with io.open(args.words, 'r', encoding='utf-8') as rdr:
+            words = [line.strip().lower() for line in rdr if line.strip()]
+    else:
+        words = ('встретимса стоиш сможеш сбереч прячте грусный браццы триццать бъется сьели гнутса плотьник здачу '
+                 'художэственный щями вощоный жывёт цыфра умнейший антиматерия недоделка нелюбовь сверхзвуковой '
+                 'стотысячный полусонный дрожь ночь помощь малчик сонный касса суперсила стоиттса одиннадцатиэтажный '
+                 'кошка ёжик мультипликация').split()
+
+    corrector = OovCorrector()
+    nb_mismatches = 0
+    for word in words:
+        expected = list(legacy_candidates(word))
+        actual = list(corrector.candidates(word))
+        if expected != actual:
+            nb_mismatches += 1
+            print('MISMATCH word={} legacy={} compiled={}'.format(word, expected, actual))
+
+    print('words={} mismatches={}'.format(len(words), nb_mismatches))
+    if nb_mismatches:
+        exit(1)
@@ -1,207 +1,60 @@
-import json
-import yaml
 import pickle
-import os
-import io
-import codecs
 import logging
 import re
+import functools
 from nltk.stem.snowball import RussianStemmer
-from transcriptor_models.stress_model import StressModel
+from transcriptor_models.stress_model import load_stress_model
 from transcriptor_models.rusyllab import split_word
+from poetry.lru_cache import LruCache, PersistentLruCache
+from poetry.accents_mmap import open_accents_mmap, MmapPairSet
+from poetry.oov_corrections import OovCorrector
+from poetry.ambiguous_index import AmbiguousAccentsIndex
+from poetry.accents_builder import build_accents
+from poetry.accents_container import LazySection, is_container, save_container, load_container_lazy
 
 
 class Accents:
+    # Словари, которые из контейнера accents.pkl загружаются при первом обращении
+    ambiguous_accents = LazySection('ambiguous_accents')
+    ambiguous_accents2 = LazySection('ambiguous_accents2')
+    word_accents_dict = LazySection('word_accents_dict')
+    yo_words = LazySection('yo_words')
+    rhymed_words = LazySection('rhymed_words')
+    rhyming_dict = LazySection('rhyming_dict')
+    ambiguous_index = LazySection('ambiguous_index')
+
     def __init__(self):
         self.ambiguous_accents = None
         self.ambiguous_accents2 = None
+        self.ambiguous_index = None
         self.word_accents_dict = None
         self.yo_words = None
         self.rhymed_words = set()
         self.allow_rifmovnik = False
+        self.precomputed_accents = dict()
+        # Мемоизация get_accent: ключ - нормализованное слово плюс значимые для него UD-теги
+        self.accent_memo = LruCache(max_size=200000, name='accent_memo')
+        self.accent_memo_log_every = 100000
+        self.oov_corrector = OovCorrector(functools.partial(self.get_vowel_count, abbrevs=False))
 
     def sanitize_word(self, word):
         return word.lower()
 
-    def load(self, data_dir, all_words):
-        # Рифмовник для нечеткой рифмы
-        with open(os.path.join(data_dir, 'rifmovnik.small.upgraded.json'), 'r') as f:
-            rhyming_data = json.load(f)
-            self.rhyming_dict = dict(
-                (key, values) for key, values in rhyming_data['dictionary'].items() if len(values) > 0)
-
-        # пары слов, который будем считать рифмующимися
-        with io.open(os.path.join(data_dir, 'rhymed_words.txt'), 'r', encoding='utf-8') as rdr:
-            for line in rdr:
-                s = line.strip()
-                if s and not s.startswith('#'):
-                    i = s.index(' ')
-                    word1 = s[:i].strip()
-                    word2 = s[i + 1:].strip()
-                    self.rhymed_words.add((word1, word2))
-
-        # однозначаная ёфикация
-        path = os.path.join(data_dir, 'solarix_yo.txt')
-        logging.info('Loading words with ё from "%s"', path)
-        self.yo_words = dict()
-        with io.open(path, 'r', encoding='utf-8') as rdr:
-            for line in rdr:
-                word = line.strip().lower()
-                key = word.replace('ё', 'е')
-                self.yo_words[key] = word
-
-        path = os.path.join(data_dir, 'ambiguous_accents.yaml')
-        logging.info('Loading ambiguous accents information from "%s"', path)
-        d = yaml.safe_load(io.open(path, 'r', encoding='utf-8').read())
-
-        d2 = dict()
-        for entry_name, entry_data in d.items():
-            entry_data2 = dict()
-            for form, tagsets in entry_data.items():
-                tagsets2 = []
-                for tagset in tagsets:
-                    if 'Case=Every' in tagset:
-                        for case in ['Nom', 'Gen', 'Ins', 'Acc', 'Dat', 'Loc']:
-                            tagset2 = tagset.replace('Case=Every', 'Case={}'.format(case))
-                            tagsets2.append(tagset2)
-                    else:
-                        tagsets2.append(tagset)
-
-                entry_data2[form] = tagsets2
-
-            d2[entry_name] = entry_data2
-
-        self.ambiguous_accents = d2
-
-        for word, wdata in self.ambiguous_accents.items():
-            for stressed_form, tagsets in wdata.items():
-                if not any((c in 'АЕЁИОУЫЭЮЯ') for c in stressed_form):
-                    print('Missing stressed vowel in "ambiguous_accents.yaml" for word={}'.format(word))
-                    exit(0)
-
-        logging.info('%d items in ambiguous_accents', len(self.ambiguous_accents))
-
-        self.ambiguous_accents2 = yaml.safe_load(
-            io.open(os.path.join(data_dir, 'ambiguous_accents_2.yaml'), 'r', encoding='utf-8').read())
-
-        self.word_accents_dict = dict()
-
-        if True:
-            path = os.path.join(data_dir, 'single_accent.dat')
-            logging.info('Loading stress information from "%s"', path)
-            with io.open(path, 'r', encoding='utf-8') as rdr:
-                for line in rdr:
-                    tx = line.split('\t')
-                    if len(tx) == 2:
-                        word, accent = tx[0], tx[1]
-                        n_vowels = 0
-                        for c in accent:
-                            if c.lower() in 'уеыаоэёяию':
-                                n_vowels += 1
-                                if c.isupper():
-                                    stress = n_vowels
-                                    self.word_accents_dict[word.lower()] = stress
-                                    break
-
-        if True:
-            path2 = os.path.join(data_dir, 'accents.txt')
-            logging.info('Loading stress information from "%s"', path2)
-            with codecs.open(path2, 'r', 'utf-8') as rdr:
-                for line in rdr:
-                    tx = line.strip().split('#')
-                    if len(tx) == 2:
-                        forms = tx[1].split(',')
-                        for form in forms:
-                            word = self.sanitize_word(form.replace('\'', '').replace('`', ''))
-                            if all_words is None or word in all_words:
-                                if '\'' in form:
-                                    accent_pos = form.index('\'')
-                                    nb_vowels_before = self.get_vowel_count(form[:accent_pos], abbrevs=False)
-                                    if word not in self.word_accents_dict:
-                                        self.word_accents_dict[word] = nb_vowels_before
-                                elif 'ё' in form:
-                                    accent_pos = form.index('ё')
-                                    nb_vowels_before = self.get_vowel_count(form[:accent_pos], abbrevs=False) + 1
-                                    if word not in self.word_accents_dict:
-                                        self.word_accents_dict[word] = nb_vowels_before
-
-        if True:
-            stress_char = '́'
-            stress2_char = '̀'
-            p3 = os.path.join(data_dir, 'ruwiktionary-accents.txt')
-            logging.info('Loading stress information from "%s"', p3)
-            with codecs.open(p3, 'r', 'utf-8') as rdr:
-                for iline, line in enumerate(rdr):
-                    word = line.strip()
-                    if '-' not in word:
-                        nword = word.replace(stress_char, '').replace('\'', '').replace('ѝ', 'и').replace('ѐ',
-                                                                                                          'е').replace(
-                            stress2_char, '').lower()
-                        if len(nword) > 2:
-                            if stress_char in word:
-                                accent_pos = word.index(stress_char)
-                                nb_vowels_before = self.get_vowel_count(word[:accent_pos], abbrevs=False)
-                                if nword not in self.word_accents_dict:
-                                    self.word_accents_dict[nword] = nb_vowels_before
-                            elif '\'' in word:
-                                accent_pos = word.index('\'')
-                                nb_vowels_before = self.get_vowel_count(word[:accent_pos], abbrevs=False)
-                                if nword not in self.word_accents_dict:
-                                    self.word_accents_dict[nword] = nb_vowels_before
-                            elif 'ё' in word:
-                                accent_pos = word.index('ё')
-                                nb_vowels_before = self.get_vowel_count(word[:accent_pos], abbrevs=False)
-                                stress_pos = nb_vowels_before + 1
-                                if nword not in self.word_accents_dict:
-                                    self.word_accents_dict[nword] = stress_pos
-
-        if True:
-            path = os.path.join(data_dir, 'words_accent.json')
-            logging.info('Loading stress information from "%s"', path)
-            d = json.loads(open(path).read())
-            for word, a in d.items():
-                if '-' not in word:
-                    nword = self.sanitize_word(word)
-                    if nword not in self.word_accents_dict:
-                        self.word_accents_dict[nword] = a
-
-        true_accent_entries = dict()
-        with io.open(os.path.join(data_dir, 'true_accents.txt'), 'r', encoding='utf-8') as rdr:
-            for line in rdr:
-                word = line.strip()
-                if word:
-                    nword = self.sanitize_word(word)
-                    if nword in self.ambiguous_accents:
-                        del self.ambiguous_accents[nword]
-                    m = re.search('([АЕЁИОУЭЮЯЫ])', word)
-                    if m is None:
-                        logging.error('Invalid item "%s" in "true_accents.txt"', word)
-                        exit(0)
-
-                    accent_char = m.groups(0)[0]
-                    accent_pos = word.index(accent_char)
-                    nb_vowels_before = self.get_vowel_count(word[:accent_pos], abbrevs=False) + 1
-                    if nword in true_accent_entries and true_accent_entries[nword] != word:
-                        logging.error(
-                            'Controversial redefenition of stress position for word "%s" in "true_accents.txt": %s and %s',
-                            nword, true_accent_entries[nword], word)
-                        exit(0)
-
-                    self.word_accents_dict[nword] = nb_vowels_before
-                    true_accent_entries[nword] = word
-
-        logging.info('%d items in word_accents_dict', len(self.word_accents_dict))
+    def load(self, data_dir, all_words, nb_workers=1, cache_dir=None):
+        # Сборка словарей из исходных файлов, см. accents_builder.py
+        build_accents(self, data_dir, all_words, nb_workers=nb_workers, cache_dir=cache_dir)
 
     def save_pickle(self, path):
-        with open(path, 'wb') as f:
-            pickle.dump(self.ambiguous_accents, f)
-            pickle.dump(self.ambiguous_accents2, f)
-            pickle.dump(self.word_accents_dict, f)
-            pickle.dump(self.yo_words, f)
-            pickle.dump(self.rhymed_words, f)
-            pickle.dump(self.rhyming_dict, f)
+        self.get_ambiguous_index()
+        save_container(self, path)
 
     def load_pickle(self, path):
+        if is_container(path):
+            # секции будут десериализованы при первом обращении к ним
+            load_container_lazy(self, path)
+            return
+
+        # старый формат: шесть объектов, записанных друг за другом
         with open(path, 'rb') as f:
             self.ambiguous_accents = pickle.load(f)
             self.ambiguous_accents2 = pickle.load(f)
@@ -209,11 +62,45 @@ class Accents:
             self.yo_words = pickle.load(f)
             self.rhymed_words = pickle.load(f)
             self.rhyming_dict = pickle.load(f)
+        self.ambiguous_index = None
+
+    def load_mmap(self, path):
+        # Словари в формате accents_mmap.py читаются прямо из отображенного в память файла,
+        # так что рабочие процессы разделяют одну копию в page cache.
+        self.mmap_file, tables = open_accents_mmap(path)
+        self.ambiguous_accents = tables['ambiguous_accents']
+        self.ambiguous_accents2 = tables['ambiguous_accents2']
+        self.word_accents_dict = tables['word_accents_dict']
+        self.yo_words = tables['yo_words']
+        self.rhymed_words = MmapPairSet(tables['rhymed_words'])
+        self.rhyming_dict = tables['rhyming_dict']
+        if 'ambiguous_index' in tables:
+            # небольшой словарь тегов читаем целиком, чтобы не разбирать json при каждом обращении к тегу
+            self.ambiguous_index = AmbiguousAccentsIndex(dict(tables['ambiguous_tags']), tables['ambiguous_index'])
+        else:
+            self.ambiguous_index = None
+        logging.info('%d items in word_accents_dict (mmap "%s")', len(self.word_accents_dict), path)
 
-    def after_loading(self, stress_model_dir):
+    def load_precomputed_accents(self, path):
+        # Таблица ударений для несловарных словоформ, рассчитанная заранее скриптом precompute_accents.py
+        with open(path, 'rb') as f:
+            self.precomputed_accents = pickle.load(f)
+        logging.info('%d items in precomputed_accents', len(self.precomputed_accents))
+
+    def after_loading(self, stress_model_dir, stress_backend='auto', predicted_accents_cache_size=100000,
+                      predicted_accents_db=None):
         self.stemmer = RussianStemmer()
-        self.stress_model = StressModel(stress_model_dir)
-        self.predicted_accents = dict()
+        # словари могли смениться после первых обращений к get_accent
+        self.accent_memo.clear()
+        # stress_backend='numpy' позволяет обойтись без импорта tensorflow в рабочих процессах
+        self.stress_model = load_stress_model(stress_model_dir, stress_backend)
+
+        # Кэш ударений, предсказанных нейросетевой моделью. Если задан путь к базе, то кэш переживает перезапуски.
+        if predicted_accents_db:
+            self.predicted_accents = PersistentLruCache(predicted_accents_db, max_size=predicted_accents_cache_size,
+                                                        name='predicted_accents')
+        else:
+            self.predicted_accents = LruCache(max_size=predicted_accents_cache_size, name='predicted_accents')
 
     def conson(self, c1):
         # Оглушение согласной
@@ -345,31 +232,14 @@ class Accents:
     def is_oov(self, word):
         return 'ё' not in word and word not in self.word_accents_dict and word not in self.ambiguous_accents and word not in self.ambiguous_accents2
 
-    def predict_ambiguous_accent(self, word, ud_tags):
-        best_accented = None
-        best_matching = 0
-        ud_tagset = set(ud_tags)
-        for accented, tagsets in self.ambiguous_accents[word].items():
-            for tagset in tagsets:
-                tx = set(tagset.split('|'))
-                nb_matched = len(ud_tagset.intersection(tx))
-                if nb_matched > best_matching:
-                    best_matching = nb_matched
-                    best_accented = accented
-
-        if best_accented is None:
-            return -1
+    def get_ambiguous_index(self):
+        # Разобранные наборы тегов омографов; если их нет в загруженном файле, строим при первом обращении
+        if self.ambiguous_index is None and self.ambiguous_accents:
+            self.ambiguous_index = AmbiguousAccentsIndex.build(self.ambiguous_accents)
+        return self.ambiguous_index
 
-        n_vowels = 0
-        for c in best_accented:
-            if c.lower() in 'уеыаоэёяию':
-                n_vowels += 1
-                if c.isupper():
-                    return n_vowels
-
-        msg = 'Could not predict stress position in word="{}" tags="{}"'.format(word,
-                                                                                ' '.join(ud_tags) if ud_tags else '[]')
-        raise ValueError(msg)
+    def predict_ambiguous_accent(self, word, ud_tags):
+        return self.get_ambiguous_index().predict(word, ud_tags)
 
     def predict_stressed_charpos(self, word):
         """ Вернет индекс ударной буквы"""
@@ -392,12 +262,18 @@ class Accents:
         return i
 
     def predict_stress(self, word):
-        if word in self.predicted_accents:
-            return self.predicted_accents[word]
+        # Заранее рассчитанные ударения и аббревиатуры в predicted_accents не попадают, поэтому проверяем
+        # их до обращения к кэшу: иначе они считались бы промахами и занижали hit rate.
+        if word in self.precomputed_accents:
+            return self.precomputed_accents[word]
 
         if re.match(r'^[бвгджзклмнпрстфхцчшщ]{2,}$', word):
             return len(word)
 
+        accent = self.predicted_accents.get(word)
+        if accent is not None:
+            return accent
+
         i = self.stress_model.predict(word)
         # получили индекс символа с ударением.
         # нам надо посчитать гласные слева (включая ударную).
@@ -406,6 +282,19 @@ class Accents:
         self.predicted_accents[word] = accent
         return accent
 
+    def predict_stress_batch(self, words):
+        """Прогоняет через нейросетевую модель сразу все слова, которых еще нет в predicted_accents"""
+        oov_words = [word for word in dict.fromkeys(words)
+                     if word not in self.predicted_accents and word not in self.precomputed_accents
+                     and not re.match(r'^[бвгджзклмнпрстфхцчшщ]{2,}$', word)]
+
+        if oov_words:
+            for word, i in zip(oov_words, self.stress_model.predict_batch(oov_words)):
+                nprev = self.get_vowel_count(word[:i], abbrevs=False)
+                self.predicted_accents[word] = nprev + 1
+
+        return [self.predict_stress(word) for word in words]
+
     def get_accent0(self, word0, ud_tags=None):
         word = self.yoficate(self.sanitize_word(word0))
         if 'ё' in word:
@@ -425,10 +314,69 @@ class Accents:
 
         return self.predict_stress(word)
 
+    def get_accent_memo_key(self, word, ud_tags):
+        # Теги влияют на результат только для слов с неоднозначным ударением, причем
+        # учитываются лишь теги, встречающиеся в описании вариантов этого слова.
+        if not ud_tags or not self.ambiguous_accents or word not in self.ambiguous_accents:
+            return word, None
+
+        return word, self.get_ambiguous_index().get_relevant_mask(word, ud_tags)
+
+    def log_accent_memo_stats(self):
+        if (self.accent_memo.hits + self.accent_memo.misses) % self.accent_memo_log_every == 0:
+            logging.info('%s', self.accent_memo.get_stats_str())
+
     def get_accent(self, word0, ud_tags=None):
-        word = self.sanitize_word(word0)
-        word = self.yoficate(word)
+        word = self.yoficate(self.sanitize_word(word0))
+        key = self.get_accent_memo_key(word, ud_tags)
+        accent = self.accent_memo.get(key)
+        self.log_accent_memo_stats()
+        if accent is None:
+            accent = self.lookup_accent(word, ud_tags)
+            if accent is None:
+                accent = self.predict_stress(word)
+            self.accent_memo[key] = accent
+        return accent
 
+    def get_accents_batch(self, words, tags=None):
+        """
+        Аналог get_accent для всех слов строки или стиха: слова, которых нет в словарях,
+        обрабатываются нейросетевой моделью за один вызов.
+        """
+        if tags is None:
+            tags = [None] * len(words)
+
+        accents = []
+        oov_words = []
+        for word0, ud_tags in zip(words, tags):
+            word = self.yoficate(self.sanitize_word(word0))
+            key = self.get_accent_memo_key(word, ud_tags)
+            accent = self.accent_memo.get(key)
+            self.log_accent_memo_stats()
+            if accent is None:
+                accent = self.lookup_accent(word, ud_tags)
+                if accent is None:
+                    oov_words.append(word)
+                else:
+                    self.accent_memo[key] = accent
+            accents.append((word, key, accent))
+
+        if oov_words:
+            self.predict_stress_batch(oov_words)
+
+        result = []
+        for word, key, accent in accents:
+            if accent is None:
+                accent = self.predict_stress(word)
+                self.accent_memo[key] = accent
+            result.append(accent)
+        return result
+
+    def lookup_accent(self, word, ud_tags=None):
+        """
+        Определение ударения по словарям и правилам для уже нормализованного слова.
+        Вернет None, если слово придется отдавать нейросетевой модели.
+        """
         vowel_count = self.get_vowel_count(word)
         if vowel_count == 1:
             # Для слов, содержащих единственную гласную, сразу возвращаем позицию ударения на этой гласной
@@ -452,82 +400,13 @@ class Accents:
         if word in self.word_accents_dict:
             return self.word_accents_dict[word]
 
-        corrections = [('тьса', 'тся'),
-                       ('тьса', 'ться'),
-                       ('ться', 'тся'),
-                       ('юцца', 'ются'),
-                       ('цца', 'ться'),
-                       ('юца', 'ются'),
-                       ('шы', 'ши'), ('жы', 'жи'), ('цы', 'ци'), ('щю', 'щу'), ('чю', 'чу'),
-                       ('ща', 'сча'),
-                       ('щя', 'ща'),  # щями
-                       ("чя", "ча"),  # чящя
-                       ("жэ", "же"),  # художэственный
-                       ('цэ', 'це'), ('жо', 'жё'), ('шо', 'шё'), ('чо', 'чё'), ('́чьк', 'чк'),
-                       ('що', 'щё'),  # вощоный
-                       ('щьк', 'щк'),
-                       ('цк', 'тск'),
-                       ('цца', 'тся'),
-                       ('ъе', 'ьё'),  # бъется
-                       ('ье', 'ъе'),  # сьЕли
-                       ('сн', 'стн'),  # грусный
-                       ('цц', 'тц'),  # браццы
-                       ('цц', 'дц'),  # триццать
-                       ('чт', 'чьт'),  # прячте
-                       ('тьн', 'тн'),  # плОтьник
-                       ('зд', 'сд'),  # здачу
-                       ('тса', 'тся'),  # гнУтса
-                       ]
-
-        for m2 in corrections:
-            if m2[0] in word:
-                word2 = word.replace(m2[0], m2[1])
-                if word2 in self.word_accents_dict:
-                    return self.word_accents_dict[word2]
-
-        # восстанавливаем мягкий знак в "стоиш" "сможеш"  "сбереч"
-        # встретимса
-        #        ^^^
-        e_corrections = [('иш', 'ишь'),  # стоиш
-                         ('еш', 'ешь'),  # сможеш
-                         ('еч', 'ечь'),  # сбереч
-                         ('мса', 'мся'),  # встретимса
-                         ]
-        for e1, e2 in e_corrections:
-            if word.endswith(e1):
-                word2 = word[:-len(e1)] + e2
-                if word2 in self.word_accents_dict:
-                    return self.word_accents_dict[word2]
-
-        # убираем финальный "ь" после шипящих
-        if re.search(r'[чшщ]ь$', word):
-            word2 = word[:-1]
+        # Правила нормализации несловарных слов (опечатки, окончания, продуктивные приставки)
+        for word2, shift in self.oov_corrector.candidates(word):
+            if word2 is None:
+                # грамматическая форма с фиксированным ударением
+                return shift
             if word2 in self.word_accents_dict:
-                return self.word_accents_dict[word2]
-
-        # повтор согласных сокращаем до одной согласной
-        if len(word) > 1:
-            cn = re.search(r'(.)\1', word, flags=re.I)
-            if cn:
-                c1 = cn.group(1)[0]
-                word2 = re.sub(c1 + '{2,}', c1, word, flags=re.I)
-                if word2 in self.word_accents_dict:
-                    return self.word_accents_dict[word2]
-
-        # Некоторые грамматические формы в русском языке имеют
-        # фиксированное ударение.
-        pos1 = word.find('ейш')
-        if pos1 != -1:
-            stress_pos = self.get_vowel_count(word[:pos1], abbrevs=False) + 1
-            return stress_pos
-
-        # Есть продуктивные приставки типа АНТИ или НЕ
-        for prefix in 'спец сверх недо анти полу электро магнито не прото микро макро нано квази само слабо одно двух трех четырех пяти шести семи восьми девяти десяти одиннадцати двенадцати тринадцати четырнадцати пятнадцати шестнадцати семнадцати восемнадцати девятнадцати двадцати тридцами сорока пятидесяти шестидесяти семидесяти восьмидесяти девяносто сто тысяче супер лже мета'.split():
-            if word.startswith(prefix):
-                word1 = word[len(prefix):]
-                if len(word1) > 2:
-                    if word1 in self.word_accents_dict:
-                        return self.get_vowel_count(prefix, abbrevs=False) + self.word_accents_dict[word1]
+                return shift + self.word_accents_dict[word2]
 
         if vowel_count == 0:
             # знаки препинания и т.д., в которых нет ни одной гласной.
@@ -538,10 +417,7 @@ class Accents:
             if word1 in self.word_accents_dict:
                 return self.word_accents_dict[word1]
 
-        if True:
-            return self.predict_stress(word)
-
-        return (vowel_count + 1) // 2
+        return None
 
     def get_phoneme(self, word):
         word = self.sanitize_word(word)
@@ -882,9 +758,11 @@ def rhymed2(accentuator, word1, stress1, ud_tags1, unstressed_prefix1, unstresse
     # смещение ударной гласной от конца слова должно быть одно и то же
     # для проверяемых слов.
     if pos1 == pos2:
-        # Особо рассматриваем рифмовку с местоимением "я":
+        # Особо рассматриваем рифмовку с местоимением "я" (в любом порядке слов):
         if word2 == 'я' and len(word1) > 1 and word1[-2] in 'аеёиоуэюяь' and word1[-1] == 'я':
             return True
+        if word1 == 'я' and len(word2) > 1 and word2[-2] in 'аеёиоуэюяь' and word2[-1] == 'я':
+            return True
 
         # Получаем клаузулы - все буквы, начиная с ударной гласной
         ending1 = extract_ending_prononciation_after_stress(accentuator, word1, stress1, ud_tags1, unstressed_prefix1,
@@ -1099,12 +977,13 @@ def rhymed_fuzzy2(accentuator, word1, stress1, ud_tags1, unstressed_prefix1, uns
     if accentuator.allow_rifmovnik and len(word1) >= 2 and len(word2) >= 2:
         eword1, keys1 = extract_ekeys(word1, stress1)
         eword2, keys2 = extract_ekeys(word2, stress2)
-        for key1 in keys1:
-            if key1 in accentuator.rhyming_dict:
-                for key2 in keys2:
-                    if key2 in accentuator.rhyming_dict[key1]:
-                        # print('\nDEBUG@1006 for word word1="{}" word2="{}"\n'.format(word1, word2))
-                        return True
+        # Рифмовник может быть несимметричным, поэтому смотрим в обе стороны.
+        for keys_a, keys_b in [(keys1, keys2), (keys2, keys1)]:
+            for key1 in keys_a:
+                if key1 in accentuator.rhyming_dict:
+                    for key2 in keys_b:
+                        if key2 in accentuator.rhyming_dict[key1]:
+                            return True
 
     return False
 
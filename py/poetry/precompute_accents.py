@@ -0,0 +1,164 @@
+"""
+Офлайн-расчет ударений для несловарных словоформ.
+
+Словоформы собираются из словаря GPT-модели, текстовых корпусов и логов генерации, прогоняются
+через нейросетевую модель ударений большими пакетами в нескольких процессах, а результат
+сохраняется в precomputed_accents.pkl рядом с accents.pkl. В рантайме Accents.predict_stress
+берет ударение из этой таблицы, и нейросетевая модель остается только последним резервом.
+"""
+
+import os
+import io
+import re
+import time
+import pickle
+import logging
+import argparse
+import collections
+import multiprocessing
+
+from poetry.phonetic import Accents
+from transcriptor_models.stress_model import load_stress_model
+
+
+worker_stress_model = None
+
+
+def init_worker(stress_model_dir, stress_backend):
+    global worker_stress_model
+    worker_stress_model = load_stress_model(stress_model_dir, stress_backend)
+
+
+def predict_chunk(words):
+    return list(zip(words, worker_stress_model.predict_batch(words)))
+
+
+def extract_words(text):
+    return re.findall(r'[а-яё]+', text.lower())
+
+
+def read_vocab_forms(vocab_path):
+    """Токены словаря GPT-модели: слоги и целые короткие слова с разметкой ударения"""
+    forms = collections.Counter()
+    with io.open(vocab_path, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            token = line.strip().replace('\u0301', '')
+            if token.startswith('##') or (token.startswith('<') and token.endswith('>')):
+                continue
+            for word in extract_words(token):
+                forms[word] += 1
+    return forms
+
+
+def read_text_forms(paths):
+    forms = collections.Counter()
+    for path in paths:
+        logging.info('Collecting word forms from "%s"', path)
+        with io.open(path, 'r', encoding='utf-8', errors='ignore') as rdr:
+            for line in rdr:
+                forms.update(extract_words(line.replace('\u0301', '')))
+    return forms
+
+
+def precompute(accents, forms, stress_model_dir, stress_backend, nb_workers, batch_size):
+    """Вернет таблицу слово => номер ударной гласной для всех словоформ, которые ушли бы в нейросетевую модель"""
+    oov_words = []
+    for word0 in forms:
+        word = accents.yoficate(accents.sanitize_word(word0))
+        if accents.lookup_accent(word) is None and not re.match(r'^[бвгджзклмнпрстфхцчшщ]{2,}$', word):
+            oov_words.append(word)
+
+    oov_words = sorted(set(oov_words))
+    logging.info('%d word forms will be processed by the stress model', len(oov_words))
+
+    chunks = [oov_words[i:i + batch_size] for i in range(0, len(oov_words), batch_size)]
+    table = dict()
+    t0 = time.time()
+    with multiprocessing.Pool(nb_workers, initializer=init_worker, initargs=(stress_model_dir, stress_backend)) as pool:
+        for ichunk, chunk_result in enumerate(pool.imap_unordered(predict_chunk, chunks), start=1):
+            for word, i in chunk_result:
+                # переводим индекс ударной буквы в номер ударной гласной, как в Accents.predict_stress
+                table[word] = accents.get_vowel_count(word[:i], abbrevs=False) + 1
+            if ichunk % 10 == 0:
+                logging.info('%d/%d chunks processed', ichunk, len(chunks))
+
+    logging.info('Stress model processed %d words in %.1f sec', len(table), time.time() - t0)
+    return table
+
+
+def report_coverage(accents, table, forms, title):
+    """Сколько обращений к нейросетевой модели снимает таблица для данного набора словоформ"""
+    nb_types = 0
+    nb_tokens = 0
+    oov_types = 0
+    oov_tokens = 0
+    covered_types = 0
+    covered_tokens = 0
+    for word0, freq in forms.items():
+        word = accents.yoficate(accents.sanitize_word(word0))
+        nb_types += 1
+        nb_tokens += freq
+        if accents.lookup_accent(word) is None and not re.match(r'^[бвгджзклмнпрстфхцчшщ]{2,}$', word):
+            oov_types += 1
+            oov_tokens += freq
+            if word in table:
+                covered_types += 1
+                covered_tokens += freq
+
+    logging.info('Coverage for %s: %d forms (%d tokens), model fallback needed for %d forms (%d tokens), '
+                 'precomputed table covers %d forms (%d tokens, %.1f%% of runtime model calls)',
+                 title, nb_types, nb_tokens, oov_types, oov_tokens, covered_types, covered_tokens,
+                 100.0 * covered_tokens / max(1, oov_tokens))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline stress precomputation for OOV word forms')
+    parser.add_argument('--tmp_dir', type=str, default='../../tmp')
+    parser.add_argument('--models_dir', type=str, default='../../models')
+    parser.add_argument('--gpt_name', type=str, default='stressed_long_poetry_generator_medium')
+    parser.add_argument('--corpus', type=str, nargs='*', default=[], help='Plain text corpora')
+    parser.add_argument('--generation_log', type=str, nargs='*', default=[], help='Logs of past generations')
+    parser.add_argument('--no_vocab', action='store_true', help='Do not use the GPT vocabulary as a source')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--stress_backend', type=str, default='auto', choices='auto keras numpy'.split())
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() - 1))
+    parser.add_argument('--batch_size', type=int, default=4096)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    tmp_dir = os.path.expanduser(args.tmp_dir)
+    output_path = args.output or os.path.join(tmp_dir, 'precomputed_accents.pkl')
+
+    accents = Accents()
+    accents.load_pickle(os.path.join(tmp_dir, 'accents.pkl'))
+
+    sources = []
+    if not args.no_vocab:
+        vocab_path = os.path.join(os.path.expanduser(args.models_dir), args.gpt_name, 'vocab.txt')
+        sources.append(('GPT vocabulary', read_vocab_forms(vocab_path)))
+    if args.corpus:
+        sources.append(('corpus', read_text_forms(args.corpus)))
+    if args.generation_log:
+        sources.append(('generation logs', read_text_forms(args.generation_log)))
+
+    all_forms = collections.Counter()
+    for _, forms in sources:
+        all_forms.update(forms)
+
+    table = dict()
+    if os.path.exists(output_path):
+        with open(output_path, 'rb') as f:
+            table = pickle.load(f)
+        logging.info('%d items loaded from existing "%s"', len(table), output_path)
+
+    new_forms = collections.Counter({w: f for w, f in all_forms.items() if w not in table})
+    table.update(precompute(accents, new_forms, os.path.join(tmp_dir, 'stress_model'), args.stress_backend,
+                            args.workers, args.batch_size))
+
+    with open(output_path, 'wb') as f:
+        pickle.dump(table, f)
+    logging.info('%d items stored in "%s"', len(table), output_path)
+
+    for title, forms in sources:
+        report_coverage(accents, table, forms, title)
@@ -1,37 +1,188 @@
 import os
+import io
 import json
 import pathlib
+import logging
+import argparse
 
 import numpy as np
-import keras
 
 
-class StressModel:
-    def __init__(self, model_dir):
-        if model_dir is None:
-            model_dir = str(pathlib.Path(__file__).resolve().parent)
+def get_stress_model_path(model_dir, filename):
+    if model_dir is None:
+        model_dir = str(pathlib.Path(__file__).resolve().parent)
+    return os.path.join(model_dir, '../stress_model', filename)
+
 
-        with open(os.path.join(model_dir, '../stress_model/nn_stress.cfg'), 'r') as f:
+class BaseStressModel:
+    """Общая часть бэкендов модели ударений: конфиг и векторизация слов"""
+    def __init__(self, model_dir):
+        with open(get_stress_model_path(model_dir, 'nn_stress.cfg'), 'r') as f:
             cfg = json.load(f)
             self.max_len = cfg['max_len']
             self.char2index = cfg['char2index']
 
-        self.model = keras.models.load_model(os.path.join(model_dir, '../stress_model/nn_stress.model'))
         self.X = np.zeros((1, self.max_len), dtype=np.int32)
 
-    def predict(self, word):
-        self.X.fill(0)
+    def vectorize_word(self, word, X, irow):
         for ich, c in enumerate(word.lower()[:self.max_len]):
             if c in self.char2index:
-                self.X[0, ich] = self.char2index[c]
-        y = self.model.predict({'input': self.X}, verbose=0)
+                X[irow, ich] = self.char2index[c]
+
+    def run_model(self, X, batch_size):
+        raise NotImplementedError()
+
+    def predict(self, word):
+        self.X.fill(0)
+        self.vectorize_word(word, self.X, 0)
+        y = self.run_model(self.X, batch_size=1)
         stress_pos = np.argmax(y, axis=-1)[0]
         return stress_pos
 
+    def predict_batch(self, words, batch_size=256):
+        """Вернет индексы ударных букв для списка слов, прогоняя через модель одну матрицу"""
+        if len(words) == 0:
+            return []
+
+        X = np.zeros((len(words), self.max_len), dtype=np.int32)
+        for irow, word in enumerate(words):
+            self.vectorize_word(word, X, irow)
+
+        y = self.run_model(X, batch_size=batch_size)
+        return np.argmax(y, axis=-1).tolist()
+
+
+class StressModel(BaseStressModel):
+    """Исходная модель ударений на keras/tensorflow"""
+    def __init__(self, model_dir):
+        super().__init__(model_dir)
+
+        # tensorflow грузим только для этого бэкенда, чтобы процессы с numpy-бэкендом его не импортировали.
+        import keras
+        self.model = keras.models.load_model(get_stress_model_path(model_dir, 'nn_stress.model'))
+
+    def run_model(self, X, batch_size):
+        return self.model.predict({'input': X}, batch_size=batch_size, verbose=0)
+
+    def export_npz(self, npz_path):
+        """Сохраняет веса сетки Embedding -> Flatten -> Dense(relu) -> Dense(softmax) в npz-файл"""
+        embeddings = None
+        dense_layers = []
+        for layer in self.model.layers:
+            layer_class = layer.__class__.__name__
+            if layer_class == 'Embedding':
+                embeddings = layer.get_weights()[0]
+            elif layer_class == 'Dense':
+                dense_layers.append(layer.get_weights())
+            elif layer_class not in ('InputLayer', 'Flatten'):
+                raise NotImplementedError('Unsupported layer "{}" in stress model'.format(layer_class))
+
+        if embeddings is None or len(dense_layers) != 2:
+            raise RuntimeError('Unexpected stress model architecture')
+
+        (w1, b1), (w2, b2) = dense_layers
+        np.savez_compressed(npz_path,
+                            embeddings=embeddings.astype(np.float32),
+                            w1=w1.astype(np.float32), b1=b1.astype(np.float32),
+                            w2=w2.astype(np.float32), b2=b2.astype(np.float32))
+        logging.info('Stress model weights exported to "%s"', npz_path)
+
+
+class NumpyStressModel(BaseStressModel):
+    """Та же сетка, но инференс на чистом numpy по весам, выгруженным через StressModel.export_npz"""
+    def __init__(self, model_dir):
+        super().__init__(model_dir)
+
+        with np.load(get_stress_model_path(model_dir, 'nn_stress.npz')) as data:
+            self.embeddings = data['embeddings']
+            self.w1 = data['w1']
+            self.b1 = data['b1']
+            self.w2 = data['w2']
+            self.b2 = data['b2']
+
+    def run_model(self, X, batch_size):
+        outputs = []
+        for start in range(0, X.shape[0], batch_size):
+            x = self.embeddings[X[start:start + batch_size]]
+            x = x.reshape((x.shape[0], -1))
+            h = np.maximum(x @ self.w1 + self.b1, 0.0)
+            logits = h @ self.w2 + self.b2
+            # softmax для argmax не нужен, но возвращаем вероятности, как и keras-модель.
+            logits -= logits.max(axis=-1, keepdims=True)
+            p = np.exp(logits)
+            outputs.append(p / p.sum(axis=-1, keepdims=True))
+        return np.concatenate(outputs, axis=0)
+
+
+def resolve_stress_backend(model_dir, backend='auto'):
+    if backend == 'auto':
+        return 'numpy' if os.path.exists(get_stress_model_path(model_dir, 'nn_stress.npz')) else 'keras'
+    elif backend in ('keras', 'numpy'):
+        return backend
+    else:
+        raise ValueError('Unknown stress model backend "{}"'.format(backend))
+
+
+def load_stress_model(model_dir, backend='auto'):
+    backend = resolve_stress_backend(model_dir, backend)
+    logging.info('Loading stress model with "%s" backend', backend)
+    if backend == 'numpy':
+        return NumpyStressModel(model_dir)
+    else:
+        return StressModel(model_dir)
+
+
+def check_parity(model_dir, words):
+    """Сверяет предсказания numpy-бэкенда с исходной keras-моделью"""
+    keras_model = StressModel(model_dir)
+    numpy_model = NumpyStressModel(model_dir)
+
+    X = np.zeros((len(words), keras_model.max_len), dtype=np.int32)
+    for irow, word in enumerate(words):
+        keras_model.vectorize_word(word, X, irow)
+
+    y_keras = keras_model.run_model(X, batch_size=256)
+    y_numpy = numpy_model.run_model(X, batch_size=256)
+    max_diff = float(np.max(np.abs(y_keras - y_numpy)))
+
+    mismatches = [word for word, i1, i2 in zip(words, np.argmax(y_keras, axis=-1), np.argmax(y_numpy, axis=-1))
+                  if i1 != i2]
+    return max_diff, mismatches
+
 
 if __name__ == '__main__':
-    model = StressModel('stress_model')
-    for word in 'чаков кошка мультипликация обсервация'.split():
-        i = model.predict(word)
-        stress = word[:i] + '^' + word[i:]
-        print('{} => {}'.format(word, stress))
+    parser = argparse.ArgumentParser(description='Stress model utilities')
+    parser.add_argument('--model_dir', type=str, default='stress_model')
+    parser.add_argument('--export', action='store_true', help='Export keras weights to nn_stress.npz')
+    parser.add_argument('--check_parity', action='store_true', help='Compare numpy backend against keras model')
+    parser.add_argument('--words', type=str, default=None, help='Word list for parity check, one word per line')
+    args = parser.parse_args()
+
+    if args.export:
+        StressModel(args.model_dir).export_npz(get_stress_model_path(args.model_dir, 'nn_stress.npz'))
+
+    if args.check_parity:
+        if args.words:
+            with io.open(args.words, 'r', encoding='utf-8') as rdr:
+                words = [line.strip().lower() for line in rdr if line.strip()]
+        else:
+            words = 'чаков кошка мультипликация обсервация синеглазый перелесками выкрутасы'.split()
+
+        max_diff, mismatches = check_parity(args.model_dir, words)
+        print('words={} max_prob_diff={:.3g} argmax_mismatches={}'.format(len(words), max_diff, len(mismatches)))
+        for word in mismatches[:20]:
+            print('mismatch: {}'.format(word))
+        if max_diff > 1e-4 or mismatches:
+            exit(1)
+
+    if not args.export and not args.check_parity:
+        model = load_stress_model(args.model_dir)
+        words = 'чаков кошка мультипликация обсервация'.split()
+        for word in words:
+            i = model.predict(word)
+            stress = word[:i] + '^' + word[i:]
+            print('{} => {}'.format(word, stress))
+
+        for word, i in zip(words, model.predict_batch(words)):
+            stress = word[:i] + '^' + word[i:]
+            print('batch: {} => {}'.format(word, stress))